@@ -0,0 +1,262 @@
+"""Benchmarks for model load, warm-up, time to first token, decode speed and chat latency.
+
+Runs against the deterministic stub backend (no model needed) or a real GGUF:
+
+    python benchmarks/run.py --backend stub --baseline benchmarks/baseline_stub.json
+    python benchmarks/run.py --backend llama_cpp --output results.json
+
+Results are written as JSON. With --baseline, every metric is compared with
+the stored run and the script exits with status 1 if one regressed by more
+than --tolerance.
+"""
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EMAIL = (
+    "hey team, just wanted to let you know the demo for the client is moved to thursday at 3pm "
+    "because their lead engineer is out sick. can someone update the slides with the new numbers "
+    "from last week and send them to me by wednesday? also we still need a volunteer to run the "
+    "live part, last time it crashed so maybe test it before. thanks"
+)
+
+PARAGRAPH = (
+    "The committee met on Monday to review the quarterly results of the regional offices. Sales in "
+    "the northern region grew by twelve percent, driven mostly by the new subscription plans, while "
+    "the southern offices reported flat revenue after two large customers delayed their renewals. "
+    "Operating costs rose slightly because of the move to the new data center, which the finance "
+    "team expects to pay for itself within eighteen months. The committee asked each office to "
+    "prepare a hiring plan for the next two quarters and to flag any project at risk of slipping. "
+)
+
+CHAT_MESSAGES = [
+    "Can you help me plan a weekend trip to the mountains?",
+    "I like hiking but not camping, what should I pack?",
+    "How long should a beginner hike be?",
+    "What if it rains on the second day?",
+    "Are there good ways to avoid crowds on the trails?",
+    "What food should I bring for a day hike?",
+    "How do I know if a trail is too difficult for me?",
+    "Thanks, can you summarize the plan in a few bullet points?",
+]
+
+# Whether a larger value of a metric is better, metrics not listed are not compared
+HIGHER_IS_BETTER = {"tokens_per_second": True, "seconds": False, "ttft": False}
+# Absolute changes below these are timer noise, not regressions
+NOISE_FLOOR = {"tokens_per_second": 0.0, "seconds": 0.02, "ttft": 0.02}
+
+
+def _median(values: Iterable[float]) -> float:
+    values = list(values)
+    return statistics.median(values) if values else 0.0
+
+
+def make_document(count_tokens: Callable[[str], int], n_tokens: int) -> str:
+    """A document of about n_tokens tokens"""
+    paragraphs = []
+    while count_tokens("\n\n".join(paragraphs)) < n_tokens:
+        paragraphs.append(f"Section {len(paragraphs) + 1}. {PARAGRAPH}")
+    return "\n\n".join(paragraphs)
+
+
+def measure_stream(deltas) -> Dict[str, float]:
+    """Time to first token, total time and decode speed of one streamed completion"""
+    start = time.perf_counter()
+    ttft = None
+    tokens = 0
+    for delta in deltas:
+        if delta.token_id is not None:
+            tokens += 1
+            if ttft is None:
+                ttft = time.perf_counter() - start
+    total = time.perf_counter() - start
+    ttft = total if ttft is None else ttft
+    decode_time = total - ttft
+    return {
+        "ttft": ttft,
+        "seconds": total,
+        "tokens": tokens,
+        "tokens_per_second": (tokens - 1) / decode_time if tokens > 1 and decode_time > 0 else 0.0,
+    }
+
+
+def summarize_runs(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    return {key: _median(run[key] for run in runs) for key in runs[0]}
+
+
+def bench_tools(tools: Dict[str, Any], inputs: Dict[str, str], repeats: int) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for tool_name, tool in tools.items():
+        for input_name, text in inputs.items():
+            runs = []
+            for i in range(repeats):
+                # A different first line per run, so runs don't reuse each other's KV cache
+                runs.append(measure_stream(tool.stream(f"Run {i}.\n{text}")))
+            results[f"{tool_name}/{input_name}"] = summarize_runs(runs)
+            print(f"{tool_name}/{input_name}: {results[f'{tool_name}/{input_name}']}", file=sys.stderr)
+    return results
+
+
+def bench_chat(chatter, turns: int, history_turns: int) -> Dict[str, Any]:
+    """Per-turn latency of a growing chat, and one turn on top of a long loaded history"""
+    from smol_tools.chatter import ChatMessage
+
+    chatter.start_new_chat()
+    per_turn = []
+    for i in range(turns):
+        per_turn.append(measure_stream(chatter.stream(CHAT_MESSAGES[i % len(CHAT_MESSAGES)])))
+    growing = {
+        "first_turn_ttft": per_turn[0]["ttft"],
+        "last_turn_ttft": per_turn[-1]["ttft"],
+        "ttft": _median(run["ttft"] for run in per_turn),
+        "seconds": _median(run["seconds"] for run in per_turn),
+        "per_turn_ttft": [run["ttft"] for run in per_turn],
+    }
+
+    # A long history arrives all at once, e.g. a reopened chat whose state was not saved
+    chatter.start_new_chat()
+    for i in range(history_turns):
+        for role, content in (("user", CHAT_MESSAGES[i % len(CHAT_MESSAGES)]), ("assistant", PARAGRAPH)):
+            chatter.chat_history.append(ChatMessage(role=role, content=content, timestamp=datetime.now()))
+    long_history = measure_stream(chatter.stream("What did we decide?"))
+    return {"chat/growing": growing, "chat/long_history": long_history}
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> List[str]:
+    """Metrics that got worse than the baseline by more than tolerance"""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            higher_is_better = HIGHER_IS_BETTER.get(metric)
+            if higher_is_better is None or not isinstance(old, (int, float)) or old <= 0:
+                continue
+            if abs(value - old) <= NOISE_FLOOR[metric]:
+                continue
+            change = (value - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{name} {metric}: {old:.4f} -> {value:.4f} ({change:+.0%})")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--backend", choices=["stub", "llama_cpp"], default="stub")
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with")
+    parser.add_argument("--update-baseline", action="store_true", help="Write the results to --baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Allowed relative regression")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--doc-tokens", type=int, default=4096)
+    parser.add_argument("--chat-turns", type=int, default=8)
+    parser.add_argument("--draft-tokens", type=int, default=0, help="Also benchmark the rewriter with prompt-lookup decoding")
+    args = parser.parse_args(argv)
+
+    # Before importing the tools, their config and caches read the environment
+    os.environ["SMOL_TOOLS_BACKEND"] = args.backend
+    os.environ["SMOL_TOOLS_RESPONSE_CACHE"] = "off"
+    from smol_tools.base import WARM_UP_STRATEGIES
+    from smol_tools.startup import startup_timings
+    from smol_tools.summarizer import SmolSummarizer
+    from smol_tools.rewriter import SmolRewriter
+    from smol_tools.titler import SmolTitler
+    from smol_tools.chatter import SmolChatter
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    # The chatter saves its chats in the working directory
+    workdir = tempfile.mkdtemp(prefix="smol_tools_bench_")
+    os.chdir(workdir)
+
+    results: Dict[str, Dict[str, Any]] = {}
+    tools = {
+        "summarizer": SmolSummarizer(),
+        "rewriter": SmolRewriter(),
+        "titler": SmolTitler(),
+    }
+    chatter = SmolChatter()
+    phases = startup_timings.phases()
+    results["load"] = {"seconds": sum(s for name, s in phases.items() if name.startswith("model load"))}
+    for name, tool in dict(tools, chatter=chatter).items():
+        runs = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            tool._warm_up()
+            runs.append(time.perf_counter() - start)
+        results[f"warm_up/{name}"] = {"seconds": _median(runs)}
+        for strategy in WARM_UP_STRATEGIES:
+            runs = []
+            for _ in range(args.repeats):
+                if tool._static_prefix is not None:
+                    # Time taking the prefix snapshot, not finding it
+                    tool.prefixes.pop(tool._static_prefix[0])
+                start = time.perf_counter()
+                tool._warm_up(strategy)
+                runs.append(time.perf_counter() - start)
+            results[f"warm_up/{name}/{strategy}"] = {"seconds": _median(runs)}
+
+    inputs = {
+        "email": EMAIL,
+        "doc_4k": make_document(tools["summarizer"]._count_tokens, args.doc_tokens),
+    }
+    results.update(bench_tools(tools, inputs, args.repeats))
+    results.update(bench_chat(chatter, args.chat_turns, history_turns=args.chat_turns * 2))
+    if args.draft_tokens:
+        from smol_tools.metrics import metrics
+        requests = []
+        metrics.add_callback(requests.append)
+        try:
+            results.update(bench_tools({"rewriter_speculative": SmolRewriter(draft_tokens=args.draft_tokens)}, inputs, args.repeats))
+        finally:
+            metrics.remove_callback(requests.append)
+        drafted = sum(r.draft_tokens for r in requests)
+        results["rewriter_speculative/drafts"] = {
+            "draft_tokens": drafted,
+            "draft_acceptance": sum(r.accepted_draft_tokens for r in requests) / drafted if drafted else 0.0,
+        }
+
+    report = {
+        "backend": args.backend,
+        "model": tools["summarizer"].config.label,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if baseline_path and args.update_baseline:
+        with open(baseline_path, "w") as f:
+            f.write(text + "\n")
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+    elif baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get("backend") != args.backend:
+            print(f"Baseline is for the {baseline.get('backend')} backend, not comparing", file=sys.stderr)
+            return 0
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
+import time
+_import_start = time.perf_counter()
 import tkinter as tk
 from tkmacosx import Button
-import time
 import threading
 import queue
 from pynput import keyboard
@@ -11,8 +12,12 @@ import pyperclip
 from smol_tools.agent import SmolToolAgent
 from smol_tools.chatter import SmolChatter
 from smol_tools.titler import SmolTitler
+from smol_tools.startup import LazyTool, startup_timings, warm_up_in_background
+from smol_tools.metrics import start_metrics_server
+from smol_tools.cancellation import CancellationToken
 import os
 import getpass
+startup_timings.record("import", time.perf_counter() - _import_start)
 
 class TextPopupApp:
     def __init__(self, root):
@@ -21,13 +26,23 @@ class TextPopupApp:
         self.last_text = ""
         self.active_popups = []
         self.last_summary = ""
-        
-        # Initialize tools
-        self.summarizer = SmolSummarizer()
-        self.rewriter = SmolRewriter()
-        self.titler = SmolTitler()
-        self.agent = SmolToolAgent()
-        self.chatter = SmolChatter()
+        # Cancels the chat reply in progress when a new message is sent
+        self.chat_cancel = None
+        self.chat_thread = None
+        
+        # Tools load on first use, and in the background meanwhile
+        self.summarizer = LazyTool(SmolSummarizer)
+        self.rewriter = LazyTool(SmolRewriter)
+        self.titler = LazyTool(SmolTitler)
+        self.agent = LazyTool(SmolToolAgent)
+        self.chatter = LazyTool(SmolChatter)
+        self.warmup = warm_up_in_background(
+            [self.summarizer, self.chatter, self.rewriter, self.agent, self.titler],
+            on_ready=lambda tool: print(f"{tool!r} is ready")
+        )
+        # Prometheus metrics of every request, e.g. SMOL_TOOLS_METRICS_PORT=9464
+        if os.environ.get("SMOL_TOOLS_METRICS_PORT"):
+            start_metrics_server(int(os.environ["SMOL_TOOLS_METRICS_PORT"]))
         
         self.keyboard_controller = Controller()
         
@@ -58,6 +73,8 @@ class TextPopupApp:
         summary_popup = tk.Toplevel(self.root)
         summary_popup.withdraw()  # Hide the window initially
         self.active_popups.append(summary_popup)
+        # Closing the popup stops its summary and answers
+        cancel = self.cancel_on_close(summary_popup)
         summary_popup.title("Summary Chat")
         summary_popup.configure(bg='#f6f8fa')
         
@@ -138,7 +155,7 @@ class TextPopupApp:
             text="Ask Question",
             command=lambda: self.process_summary_question(
                 text, chat_input.get("1.0", "end-1c").strip(),
-                chat_display, chat_input
+                chat_display, chat_input, cancel
             ),
             font=('Segoe UI', 12),
             bg='#0066FF',
@@ -156,7 +173,7 @@ class TextPopupApp:
         chat_input.bind("<Return>", lambda e: [
             self.process_summary_question(
                 text, chat_input.get("1.0", "end-1c").strip(),
-                chat_display, chat_input
+                chat_display, chat_input, cancel
             ),
             "break"
         ][1])
@@ -189,16 +206,11 @@ class TextPopupApp:
                 self.root.after(0, lambda: self.update_summary_chat(
                     chat_display, self.summarizer.name, ""))
                 
-                current_response = ""
-                for output in self.summarizer.process(input_text):
-                    # Only send the new part of the response
-                    if output.startswith(current_response):
-                        new_text = output[len(current_response):]
-                        if new_text:  # Only update if there's new text
-                            current_response = output
-                            self.root.after(0, lambda t=new_text: chat_display.config(state='normal') or 
-                                chat_display.insert("end-1c", t) or 
-                                chat_display.config(state='disabled'))
+                for delta in self.summarizer.stream(input_text, cancel=cancel):
+                    if delta.text:  # Only update if there's new text
+                        self.root.after(0, lambda t=delta.text: chat_display.config(state='normal') or 
+                            chat_display.insert("end-1c", t) or 
+                            chat_display.config(state='disabled'))
             except Exception as e:
                 print(e)
         
@@ -218,7 +230,8 @@ class TextPopupApp:
         chat_display.config(state='disabled')
 
     def process_summary_question(self, original_text: str, question: str, 
-                               chat_display: tk.Text, chat_input: tk.Text):
+                               chat_display: tk.Text, chat_input: tk.Text,
+                               cancel: CancellationToken = None):
         """Process a follow-up question about the summarized text"""
         if not question.strip():
             return
@@ -235,16 +248,11 @@ class TextPopupApp:
                 self.root.after(0, lambda: self.update_summary_chat(
                     chat_display, self.summarizer.name, ""))
 
-                current_response = ""
-                for output in self.summarizer.process(original_text, question=question):
-                    # Only send the new part of the response
-                    if output.startswith(current_response):
-                        new_text = output[len(current_response):]
-                        if new_text:  # Only update if there's new text
-                            current_response = output
-                            self.root.after(0, lambda t=new_text: chat_display.config(state='normal') or 
-                                chat_display.insert("end-1c", t) or 
-                                chat_display.config(state='disabled'))
+                for delta in self.summarizer.stream(original_text, question=question, cancel=cancel):
+                    if delta.text:  # Only update if there's new text
+                        self.root.after(0, lambda t=delta.text: chat_display.config(state='normal') or 
+                            chat_display.insert("end-1c", t) or 
+                            chat_display.config(state='disabled'))
             except Exception as e:
                 print(e)
 
@@ -265,6 +273,13 @@ class TextPopupApp:
         # Get text from clipboard
         return pyperclip.paste()
 
+    def cancel_on_close(self, window) -> CancellationToken:
+        """A token cancelled when window is destroyed, so its generations stop and free the model"""
+        cancel = CancellationToken()
+        # Children's <Destroy> events reach the toplevel's binding too
+        window.bind("<Destroy>", lambda e: cancel.cancel() if e.widget is window else None, add="+")
+        return cancel
+
     def destroy_active_popups(self):
         # Destroy all active popups
         for popup in self.active_popups:
@@ -420,11 +435,16 @@ class TextPopupApp:
         improved_text_widget.delete("1.0", tk.END)
         improved_text_widget.insert("1.0", "Generating improvement...")
         improved_text_widget.config(state='disabled')
+        cancel = self.cancel_on_close(improved_text_widget.winfo_toplevel())
         
         def improve(input_text):
             try:
-                for output in self.rewriter.process(input_text):
-                    self.root.after(0, lambda t=output: self.update_improved_text(improved_text_widget, t))
+                first = True
+                for delta in self.rewriter.stream(input_text, cancel=cancel):
+                    if delta.text:
+                        # The first piece replaces the placeholder, the rest is appended
+                        self.root.after(0, lambda t=delta.text, r=first: self.update_improved_text(improved_text_widget, t, replace=r))
+                        first = False
                 
                 # Re-enable button and restore original state after generation is complete
                 self.root.after(0, lambda: improve_btn.config(
@@ -443,10 +463,11 @@ class TextPopupApp:
         
         threading.Thread(target=lambda: improve(text), daemon=True).start()
 
-    def update_improved_text(self, text_widget, new_text):
+    def update_improved_text(self, text_widget, new_text, replace=False):
         text_widget.config(state='normal')
-        text_widget.delete("1.0", tk.END)
-        text_widget.insert("1.0", new_text)
+        if replace:
+            text_widget.delete("1.0", tk.END)
+        text_widget.insert("end-1c", new_text)
         text_widget.config(state='disabled')
 
     def show_agent_input(self):
@@ -478,12 +499,14 @@ class TextPopupApp:
             output_text.delete("1.0", tk.END)
             output_text.insert("1.0", "Processing request...\n")
             output_text.config(state='disabled')
+            cancel = self.cancel_on_close(agent_popup)
             
             def run_agent():
-                full_response = []
-                for response in self.agent.process(query):
-                    full_response.append(response)
-                    self.root.after(0, lambda t="\n".join(full_response): self.update_agent_output(output_text, t))
+                first = True
+                for delta in self.agent.stream(query, cancel=cancel):
+                    if delta.text:
+                        self.root.after(0, lambda t=delta.text, r=first: self.update_agent_output(output_text, t, replace=r))
+                        first = False
             
             threading.Thread(target=run_agent, daemon=True).start()
         
@@ -501,16 +524,18 @@ class TextPopupApp:
         y = (screen_height - popup_height) // 2
         agent_popup.geometry(f"+{x}+{y}")
 
-    def update_agent_output(self, text_widget, new_text):
+    def update_agent_output(self, text_widget, new_text, replace=False):
         text_widget.config(state='normal')
-        text_widget.delete("1.0", tk.END)
-        text_widget.insert("1.0", new_text)
+        if replace:
+            text_widget.delete("1.0", tk.END)
+        text_widget.insert("end-1c", new_text)
         text_widget.config(state='disabled')
 
     def show_chat_window(self):
         chat_window = tk.Toplevel(self.root)
         self.active_popups.append(chat_window)
         chat_window.title("SmolChat")
+        chat_window.bind("<Destroy>", lambda e: self.chat_cancel.cancel() if e.widget is chat_window and self.chat_cancel else None, add="+")
         
         # Configure the chat window to be resizable
         chat_window.geometry("800x800")
@@ -614,9 +639,7 @@ class TextPopupApp:
                 self.chatter.save_current_chat(current_chat_id, overwrite=True)
             else:
                 # Generate new title for new chat
-                summary = ""
-                for chunk in self.titler.process(chat_history):
-                    summary = chunk
+                summary = "".join(delta.text for delta in self.titler.stream(chat_history))
                 
                 summary_title = summary[:50].strip().replace("/", "-").replace("\\", "-")
                 self.chatter.save_current_chat(summary_title, overwrite=True)
@@ -647,6 +670,14 @@ class TextPopupApp:
         self.chat_controls['listbox'].config(state='disabled')
         self.chat_controls['new_chat_btn'].config(state='disabled')
             
+        # A new message stops the reply still being generated
+        previous = self.chat_thread
+        if previous is not None and previous.is_alive():
+            self.chat_cancel.cancel()
+            chat_display.config(state='normal')
+            chat_display.insert(tk.END, "\n\n")
+        cancel = self.chat_cancel = CancellationToken()
+            
         chat_display.config(state='normal')
         
         # Add extra newline before user message for spacing
@@ -663,27 +694,26 @@ class TextPopupApp:
         chat_input = input_frame.children['!text']
         chat_input.delete("1.0", tk.END)
         
-        # Initialize an empty string to store the full response
-        self.current_response = ""
-        
         chat_display.see(tk.END)
         chat_display.config(state='disabled')
         
         def chat_response():
             try:
-                for chunk in self.chatter.process(message):
-                    # Only send the new part of the response
-                    if chunk.startswith(self.current_response):
-                        new_text = chunk[len(self.current_response):]
-                        if new_text:  # Only update if there's new text
-                            self.current_response = chunk
-                            self.root.after(0, lambda t=new_text: self.update_chat_display(chat_display, t))
-                self.root.after(0, lambda t="\n\n": self.update_chat_display(chat_display, t))
+                # The cut-off reply must reach the history before this message
+                if previous is not None:
+                    previous.join()
+                for delta in self.chatter.stream(message, cancel=cancel):
+                    # Once cancelled, the display has moved on to the next message
+                    if delta.text and not cancel.cancelled:
+                        self.root.after(0, lambda t=delta.text: self.update_chat_display(chat_display, t))
+                if not cancel.cancelled:
+                    self.root.after(0, lambda t="\n\n": self.update_chat_display(chat_display, t))
             finally:
                 # Re-enable chat controls after response is complete
                 self.root.after(0, self.enable_chat_controls)
         
-        threading.Thread(target=chat_response, daemon=True).start()
+        self.chat_thread = threading.Thread(target=chat_response, daemon=True)
+        self.chat_thread.start()
 
     def enable_chat_controls(self):
         """Re-enable chat controls after response is complete"""
@@ -0,0 +1,56 @@
+import argparse
+import json
+import sys
+import time
+from .batch import TOOLS, Checkpoint, Throughput, read_items, run_batch
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["serve"]:
+        from .server import main as serve
+        return serve(argv[1:])
+
+    parser = argparse.ArgumentParser(prog="python -m smol_tools", description="Run a smol tool over many inputs, or serve the tools with 'serve'")
+    parser.add_argument("tool", choices=sorted(TOOLS))
+    parser.add_argument("inputs", nargs="*", help="JSONL files or directories of .txt/.md files, stdin if none or -")
+    parser.add_argument("-o", "--output", help="JSONL file for the results, stdout by default")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Worker processes, each loads its own model")
+    parser.add_argument("--threads-per-worker", type=int, help="Defaults to the CPU count divided by the workers")
+    parser.add_argument("--unordered", action="store_true", help="Write results as they finish instead of in input order")
+    parser.add_argument("--checkpoint", help="File of finished item ids, rerun with the same file to resume")
+    parser.add_argument("--field", default="text", help="Field holding the text in JSONL objects")
+    parser.add_argument("--report-every", type=float, default=30.0, help="Seconds between throughput reports")
+    args = parser.parse_args(argv)
+
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+    # Resumed runs add to the existing output
+    output = open(args.output, "a" if checkpoint else "w", encoding="utf-8") if args.output else sys.stdout
+    throughput = Throughput()
+    last_report = time.perf_counter()
+    try:
+        for result in run_batch(
+            args.tool,
+            read_items(args.inputs, args.field),
+            workers=args.workers,
+            ordered=not args.unordered,
+            checkpoint=checkpoint,
+            threads_per_worker=args.threads_per_worker
+        ):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            throughput.add(result)
+            if time.perf_counter() - last_report >= args.report_every:
+                print(throughput.report(), file=sys.stderr)
+                last_report = time.perf_counter()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if checkpoint:
+            checkpoint.close()
+        print(throughput.report(), file=sys.stderr)
+    return 1 if throughput.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
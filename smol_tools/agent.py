@@ -1,13 +1,36 @@
-from .base import SmolTool
-from typing import Generator, List, Dict, Any, Callable
+from .base import SmolTool, CompletionDelta, PROMPT_SENTINEL
+from .config import ModelConfig
+from .cancellation import CancellationToken
+from .grammar import ToolCallParser, tool_call_grammar
+from .http_client import http_client
+from .plan_cache import PlanCache
+from typing import Generator, List, Dict, Any, Callable, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import json
+import queue
 import re
+import os
+import threading
+import time
 from datetime import datetime
+from urllib.parse import quote
 import random
 from transformers import tool, CodeAgent
-import requests
 import webbrowser
 
+# Seconds a tool call may take before its result is given up on
+DEFAULT_TOOL_TIMEOUT = 10.0
+# Calls of one tool that run at once, and calls of all tools
+DEFAULT_TOOL_CONCURRENCY = 4
+TOOL_WORKERS = 8
+# Seconds a call may wait for a free slot of its tool before it is given up on
+TOOL_QUEUE_TIMEOUT = 30.0
+
+# Weather endpoint, {city} is replaced by the URL-quoted city, e.g. a local stand-in for tests
+WEATHER_URL_ENV = "SMOL_TOOLS_WEATHER_URL"
+DEFAULT_WEATHER_URL = "https://wttr.in/{city}?format=+%C,+%t"
+
 @tool
 def get_random_number_between(min: int, max: int) -> int:
     """
@@ -34,8 +57,10 @@ def get_weather(city: str) -> str:
     Returns:
         A string with a mock weather forecast.
     """
-    url = 'https://wttr.in/{}?format=+%C,+%t'.format(city)
-    res = requests.get(url).text
+    city = " ".join(city.split())
+    # Spelling variants of a city share one cached response
+    url = os.environ.get(WEATHER_URL_ENV, DEFAULT_WEATHER_URL).format(city=quote(city.lower()))
+    res = http_client.get_text(url)
 
     return f"The weather in {city} is {res.split(',')[0]} with a high of {res.split(',')[1][:-2]} degrees Celsius."
 
@@ -60,34 +85,270 @@ def open_webbrowser(url: str) -> str:
     return f"I opened {url.replace('https://', '').replace('www.', '')} in the browser."
 
 
+class _PendingCall:
+    """A submitted tool call, its timeout runs from when it gets a slot of its tool"""
+
+    def __init__(self, name: str, timeout: float, events: "queue.Queue"):
+        self.name = name
+        self.timeout = timeout
+        self.events = events
+        self.submitted_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.abandoned = False  # Set when given up on before it started, it then never runs
+        self.lock = threading.Lock()
+
+    def start(self) -> bool:
+        """Mark the call as running, False if it was given up on"""
+        with self.lock:
+            if self.abandoned:
+                return False
+            self.started_at = time.monotonic()
+        # Wakes the run up to wait for the new deadline
+        self.events.put(("started", self.name))
+        return True
+
+    def deadline(self) -> float:
+        with self.lock:
+            if self.started_at is None:
+                return self.submitted_at + TOOL_QUEUE_TIMEOUT
+            return self.started_at + self.timeout
+
+    def expire(self, now: float) -> Optional[str]:
+        """The message reporting the call as given up on if it is past its deadline, else None"""
+        with self.lock:
+            if self.started_at is None:
+                if now - self.submitted_at < TOOL_QUEUE_TIMEOUT:
+                    return None
+                self.abandoned = True
+                return f"Tool {self.name} gave up waiting for a free slot after {TOOL_QUEUE_TIMEOUT:g}s."
+            if now - self.started_at < self.timeout:
+                return None
+            return f"Tool {self.name} timed out after {self.timeout:g}s."
+
+    def abandon(self):
+        with self.lock:
+            if self.started_at is None:
+                self.abandoned = True
+
+
+class _ToolSlots:
+    """Calls of one tool, at most limit of them running on the shared executor.
+
+    The rest wait in a queue rather than on an executor thread, so a busy or
+    hung tool can't take up the threads every other tool runs on, and a call
+    given up on while queued is dropped without ever taking a thread.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = 0
+        self.waiting: "deque" = deque()
+        self.lock = threading.Lock()
+
+    def submit(self, executor: ThreadPoolExecutor, fn: Callable[[], Any], call: _PendingCall) -> Future:
+        """Run fn once the tool has a free slot, the future holds its result"""
+        future = Future()
+        with self.lock:
+            if self.running >= self.limit:
+                self.waiting.append((fn, call, future))
+                return future
+            self.running += 1
+        self._run(executor, fn, call, future)
+        return future
+
+    def _run(self, executor: ThreadPoolExecutor, fn: Callable[[], Any], call: _PendingCall, future: Future):
+        def task():
+            try:
+                if call.start() and future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn())
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                self._release(executor)
+
+        executor.submit(task)
+
+    def _release(self, executor: ThreadPoolExecutor):
+        # The slot passes to the oldest queued call that wasn't given up on
+        with self.lock:
+            while self.waiting:
+                fn, call, future = self.waiting.popleft()
+                if not call.abandoned and not future.cancelled():
+                    break
+                future.cancel()
+            else:
+                self.running -= 1
+                return
+        self._run(executor, fn, call, future)
+
+
+class _ToolRun:
+    """Tool calls submitted while a response may still be generating, with their results in completion order"""
+
+    def __init__(self, agent: "SmolToolAgent"):
+        self.agent = agent
+        self.events: "queue.Queue" = queue.Queue()
+        self.pending: Dict[Future, _PendingCall] = {}
+        self.lock = threading.Lock()
+        self.calls: List[Dict[str, Any]] = []
+        self.malformed = 0
+        self.generating = True
+        self.response: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+    def submit(self, tool_call: Any):
+        """Start a call on the tool executor, safe to call from any thread"""
+        if not isinstance(tool_call, dict) or "name" not in tool_call:
+            # Reported rather than dropped, the run isn't a complete plan any more
+            self.malformed += 1
+            self.events.put(("text", f"Skipped a malformed tool call: {tool_call}"))
+            return
+        self.calls.append(tool_call)
+        name = tool_call["name"]
+        if name not in self.agent.toolbox:
+            self.events.put(("text", f"Tool {name} not found."))
+            return
+        call = _PendingCall(name, self.agent.tool_timeouts.get(name, DEFAULT_TOOL_TIMEOUT), self.events)
+        future = self.agent._call_tool(name, tool_call.get("arguments") or {}, call)
+        with self.lock:
+            self.pending[future] = call
+        future.add_done_callback(lambda f: self.events.put(("done", f)))
+
+    def finish(self, response: Optional[str] = None, error: Optional[BaseException] = None):
+        """No more calls will be submitted"""
+        self.events.put(("finished", (response, error)))
+
+    def results(self, cancel: Optional[CancellationToken] = None) -> Generator[str, None, None]:
+        """Yield each tool response as soon as it's ready, until generation ended and every call is done.
+
+        A call that outlives its tool's timeout, counted from when it got a
+        slot of its tool, is reported as timed out. Its thread can't be stopped
+        and finishes in the background. A call still waiting for a slot after
+        TOOL_QUEUE_TIMEOUT, or when the run stops early, never runs.
+        """
+        try:
+            yield from self._results(cancel)
+        finally:
+            with self.lock:
+                for call in self.pending.values():
+                    call.abandon()
+
+    def _results(self, cancel: Optional[CancellationToken]) -> Generator[str, None, None]:
+        while True:
+            if cancel is not None and cancel.cancelled:
+                return
+            with self.lock:
+                if not self.generating and not self.pending:
+                    return
+                deadlines = [call.deadline() for call in self.pending.values()]
+            wait_for = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            if cancel is not None:
+                wait_for = 0.1 if wait_for is None else min(wait_for, 0.1)
+            try:
+                kind, payload = self.events.get(timeout=wait_for)
+            except queue.Empty:
+                kind, payload = None, None
+            if kind == "text":
+                yield payload
+            elif kind == "finished":
+                self.response, self.error = payload
+                self.generating = False
+            elif kind == "done":
+                with self.lock:
+                    # Timed out calls were already reported
+                    entry = self.pending.pop(payload, None)
+                if entry is not None:
+                    try:
+                        yield str(payload.result())
+                    except Exception as e:
+                        yield f"Tool {entry.name} failed: {e}"
+            now = time.monotonic()
+            expired = []
+            with self.lock:
+                for future, call in list(self.pending.items()):
+                    message = call.expire(now)
+                    if message is not None:
+                        del self.pending[future]
+                        expired.append((future, message))
+            for future, message in expired:
+                # Only stops calls still queued for a slot of their tool
+                future.cancel()
+                yield message
+
+
 class SmolToolAgent(SmolTool):
-    def __init__(self):
+    config_name = "agent"
+    # Per-tool overrides of DEFAULT_TOOL_TIMEOUT and DEFAULT_TOOL_CONCURRENCY
+    tool_timeouts: Dict[str, float] = {"get_random_number_between": 1.0, "get_current_time": 1.0}
+    tool_concurrency: Dict[str, int] = {"open_webbrowser": 1}
+    # Tools that act on the world, the plan cache only replays them for the exact same query
+    side_effect_tools = {"open_webbrowser"}
+    # Shared by every agent, created on first use
+    _tool_executor: Optional[ThreadPoolExecutor] = None
+    _tool_executor_lock = threading.Lock()
+
+    def __init__(
+        self,
+        config: Optional[ModelConfig] = None,
+        constrained: bool = True,
+        tool_timeouts: Optional[Dict[str, float]] = None,
+        tool_concurrency: Optional[Dict[str, int]] = None,
+        plan_cache: bool = True,
+        streaming: bool = True
+    ):
         self.tools = [get_random_number_between, get_current_time, open_webbrowser, get_weather]
         self.toolbox = {tool.name: tool for tool in self.tools}
+        self.tool_timeouts = dict(self.tool_timeouts, **(tool_timeouts or {}))
+        self.tool_concurrency = dict(self.tool_concurrency, **(tool_concurrency or {}))
+        self._tool_slots = {
+            name: _ToolSlots(self.tool_concurrency.get(name, DEFAULT_TOOL_CONCURRENCY)) for name in self.toolbox
+        }
+        # Constrained decoding only produces valid calls to these tools, and stops when the list closes
+        self.grammar = tool_call_grammar(self.tools) if constrained else None
+        # Tool calls of past queries, reused without generating
+        self.plans = PlanCache(embed=self._embed, side_effect_tools=self.side_effect_tools) if plan_cache else None
+        # Run each tool call as soon as it's generated instead of after the whole response
+        self.streaming = streaming
+        # The cancellation token and tool call callback of the request running on each thread, read by llm_engine
+        self._request = threading.local()
         self.json_code_agent = CodeAgent(tools=self.tools, llm_engine=self.llm_engine, system_prompt=self._get_system_prompt())
         super().__init__(
             model_repo="andito/SmolLM2-1.7B-Instruct-F16-GGUF",
             model_filename="smollm2-1.7b-8k-dpo-f16.gguf",
             system_prompt=self._get_system_prompt(),
-            prefix_text=""
+            prefix_text="",
+            config=config
         )
 
+    def _prompt_messages(self, text: str) -> None:
+        # CodeAgent builds the prompt, its static prefix is taken from the first request
+        return None
+
     def llm_engine(self, messages, stop_sequences=["Task", "<|endoftext|>"]) -> str:
+        if self._static_prefix is None and len(messages) > 1:
+            self._set_static_prefix(messages[:-1] + [dict(messages[-1], content=PROMPT_SENTINEL)])
+        on_tool_call = getattr(self._request, "on_tool_call", None)
+        parser = ToolCallParser() if on_tool_call is not None else None
         output = ""
-        for chunk in self.model.create_chat_completion(
-            messages=messages,
+        for delta in self._stream_chat_completion(
+            messages,
             max_tokens=2048,
             temperature=0.0,
             top_p=1.0,
             top_k=50,
             repeat_penalty=1.0,
-            stream=True
+            cancel=getattr(self._request, "cancel", None),
+            grammar=self.grammar
         ):
-            content = chunk['choices'][0]['delta'].get('content')
-            if content:
-                if content in ["<end_action>", "<|endoftext|>"]:
-                    break
-                output += content
+            output += delta.text
+            if parser is not None:
+                errors = len(parser.errors)
+                for tool_call in parser.feed(delta.text):
+                    on_tool_call(tool_call)
+                # Objects that aren't valid JSON are passed on as their text, to be reported as malformed
+                for raw in parser.errors[errors:]:
+                    on_tool_call(raw)
         return output
 
     def _get_system_prompt(self) -> str:
@@ -117,31 +378,116 @@ The example format is as follows. Please make sure the parameter type is correct
             return json.loads(matches[0])
         return text
 
-    def _call_tools(self, tool_calls: List[Dict[str, Any]]) -> List[str]:
-        tool_responses = []
+    @classmethod
+    def _executor(cls) -> ThreadPoolExecutor:
+        with cls._tool_executor_lock:
+            if cls._tool_executor is None:
+                cls._tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="smol-tools-tool")
+            return cls._tool_executor
+
+    def _call_tool(self, name: str, arguments: Dict[str, Any], call: _PendingCall) -> Future:
+        """Run a tool call on the shared executor once its tool has a free slot"""
+        return self._tool_slots[name].submit(self._executor(), lambda: self.toolbox[name](**arguments), call)
+
+    def _call_tools(self, tool_calls: List[Dict[str, Any]], cancel: Optional[CancellationToken] = None) -> Generator[str, None, None]:
+        """Run the calls in parallel and yield each response as soon as it's ready"""
+        run = _ToolRun(self)
         for tool_call in tool_calls:
-            if tool_call["name"] in self.toolbox:
-                tool_responses.append(
-                    self.toolbox[tool_call["name"]](**tool_call["arguments"])
-                )
+            run.submit(tool_call)
+        run.finish()
+        yield from run.results(cancel)
+
+    def _run_agent(self, text: str, cancel: Optional[CancellationToken], on_tool_call: Optional[Callable] = None) -> str:
+        self._request.cancel = cancel
+        self._request.on_tool_call = on_tool_call
+        try:
+            return self.json_code_agent.run(text, return_generated_code=True)
+        finally:
+            self._request.cancel = None
+            self._request.on_tool_call = None
+
+    def _stream_tool_calls(self, text: str, cancel: CancellationToken) -> Generator[str, None, None]:
+        """Generate on a worker thread and run each tool call as soon as its object is complete"""
+        run = _ToolRun(self)
+
+        def generate():
+            try:
+                response = self._run_agent(text, cancel, on_tool_call=run.submit)
+            except BaseException as e:
+                run.finish(error=e)
             else:
-                tool_responses.append(f"Tool {tool_call['name']} not found.")
-        return tool_responses
+                run.finish(response)
 
-    def process(self, text: str) -> Generator[str, None, None]:
-        response = self.json_code_agent.run(text, return_generated_code=True)
-        # Parse and execute the tool calls
+        threading.Thread(target=generate, name="smol-tools-agent", daemon=True).start()
+        yield from run.results(cancel)
+        if cancel.cancelled:
+            return
+        if run.error is not None:
+            raise run.error
+        if run.calls or run.malformed:
+            # A plan missing a malformed call isn't stored
+            if self.plans is not None and not run.malformed and all(call["name"] in self.toolbox for call in run.calls):
+                self.plans.store(text, run.calls)
+            return
+        # Nothing was dispatched, the response is a refusal or plain text
+        yield from self._respond(text, run.response, cancel)
+
+    def _respond(self, text: str, response: str, cancel: Optional[CancellationToken] = None) -> Generator[str, None, None]:
+        """Parse the generated response and run its tool calls"""
         try:
             tool_calls = self._parse_response(response)
+            if tool_calls == [] and self.grammar is not None:
+                # Under the grammar the model can't explain itself, an empty list is its refusal
+                yield "None of my tools can help with that."
+                return
             if tool_calls in [response, [], ""]:
                 yield response
                 return
-            tool_responses = self._call_tools(tool_calls)
+            if not isinstance(tool_calls, list) or not all(isinstance(call, dict) and "name" in call for call in tool_calls):
+                raise ValueError(f"Malformed tool calls: {tool_calls!r}")
         except Exception as e:
             print("error", e)
             yield response
             return
 
-        # Yield each tool response
-        for response in tool_responses:
-            yield str(response) 
\ No newline at end of file
+        if self.plans is not None and all(call["name"] in self.toolbox for call in tool_calls):
+            self.plans.store(text, tool_calls)
+
+        # Yield each tool response as it completes
+        yield from self._call_tools(tool_calls, cancel)
+
+    def process(self, text: str, cancel: Optional[CancellationToken] = None) -> Generator[str, None, None]:
+        if self.plans is not None:
+            plan = self.plans.lookup(text)
+            if plan is not None:
+                tool_calls, kind, confidence = plan
+                print(f"Plan cache {kind} hit ({confidence:.2f}): {tool_calls}")
+                yield from self._call_tools(tool_calls, cancel)
+                return
+
+        if self.streaming:
+            # Closing the generator early stops the generation behind it
+            token = cancel if cancel is not None else CancellationToken()
+            try:
+                yield from self._stream_tool_calls(text, token)
+            finally:
+                if cancel is None:
+                    token.cancel()
+            return
+
+        response = self._run_agent(text, cancel)
+        # A cut-off response could hold half a tool call, don't run it
+        if cancel is not None and cancel.cancelled:
+            return
+        yield from self._respond(text, response, cancel)
+
+    def plan_stats(self) -> Dict[str, Any]:
+        """Entries, hits by kind and hit rate of the plan cache"""
+        return self.plans.stats() if self.plans is not None else {}
+
+    def stream(self, text: str, cancel: Optional[CancellationToken] = None) -> Generator[CompletionDelta, None, None]:
+        # Tool responses arrive whole, one delta per response separated by newlines
+        for i, response in enumerate(self.process(text, cancel=cancel)):
+            yield CompletionDelta(text=response if i == 0 else f"\n{response}")
+        if cancel is not None and cancel.cancelled:
+            yield CompletionDelta(text="", finish_reason=cancel.reason)
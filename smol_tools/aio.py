@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import AsyncGenerator, Callable, Iterator, Optional, TypeVar
+import asyncio
+import os
+import threading
+
+T = TypeVar("T")
+
+# Threads running blocking generations for async callers
+ASYNC_WORKERS_ENV = "SMOL_TOOLS_ASYNC_WORKERS"
+DEFAULT_ASYNC_WORKERS = 4
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+_ITEM, _ERROR, _DONE = range(3)
+
+
+def async_executor() -> ThreadPoolExecutor:
+    """The bounded pool shared by every async call, created on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get(ASYNC_WORKERS_ENV, DEFAULT_ASYNC_WORKERS)),
+                thread_name_prefix="smol-tools-async"
+            )
+        return _executor
+
+
+async def iterate_in_thread(
+    factory: Callable[[], Iterator[T]],
+    maxsize: int = 32,
+    executor: Optional[ThreadPoolExecutor] = None
+) -> AsyncGenerator[T, None]:
+    """Run a blocking generator on the executor and yield its items on the event loop.
+
+    Items pass through a bounded asyncio queue, so the generator pauses when
+    the consumer falls behind. When the consumer stops (the async generator
+    is closed or its task cancelled) the blocking generator is closed after
+    its current item, which ends the generation and frees the model.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(kind: int, value=None) -> bool:
+        try:
+            future = asyncio.run_coroutine_threadsafe(queue.put((kind, value)), loop)
+        except RuntimeError:
+            # The loop is closed
+            return False
+        while True:
+            try:
+                future.result(timeout=0.1)
+                return True
+            except TimeoutError:
+                if stopped.is_set():
+                    future.cancel()
+                    return False
+
+    def run():
+        iterator = None
+        try:
+            iterator = factory()
+            for item in iterator:
+                if stopped.is_set() or not put(_ITEM, item):
+                    return
+        except BaseException as e:
+            put(_ERROR, e)
+            return
+        finally:
+            # Ends the generation now rather than when the generator is collected
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+        put(_DONE)
+
+    loop.run_in_executor(executor or async_executor(), run)
+    try:
+        while True:
+            kind, value = await queue.get()
+            if kind == _DONE:
+                return
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        stopped.set()
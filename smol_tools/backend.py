@@ -0,0 +1,46 @@
+from typing import Any
+from .config import ModelConfig
+
+# llama-cpp-python is only needed for real models, the stub backend runs without it
+try:
+    import llama_cpp
+    from llama_cpp import Llama, LlamaGrammar
+    from llama_cpp.llama import LlamaState
+    from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+    from llama_cpp.llama_chat_format import Jinja2ChatFormatter, CHATML_CHAT_TEMPLATE
+except ImportError:
+    llama_cpp = None
+    Llama = None
+    LlamaGrammar = None
+    LlamaPromptLookupDecoding = None
+    Jinja2ChatFormatter = None
+    CHATML_CHAT_TEMPLATE = None
+
+    class LlamaState:
+        """Same fields as llama_cpp.llama.LlamaState"""
+
+        def __init__(self, input_ids, scores, n_tokens, llama_state, llama_state_size, seed):
+            self.input_ids = input_ids
+            self.scores = scores
+            self.n_tokens = n_tokens
+            self.llama_state = llama_state
+            self.llama_state_size = llama_state_size
+            self.seed = seed
+
+
+def load_model(config: ModelConfig, **overrides: Any):
+    """Load the model described by config, overrides replace its Llama arguments"""
+    kwargs = config.llama_kwargs()
+    kwargs.update(overrides)
+    if config.backend == "stub":
+        from .stub import StubLlama
+        return StubLlama.from_pretrained(**kwargs)
+    if Llama is None:
+        raise ImportError(
+            "llama-cpp-python is not installed, install it or use the stub backend (SMOL_TOOLS_BACKEND=stub)"
+        )
+    if config.draft_tokens > 0 and not kwargs.get("embedding"):
+        from .speculative import PromptLookupDraft
+        # Llama keeps the logits of every position when it has a draft model, to check the drafts
+        kwargs.setdefault("draft_model", PromptLookupDraft(config.draft_tokens, config.draft_ngram))
+    return Llama.from_pretrained(**kwargs)
@@ -1,74 +1,844 @@
 from abc import ABC, abstractmethod
-from typing import Generator, List, Dict, Any, Union, Tuple
-from llama_cpp import Llama
+from typing import AsyncGenerator, Generator, List, Dict, Any, Union, Tuple, Optional, Hashable
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+import codecs
+import heapq
+import itertools
+import os
+import threading
+import time
+import numpy as np
+from .backend import llama_cpp, Llama, LlamaGrammar, LlamaState, Jinja2ChatFormatter, CHATML_CHAT_TEMPLATE, load_model
+from .stub import StubChatFormatter
+from .state_cache import StateCache, compact_state, common_prefix_length
+from .startup import startup_timings
+from .config import ModelConfig, load_config
+from .models import model_manager, kv_cache_nbytes
+from .response_cache import response_cache, response_key
+from .metrics import RequestMetrics, metrics
+from .aio import iterate_in_thread
+from .cancellation import CancellationToken, RequestCancelled
+from .speculative import PromptLookupDraft
+
+# Request priorities, lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# Text that ends a generation when the model emits it
+STOP_STRINGS = ["<end_action>", "<|endoftext|>"]
+
+# Ways to prepare a tool for its first request, cheapest first, see SmolTool._warm_up
+WARM_UP_STRATEGIES = ("none", "pagein", "token", "prefix", "full")
+# Bytes read at a time when paging in a model file
+PAGE_IN_CHUNK = 16 * 1024 * 1024
+
+# Placeholder marking where the variable part of a prompt starts
+PROMPT_SENTINEL = "\u0000SMOL_PROMPT_SENTINEL\u0000"
+
+
+@dataclass
+class CompletionDelta:
+    """One step of a streamed completion"""
+    text: str  # New text since the previous delta, may be empty
+    token_id: Optional[int] = None
+    logprob: Optional[float] = None
+    finish_reason: Optional[str] = None  # "stop", "length", or the cancellation reason on the last delta
+    elapsed: float = 0.0  # Seconds since the model was acquired
+    latency: float = 0.0  # Seconds spent producing this delta, the first one includes prefill
+
+
+@dataclass(order=True)
+class _Ticket:
+    priority: int
+    tag: int
+    seq: int
+    owner: str = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    event: threading.Event = field(compare=False, default_factory=threading.Event)
+    started_at: Optional[float] = field(compare=False, default=None)
+
+
+class InferenceScheduler:
+    """Serializes inference requests on a single shared model.
+
+    Requests are served strictly by priority. Within a priority level, owners
+    (usually tool classes) are interleaved fairly using start-time fair queuing,
+    so one busy tool cannot starve another tool of the same priority.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._queue: List[_Ticket] = []
+        self._active: Optional[_Ticket] = None
+        self._seq = itertools.count()
+        self._virtual_time = 0
+        self._last_tag: Dict[str, int] = {}
+        self._served = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+
+    @contextmanager
+    def slot(self, owner: str, priority: int = PRIORITY_NORMAL, cancel: Optional[CancellationToken] = None):
+        """Block until the model is free for this request, and hold it until the block exits.
+
+        Raises RequestCancelled, and leaves the queue, if cancel is cancelled while waiting.
+        """
+        ticket = self._enqueue(owner, priority)
+        try:
+            while not ticket.event.wait(None if cancel is None else 0.05):
+                if cancel.cancelled:
+                    raise RequestCancelled(cancel.reason)
+        except BaseException:
+            self._abandon(ticket)
+            raise
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    def _enqueue(self, owner: str, priority: int) -> _Ticket:
+        with self._lock:
+            tag = max(self._virtual_time, self._last_tag.get(owner, 0)) + 1
+            self._last_tag[owner] = tag
+            ticket = _Ticket(priority, tag, next(self._seq), owner, time.perf_counter())
+            heapq.heappush(self._queue, ticket)
+            self._dispatch()
+        return ticket
+
+    def _dispatch(self):
+        # Must be called with self._lock held
+        if self._active is not None or not self._queue:
+            return
+        ticket = heapq.heappop(self._queue)
+        ticket.started_at = time.perf_counter()
+        wait = ticket.started_at - ticket.enqueued_at
+        self._virtual_time = ticket.tag
+        self._served += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        self._last_wait = wait
+        self._active = ticket
+        ticket.event.set()
+
+    def _release(self, ticket: _Ticket):
+        with self._lock:
+            if self._active is ticket:
+                self._active = None
+            self._dispatch()
+
+    def _abandon(self, ticket: _Ticket):
+        with self._lock:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+            elif self._active is ticket:
+                self._active = None
+            self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        """Current queue depth and wait time statistics"""
+        with self._lock:
+            now = time.perf_counter()
+            return {
+                "model": self.name,
+                "queue_depth": len(self._queue),
+                "active": self._active.owner if self._active else None,
+                "waiting": sorted((t.owner for t in self._queue)),
+                "oldest_wait": max((now - t.enqueued_at for t in self._queue), default=0.0),
+                "served": self._served,
+                "mean_wait": self._total_wait / self._served if self._served else 0.0,
+                "max_wait": self._max_wait,
+                "last_wait": self._last_wait,
+            }
+
 
 class SmolTool(ABC):
-    # Class-level cache for model instances
-    _model_cache: Dict[Tuple[str, str], Llama] = {}
+    # Models are loaded and evicted by model_manager, keyed by config
+    # One scheduler per model, shared by every tool using it
+    _scheduler_cache: Dict[Tuple, InferenceScheduler] = {}
+    # Chat prompt formatters built from each model's template
+    _formatter_cache: Dict[Tuple, Jinja2ChatFormatter] = {}
+    # Saved KV states of each model, keyed by the prefix they belong to
+    _state_cache: Dict[Tuple, StateCache] = {}
+    # Snapshots of the tools' static prompt prefixes, apart so chats and documents can't evict them
+    _prefix_cache: Dict[Tuple, StateCache] = {}
+    # Embedding-mode contexts of each model, created on first use
+    _embedding_cache: Dict[Tuple, Llama] = {}
+    _embedding_lock = threading.Lock()
 
-    def __init__(self, model_repo: str, model_filename: str, system_prompt: str, prefix_text: str = "", n_ctx: int = 8192):
+    # Default scheduling priority for this tool's requests
+    priority: int = PRIORITY_NORMAL
+    # Section of the config file and infix of environment overrides for this tool
+    config_name: str = "default"
+    # Whether identical requests may be answered from the response cache
+    cache_responses: bool = True
+
+    def __init__(
+        self,
+        model_repo: str,
+        model_filename: str,
+        system_prompt: str,
+        prefix_text: str = "",
+        n_ctx: int = 8192,
+        config: Optional[ModelConfig] = None
+    ):
         self.system_prompt = system_prompt
         self.prefix_text = prefix_text
-        
-        # Create a cache key from the model repo and filename
-        cache_key = (model_repo, model_filename)
-        
-        # Track if this is a new model load
-        is_new_model = cache_key not in self._model_cache
-        
-        # Try to get the model from cache, or create and cache a new one
-        if is_new_model:
-            print(f"Loading model {model_filename} from {model_repo}...")
-            self._model_cache[cache_key] = Llama.from_pretrained(
-                repo_id=model_repo,
-                filename=model_filename,
-                n_ctx=n_ctx,
-                verbose=False
+
+        # The arguments are the tool's defaults, the config file and environment override them
+        if config is None:
+            config = load_config(
+                self.config_name,
+                ModelConfig(model_repo=model_repo, model_filename=model_filename, n_ctx=n_ctx)
             )
-        
-        self.model = self._model_cache[cache_key]
-        
-        # Only warm up for newly loaded models
+        self.config = config
+
+        # Tools with identical configs share one model
+        cache_key = config.cache_key()
+
+        # Track if this is a new model load
+        is_new_model = model_manager.register(
+            cache_key,
+            config,
+            on_unload=lambda model: SmolTool._model_unloaded(cache_key, model)
+        )
         if is_new_model:
-            self._warm_up()
-
-    def _warm_up(self):
-        """Warm up the model with a test prompt"""
-        print(f"Warming up {self.__class__.__name__}...")
-        test_text = "This is a test message to warm up the model."
-        # Consume the generator to complete the warm-up
-        for _ in self.process(test_text):
-            pass
+            self._scheduler_cache[cache_key] = InferenceScheduler(config.label)
+            self._state_cache[cache_key] = StateCache()
+            # One entry per tool prompt, a handful per model
+            self._prefix_cache[cache_key] = StateCache(capacity=16, max_bytes=512 * 1024 ** 2)
+            # Saved states and the embedding context are counted in the model's memory budget
+            model_manager.add_memory_source(cache_key, lambda: SmolTool._state_cache[cache_key].nbytes)
+            model_manager.add_memory_source(cache_key, lambda: SmolTool._prefix_cache[cache_key].nbytes)
+            model_manager.add_memory_source(cache_key, lambda: SmolTool._embedding_nbytes(cache_key))
+
+        self.cache_key = cache_key
+        self.scheduler = self._scheduler_cache[cache_key]
+        self.states = self._state_cache[cache_key]
+        self.prefixes = self._prefix_cache[cache_key]
+        # State key and tokens of the prompt prefix shared by this tool's requests
+        self._static_prefix: Optional[Tuple[Hashable, List[int]]] = None
+        # Load now rather than on the first request
+        model_manager.get(cache_key)
+
+        # Every tool warms up, even on a model another tool loaded, to snapshot its own prefix
+        if config.warm_up_background:
+            # Requests can start meanwhile, they queue for the model like any other
+            threading.Thread(
+                target=self._timed_warm_up, name=f"smol-tools-warm-up-{self.__class__.__name__}", daemon=True
+            ).start()
+        else:
+            self._timed_warm_up()
+
+    @property
+    def model(self) -> Llama:
+        """This tool's model, loaded again if it was evicted"""
+        return model_manager.get(self.cache_key)
+
+    def unload(self) -> bool:
+        """Free this tool's model (and every other tool's using it) until it is needed again"""
+        return model_manager.unload(self.cache_key)
+
+    @classmethod
+    def _model_unloaded(cls, cache_key: Tuple, model: Llama):
+        """Free the saved states and embedding context of an evicted model.
+
+        Keeping them would hold on to most of the memory the unload was for.
+        Chats, documents and prompt prefixes are evaluated again after a reload.
+        """
+        cls._state_cache[cache_key].clear()
+        cls._prefix_cache[cache_key].clear()
+        with cls._embedding_lock:
+            context = cls._embedding_cache.pop(cache_key, None)
+            if context is not None:
+                context.close()
+
+    @classmethod
+    def _embedding_nbytes(cls, cache_key: Tuple) -> int:
+        context = cls._embedding_cache.get(cache_key)
+        return kv_cache_nbytes(context) if context is not None else 0
+
+    @contextmanager
+    def _hold_model(self, priority: Optional[int] = None, cancel: Optional[CancellationToken] = None):
+        """Keep the model loaded and wait for its scheduler slot, holding both until the block exits"""
+        priority = self.priority if priority is None else priority
+        with model_manager.lease(self.cache_key):
+            with self.scheduler.slot(self.__class__.__name__, priority, cancel) as ticket:
+                yield ticket
+
+    def _timed_warm_up(self):
+        # SMOL_TOOLS_WARM_UP=none parses as None
+        strategy = self.config.warm_up or "none"
+        try:
+            with startup_timings.phase(f"warm-up {self.__class__.__name__} ({strategy})"):
+                self._warm_up(strategy)
+        except Exception as e:
+            if not self.config.warm_up_background:
+                raise
+            print(f"Warm-up of {self.__class__.__name__} failed: {e}")
+
+    def _warm_up(self, strategy: Optional[str] = None):
+        """Prepare the model for the first request, with the config's strategy by default.
+
+        "none" does nothing, "pagein" reads the model file so the weights
+        llama.cpp mmap'd are in memory, "token" evaluates a single token,
+        "prefix" evaluates and snapshots the tool's static prompt prefix so
+        requests only evaluate their own text, and "full" generates a whole
+        response to a test message.
+        """
+        strategy = strategy or self.config.warm_up or "none"
+        if strategy not in WARM_UP_STRATEGIES:
+            raise ValueError(f"Unknown warm-up strategy {strategy!r}, expected one of {WARM_UP_STRATEGIES}")
+        messages = self._prompt_messages(PROMPT_SENTINEL)
+        if messages is not None:
+            # Snapshotted now with "prefix", by the first request otherwise
+            self._set_static_prefix(messages, evaluate=strategy == "prefix")
+        elif strategy == "prefix":
+            # The prompt isn't known before the first request
+            strategy = "token"
+        if strategy == "none":
+            return
+        print(f"Warming up {self.__class__.__name__} ({strategy})...")
+        if strategy == "pagein":
+            self._page_in()
+        elif strategy == "token":
+            with self._hold_model(PRIORITY_BACKGROUND):
+                tokens = [self.model.token_bos()]
+                self._prepare_context(tokens, None)
+                self._prefill(tokens)
+        elif strategy == "full":
+            test_text = "This is a test message to warm up the model."
+            # Consume the generator to complete the warm-up
+            for _ in self.process(test_text):
+                pass
         print(f"{self.__class__.__name__} ready!")
 
+    def _page_in(self):
+        """Read the model file once, so its mmap'd weights are served from the page cache"""
+        path = getattr(self.model, "model_path", None)
+        if not self.config.use_mmap or not path or not os.path.isfile(path):
+            return
+        buffer = bytearray(PAGE_IN_CHUNK)
+        with open(path, "rb", buffering=0) as f:
+            while f.readinto(buffer):
+                pass
+
+    def _prompt_messages(self, text: str) -> Optional[List[Dict[str, str]]]:
+        """Messages of a request for text, None if the tool doesn't build its own prompt"""
+        messages = [{"role": "system", "content": self.system_prompt}] if self.system_prompt else []
+        content = f"{self.prefix_text}\n{text}" if self.prefix_text else text
+        return messages + [{"role": "user", "content": content}]
+
+    def _set_static_prefix(self, messages: List[Dict[str, str]], evaluate: bool = True):
+        """Snapshot the prompt of messages up to PROMPT_SENTINEL, restored before each request starting with it.
+
+        With evaluate=False the snapshot is taken by the first request that needs it.
+        """
+        tokens = self._prefix_tokens(messages)
+        # Keyed by content, tools with the same prefix on one model share the snapshot
+        key = ("prefix", hash(tuple(tokens)))
+        self._static_prefix = (key, tokens)
+        if evaluate and self.prefixes.get(key) is None:
+            with self._hold_model():
+                self._snapshot_static_prefix(key, tokens)
+
     @abstractmethod
-    def process(self, text: str) -> Generator[str, None, None]:
-        """Process the input text and yield results as they're generated"""
+    def stream(self, text: str, cancel: Optional[CancellationToken] = None) -> Generator[CompletionDelta, None, None]:
+        """Process the input text and yield the new text of the result as it's generated.
+
+        Generation stops early, with the token's reason as finish reason, when cancel is cancelled.
+        """
         pass
 
+    def process(self, *args, **kwargs) -> Generator[str, None, None]:
+        """Process the input text and yield the full result so far as it's generated"""
+        output = ""
+        for delta in self.stream(*args, **kwargs):
+            if delta.text:
+                output += delta.text
+                yield output
+
+    async def astream(self, *args, **kwargs) -> AsyncGenerator[CompletionDelta, None]:
+        """Async version of stream(), the generation runs on a bounded thread pool.
+
+        Cancelling the task (or closing the generator) stops the generation
+        after the current token and frees the model for the next request.
+        """
+        async for delta in iterate_in_thread(lambda: self.stream(*args, **kwargs)):
+            yield delta
+
+    async def aprocess(self, *args, **kwargs) -> AsyncGenerator[str, None]:
+        """Async version of process(), see astream()"""
+        async for output in iterate_in_thread(lambda: self.process(*args, **kwargs)):
+            yield output
+
+    def scheduler_stats(self) -> Dict[str, Any]:
+        """Queue depth and wait times of the scheduler for this tool's model"""
+        return self.scheduler.stats()
+
+    @staticmethod
+    def model_stats() -> Dict[str, Any]:
+        """Memory budget and the resident models of every tool"""
+        return model_manager.stats()
+
+    def _chat_formatter(self) -> Jinja2ChatFormatter:
+        """Build (once per model) the formatter create_chat_completion would use"""
+        formatter = self._formatter_cache.get(self.cache_key)
+        if formatter is None and self.config.backend == "stub":
+            formatter = self._formatter_cache[self.cache_key] = StubChatFormatter()
+        if formatter is None:
+            template = self.model.metadata.get("tokenizer.chat_template", CHATML_CHAT_TEMPLATE)
+            eos_token_id = self.model.token_eos()
+            formatter = Jinja2ChatFormatter(
+                template=template,
+                eos_token=self.model.detokenize([eos_token_id], special=True).decode("utf-8", errors="ignore"),
+                bos_token=self.model.detokenize([self.model.token_bos()], special=True).decode("utf-8", errors="ignore"),
+                stop_token_ids=[eos_token_id],
+            )
+            self._formatter_cache[self.cache_key] = formatter
+        return formatter
+
+    def _tokenize_messages(self, messages: List[Dict[str, str]]) -> List[int]:
+        """Render messages with the model's chat template and tokenize the prompt"""
+        result = self._chat_formatter()(messages=messages)
+        return self.model.tokenize(
+            result.prompt.encode("utf-8"),
+            add_bos=not result.added_special,
+            special=True
+        )
+
+    def _prefix_tokens(self, messages: List[Dict[str, str]]) -> List[int]:
+        """Tokens of the rendered prompt up to PROMPT_SENTINEL, the part shared by every request"""
+        result = self._chat_formatter()(messages=messages)
+        prefix = result.prompt.split(PROMPT_SENTINEL)[0].rstrip()
+        return self.model.tokenize(
+            prefix.encode("utf-8"),
+            add_bos=not result.added_special,
+            special=True
+        )
+
+    def _stop_token_ids(self) -> set:
+        stop_ids = {self.model.token_eos()}
+        for stop in STOP_STRINGS:
+            tokens = self.model.tokenize(stop.encode("utf-8"), add_bos=False, special=True)
+            if len(tokens) == 1:
+                stop_ids.add(tokens[0])
+        return stop_ids
+
+    def _spawn_context(self, n_ctx: int, n_threads: Optional[int] = None, **kwargs) -> Llama:
+        """Load a private context of this tool's model, for work that runs beside the shared one.
+
+        The weights are memory-mapped, so extra contexts mostly cost their KV cache.
+        """
+        if n_threads is not None:
+            kwargs["n_threads"] = n_threads
+        return load_model(self.config, n_ctx=n_ctx, **kwargs)
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        """Mean-pooled embeddings of texts from this tool's model"""
+        with self._embedding_lock:
+            context = self._embedding_cache.get(self.cache_key)
+            if context is None:
+                context = self._spawn_context(
+                    2048,
+                    embedding=True,
+                    pooling_type=llama_cpp.LLAMA_POOLING_TYPE_MEAN if llama_cpp else None
+                )
+                self._embedding_cache[self.cache_key] = context
+            return context.embed(texts)
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self.model.tokenize(text.encode("utf-8"), add_bos=False))
+
+    @staticmethod
+    def _last_logprob(model: Llama, token: int) -> Optional[float]:
+        """Log-probability of a token just sampled from the last position, if the logits are available"""
+        if model.draft_model is not None:
+            return None
+        try:
+            logits = np.ctypeslib.as_array(
+                llama_cpp.llama_get_logits_ith(model.ctx, -1),
+                shape=(model.n_vocab(),)
+            )
+        except Exception:
+            return None
+        return float(Llama.logits_to_logprobs(logits)[token])
+
+    def _stream_chat_completion(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.4,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        repeat_penalty: float = 1.2,
+        max_tokens: int = 256,
+        priority: Optional[int] = None,
+        logprobs: bool = False,
+        state_key: Optional[Hashable] = None,
+        update_state: bool = True,
+        cache: Optional[bool] = None,
+        cancel: Optional[CancellationToken] = None,
+        grammar: Optional[str] = None
+    ) -> Generator[CompletionDelta, None, None]:
+        """Generate a chat completion and yield one delta per sampled token.
+
+        Requests that share a state_key (e.g. the turns of one chat) keep their
+        KV cache across calls, so only the tokens after their shared prefix are
+        evaluated even if other requests used the model in between. With
+        update_state=False the saved state is only read, never replaced.
+
+        Completed responses are cached by model config, rendered prompt and
+        sampling parameters, and repeated requests are replayed from the cache.
+        By default only deterministic (temperature 0) requests are cached,
+        cache=True or SMOL_TOOLS_CACHE_SAMPLED=1 opts sampled ones in.
+
+        Closing the generator stops decoding at once and frees the model for
+        the next request, as does cancelling cancel (see CancellationToken).
+        A GBNF grammar constrains the sampled tokens to the text it accepts.
+        """
+        start = time.perf_counter()
+        # Stays "cancelled" unless the generation runs to its end
+        stats = RequestMetrics(self.__class__.__name__, self.config.label, finish_reason="cancelled")
+        try:
+            if cache is None:
+                cache = self.cache_responses and (temperature <= 0 or response_cache.cache_sampled)
+            key = None
+            if cache:
+                key = response_key(
+                    self.config.cache_key(),
+                    self._chat_formatter()(messages=messages).prompt,
+                    temperature, top_p, top_k, repeat_penalty, max_tokens, logprobs, grammar
+                )
+                cached = response_cache.get(key)
+                if cached is not None:
+                    stats.cache_hit = True
+                    for delta in _replay(cached, cancel):
+                        if delta.token_id is not None:
+                            stats.completion_tokens += 1
+                        if delta.finish_reason is not None:
+                            stats.finish_reason = delta.finish_reason
+                        yield delta
+                    return
+
+            deltas = []
+            # Hold the model for the whole generation, one request at a time
+            with ExitStack() as hold:
+                try:
+                    ticket = hold.enter_context(self._hold_model(priority, cancel))
+                except RequestCancelled:
+                    # Cancelled while queued, the model was never touched
+                    stats.finish_reason = cancel.reason
+                    yield CompletionDelta(text="", finish_reason=cancel.reason)
+                    return
+                stats.queue_wait = ticket.started_at - ticket.enqueued_at
+                prompt_tokens = self._tokenize_messages(messages)
+                _check_prompt_fits(prompt_tokens, self.model)
+                self._prepare_context(prompt_tokens, state_key, update_state, self._static_prefix_key(prompt_tokens))
+                # Llama.generate re-evaluates at least the last prompt token
+                stats.cached_prompt_tokens = min(
+                    common_prefix_length(self.model._input_ids, prompt_tokens), len(prompt_tokens) - 1
+                )
+                for delta in self._generate(
+                    prompt_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    top_k=top_k,
+                    repeat_penalty=repeat_penalty,
+                    max_tokens=max_tokens,
+                    logprobs=logprobs,
+                    stats=stats,
+                    cancel=cancel,
+                    grammar=grammar
+                ):
+                    if not stats.ttft and delta.token_id is not None:
+                        stats.ttft = time.perf_counter() - start
+                    if key is not None:
+                        deltas.append(delta)
+                    yield delta
+
+            # Only responses that ran to the end are cached, not ones cut short by cancel
+            if key is not None and deltas and deltas[-1].finish_reason in ("stop", "length"):
+                response_cache.put(key, ([(d.text, d.token_id, d.logprob) for d in deltas], deltas[-1].finish_reason))
+        finally:
+            stats.total_seconds = time.perf_counter() - start
+            stats.ttft = stats.ttft or stats.total_seconds
+            metrics.record(stats)
+            if cancel is not None:
+                cancel.report(stats)
+
+    def _prepare_context(
+        self,
+        prompt_tokens: List[int],
+        state_key: Optional[Hashable],
+        update_state: bool = True,
+        prefix_key: Optional[Hashable] = None
+    ):
+        """Swap the KV state for state_key into the model, the caller must hold the scheduler slot.
+
+        The snapshot of prefix_key is loaded instead when it shares more of the
+        prompt, e.g. for a new chat or after another tool used the model.
+        """
+        states = self.states
+        candidates = [self.prefixes.get(prefix_key) if prefix_key is not None else None]
+        if states.resident != state_key:
+            # Park the context of the previous key before this request overwrites it
+            if states.resident is not None and states.resident_dirty:
+                states.put(states.resident, self._save_state())
+            states.resident = state_key
+            states.resident_dirty = False
+            candidates.insert(0, states.get(state_key) if state_key is not None else None)
+        elif states.resident_dirty:
+            # The live context is the latest state of state_key, don't drop it
+            candidates = []
+        best, best_length = None, common_prefix_length(self.model._input_ids, prompt_tokens)
+        for state in candidates:
+            if state is not None:
+                length = common_prefix_length(state.input_ids[:state.n_tokens], prompt_tokens)
+                if length > best_length:
+                    best, best_length = state, length
+        if best is not None:
+            self.model.load_state(best)
+        # Generation will append to the live context
+        states.resident_dirty = states.resident_dirty or (state_key is not None and update_state)
+
+    def _prefill(self, tokens: List[int]):
+        """Evaluate tokens without sampling, reusing the matching prefix of the live context"""
+        n_past = common_prefix_length(self.model._input_ids, tokens)
+        self.model.n_tokens = n_past
+        if n_past < len(tokens):
+            self.model.eval(tokens[n_past:])
+
+    def _prefill_state(self, state_key: Hashable, messages: List[Dict[str, str]]) -> LlamaState:
+        """Evaluate the prompt prefix of messages (up to PROMPT_SENTINEL) once and save it as state_key"""
+        with self._hold_model():
+            return self._snapshot_prefix(state_key, self._prefix_tokens(messages))
+
+    def _snapshot_prefix(self, state_key: Hashable, tokens: List[int]) -> LlamaState:
+        """Evaluate tokens and save them as state_key, the caller must hold the scheduler slot"""
+        self._prepare_context(tokens, state_key)
+        self._prefill(tokens)
+        state = self._save_state()
+        self.states.put(state_key, state)
+        self.states.resident_dirty = False
+        return state
+
+    def _snapshot_static_prefix(self, key: Hashable, tokens: List[int]):
+        """Evaluate a static prefix and save it in the prefix cache, the caller must hold the scheduler slot"""
+        self._prepare_context(tokens, None)
+        self._prefill(tokens)
+        self.prefixes.put(key, self._save_state())
+
+    def _static_prefix_key(self, prompt_tokens: List[int]) -> Optional[Hashable]:
+        """State key of the static prefix if the prompt starts with it, the caller must hold the scheduler slot"""
+        if self._static_prefix is None:
+            return None
+        key, tokens = self._static_prefix
+        # The last prefix token may merge with the text after it
+        if common_prefix_length(prompt_tokens, tokens) < len(tokens) - 1:
+            return None
+        if self.prefixes.get(key) is None:
+            # Not taken at warm-up, or freed with the model, evaluate it for this and later requests
+            self._snapshot_static_prefix(key, tokens)
+        return key
+
+    def _save_state(self) -> LlamaState:
+        return _snapshot(self.model)
+
+    def snapshot_state(self, state_key: Hashable) -> Optional[LlamaState]:
+        """Latest saved KV state for state_key, snapshotting the live context if it holds that key"""
+        if self.states.resident == state_key and self.states.resident_dirty:
+            with self._hold_model():
+                if self.states.resident == state_key and self.states.resident_dirty:
+                    self.states.put(state_key, self._save_state())
+                    self.states.resident_dirty = False
+        return self.states.get(state_key)
+
+    def _generate(
+        self,
+        prompt_tokens: List[int],
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        repeat_penalty: float,
+        max_tokens: int,
+        logprobs: bool = False,
+        model: Optional[Llama] = None,
+        stats: Optional[RequestMetrics] = None,
+        cancel: Optional[CancellationToken] = None,
+        grammar: Optional[str] = None
+    ) -> Generator[CompletionDelta, None, None]:
+        """Token-level decode loop.
+
+        Runs on the shared model unless a private context is given, the caller
+        must hold the scheduler slot when using the shared model. Token counts
+        and timings are written to stats as the generation progresses, and
+        cancel is checked after every token.
+        """
+        model = self.model if model is None else model
+        _check_prompt_fits(prompt_tokens, model)
+        start = last = time.perf_counter()
+        max_tokens = min(max_tokens, model.n_ctx() - len(prompt_tokens))
+        stop_ids = self._stop_token_ids()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""  # Text held back because it may be the start of a stop string
+        finish_reason = "length"
+        n_generated = 0
+        if stats is not None:
+            stats.prompt_tokens = len(prompt_tokens)
+        # The stub backend has no grammar support and ignores it
+        if grammar is not None and LlamaGrammar is not None and isinstance(model, Llama):
+            grammar = LlamaGrammar.from_string(grammar, verbose=False)
+        draft = getattr(model, "draft_model", None)
+        if isinstance(draft, PromptLookupDraft):
+            draft.reset()
+            drafted, accepted = draft.drafted, draft.accepted
+
+        if cancel is not None and cancel.cancelled:
+            finish_reason = cancel.reason
+        elif max_tokens > 0:
+            for token in model.generate(
+                prompt_tokens,
+                temp=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                repeat_penalty=repeat_penalty,
+                grammar=grammar
+            ):
+                now = time.perf_counter()
+                n_generated += 1
+                if stats is not None:
+                    if n_generated == 1:
+                        stats.prefill_seconds = now - start
+                    stats.completion_tokens = n_generated
+                    stats.decode_seconds = now - start - stats.prefill_seconds
+                if token in stop_ids:
+                    finish_reason = "stop"
+                    break
+                # Other requests sharing cancel may have spent its budget since the last token
+                if cancel is not None and not cancel.consume():
+                    # The token is dropped, it doesn't count as generated
+                    n_generated -= 1
+                    if stats is not None:
+                        stats.completion_tokens = n_generated
+                    finish_reason = cancel.reason
+                    break
+
+                pending += decoder.decode(model.detokenize([token]))
+                stop_at = _find_stop(pending)
+                if stop_at is not None:
+                    pending = pending[:stop_at]
+                    finish_reason = "stop"
+                    break
+                emit = _emittable_length(pending)
+                yield CompletionDelta(
+                    text=pending[:emit],
+                    token_id=token,
+                    logprob=self._last_logprob(model, token) if logprobs else None,
+                    elapsed=now - start,
+                    latency=now - last
+                )
+                pending = pending[emit:]
+                last = now
+
+                if n_generated >= max_tokens:
+                    break
+                if cancel is not None and cancel.cancelled:
+                    finish_reason = cancel.reason
+                    break
+
+        if stats is not None:
+            stats.finish_reason = finish_reason
+            if isinstance(draft, PromptLookupDraft):
+                stats.draft_tokens = draft.drafted - drafted
+                stats.accepted_draft_tokens = draft.accepted - accepted
+        now = time.perf_counter()
+        yield CompletionDelta(
+            text=pending + decoder.decode(b"", final=True),
+            finish_reason=finish_reason,
+            elapsed=now - start,
+            latency=now - last
+        )
+
     def _create_chat_completion(
-        self, 
-        messages: List[Dict[str, str]], 
+        self,
+        messages: List[Dict[str, str]],
         temperature: float = 0.4,
         top_p: float = 0.9,
         top_k: int = 50,
         repeat_penalty: float = 1.2,
-        max_tokens: int = 256
+        max_tokens: int = 256,
+        priority: Optional[int] = None
     ) -> Generator[str, None, None]:
-        """Helper method to create chat completions with standard parameters"""
+        """Cumulative-text wrapper around _stream_chat_completion, kept for compatibility"""
         output = ""
-        for chunk in self.model.create_chat_completion(
-            messages=messages,
-            max_tokens=max_tokens,
+        for delta in self._stream_chat_completion(
+            messages,
             temperature=temperature,
             top_p=top_p,
             top_k=top_k,
             repeat_penalty=repeat_penalty,
-            stream=True
+            max_tokens=max_tokens,
+            priority=priority
         ):
-            content = chunk['choices'][0]['delta'].get('content')
-            if content:
-                if content in ["<end_action>", "<|endoftext|>"]:
-                    break
-                output += content
-                yield output
\ No newline at end of file
+            if delta.text:
+                output += delta.text
+                yield output
+
+
+def _replay(response, cancel: Optional[CancellationToken] = None) -> Generator[CompletionDelta, None, None]:
+    """Stream a cached response the way _generate produced it, stopping where cancel would have stopped it"""
+    deltas, finish_reason = response
+    start = time.perf_counter()
+    if cancel is not None and cancel.cancelled:
+        yield CompletionDelta(text="", finish_reason=cancel.reason)
+        return
+    for i, (text, token_id, logprob) in enumerate(deltas):
+        last = i == len(deltas) - 1
+        # Replayed tokens count against the budget like generated ones
+        if cancel is not None and token_id is not None and not cancel.consume():
+            yield CompletionDelta(text="", finish_reason=cancel.reason, elapsed=time.perf_counter() - start)
+            return
+        yield CompletionDelta(
+            text=text,
+            token_id=token_id,
+            logprob=logprob,
+            finish_reason=finish_reason if last else None,
+            elapsed=time.perf_counter() - start
+        )
+        if cancel is not None and not last and cancel.cancelled:
+            yield CompletionDelta(text="", finish_reason=cancel.reason, elapsed=time.perf_counter() - start)
+            return
+
+
+def _snapshot(model: Llama) -> LlamaState:
+    """Save the model's state, keeping only the logits generation needs"""
+    state = model.save_state()
+    if not model.context_params.logits_all:
+        state = compact_state(state)
+    return state
+
+
+def _check_prompt_fits(prompt_tokens: List[int], model: Llama):
+    """Raise ValueError if the prompt leaves no room in the context to generate"""
+    if len(prompt_tokens) >= model.n_ctx():
+        raise ValueError(
+            f"Prompt is {len(prompt_tokens)} tokens but the context only holds {model.n_ctx()}, shorten the input"
+        )
+
+
+def _find_stop(text: str) -> Optional[int]:
+    """Index of the first stop string in text, if any"""
+    positions = [text.find(stop) for stop in STOP_STRINGS if stop in text]
+    return min(positions) if positions else None
+
+
+def _emittable_length(text: str) -> int:
+    """Length of the prefix of text that cannot be the start of a stop string"""
+    for i in range(max(0, len(text) - max(map(len, STOP_STRINGS)) + 1), len(text)):
+        if any(stop.startswith(text[i:]) for stop in STOP_STRINGS):
+            return i
+    return len(text)
@@ -0,0 +1,187 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from dataclasses import dataclass
+from typing import Any, Dict, Generator, Iterable, Iterator, List, Optional
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+# Tools the batch runner can use, by CLI name
+TOOLS = {
+    "summarize": ("smol_tools.summarizer", "SmolSummarizer"),
+    "rewrite": ("smol_tools.rewriter", "SmolRewriter"),
+    "title": ("smol_tools.titler", "SmolTitler"),
+}
+
+# Files picked up when an input is a directory
+TEXT_EXTENSIONS = (".txt", ".md")
+
+
+@dataclass
+class BatchItem:
+    id: str
+    text: str
+
+
+def _read_jsonl(lines: Iterable[str], source: str, field: str) -> Iterator[BatchItem]:
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if isinstance(record, str):
+            yield BatchItem(f"{source}:{number}", record)
+        else:
+            yield BatchItem(str(record.get("id", f"{source}:{number}")), record[field])
+
+
+def read_items(sources: List[str], field: str = "text") -> Iterator[BatchItem]:
+    """Items from JSONL files, directories of text files, or stdin ("-").
+
+    JSONL lines are either strings or objects with the text in field and an
+    optional "id". Items without an id are named after their source and line.
+    """
+    for source in sources or ["-"]:
+        if source == "-":
+            yield from _read_jsonl(sys.stdin, "stdin", field)
+        elif os.path.isdir(source):
+            for root, _, files in sorted(os.walk(source)):
+                for name in sorted(files):
+                    if name.endswith(TEXT_EXTENSIONS):
+                        path = os.path.join(root, name)
+                        with open(path, encoding="utf-8") as f:
+                            yield BatchItem(os.path.relpath(path, source), f.read())
+        else:
+            with open(source, encoding="utf-8") as f:
+                yield from _read_jsonl(f, source, field)
+
+
+class Checkpoint:
+    """Ids of finished items, appended to a file as they complete so a rerun can skip them"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.done = {line.rstrip("\n") for line in f if line.strip()}
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self.done
+
+    def mark(self, item_id: str):
+        self.done.add(item_id)
+        self._file.write(item_id + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Throughput:
+    """Items and generated tokens per second since the batch started"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.items = 0
+        self.failed = 0
+        self.tokens = 0
+
+    def add(self, result: Dict[str, Any]):
+        self.items += 1
+        if "error" in result:
+            self.failed += 1
+        self.tokens += result.get("tokens", 0)
+
+    def report(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        return (
+            f"{self.items} items ({self.failed} failed) in {elapsed:.1f}s: "
+            f"{self.items / elapsed:.2f} items/s, {self.tokens / elapsed:.1f} tokens/s"
+        )
+
+
+# The tool of the current worker process
+_tool = None
+
+
+def _init_worker(tool_name: str, n_threads: Optional[int]):
+    global _tool
+    # Keep stdout for results, the tools print their progress
+    sys.stdout = sys.stderr
+    if n_threads:
+        os.environ["SMOL_TOOLS_N_THREADS"] = str(n_threads)
+    module, name = TOOLS[tool_name]
+    _tool = getattr(importlib.import_module(module), name)()
+
+
+def _run_item(item: BatchItem) -> Dict[str, Any]:
+    start = time.perf_counter()
+    output, tokens = "", 0
+    try:
+        for delta in _tool.stream(item.text):
+            output += delta.text
+            if delta.token_id is not None:
+                tokens += 1
+    except Exception as e:
+        return {"id": item.id, "error": f"{type(e).__name__}: {e}"}
+    return {"id": item.id, "output": output.strip(), "tokens": tokens, "seconds": time.perf_counter() - start}
+
+
+def run_batch(
+    tool_name: str,
+    items: Iterable[BatchItem],
+    workers: int = 1,
+    ordered: bool = True,
+    checkpoint: Optional[Checkpoint] = None,
+    threads_per_worker: Optional[int] = None
+) -> Generator[Dict[str, Any], None, None]:
+    """Run a tool over items in a pool of worker processes, each with its own model.
+
+    Yields one result per item, in input order if ordered, else as they
+    finish. Items already in the checkpoint are skipped, finished items are
+    added to it (failed ones are not, so a rerun retries them).
+    """
+    if tool_name not in TOOLS:
+        raise ValueError(f"Unknown tool '{tool_name}', expected one of {sorted(TOOLS)}")
+    if threads_per_worker is None and workers > 1:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    pending_items = (item for item in items if checkpoint is None or item.id not in checkpoint)
+    # Bound the items in flight so large inputs are read lazily
+    window = workers * 4
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(tool_name, threads_per_worker)
+    ) as executor:
+        def results() -> Iterator[Dict[str, Any]]:
+            if ordered:
+                queue = deque()
+                for item in pending_items:
+                    queue.append(executor.submit(_run_item, item))
+                    if len(queue) >= window:
+                        yield queue.popleft().result()
+                while queue:
+                    yield queue.popleft().result()
+            else:
+                running = set()
+                for item in pending_items:
+                    running.add(executor.submit(_run_item, item))
+                    if len(running) >= window:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield future.result()
+                for future in as_completed(running):
+                    yield future.result()
+
+        for result in results():
+            yield result
+            # Marked once the caller has handled (e.g. written) the result
+            if checkpoint is not None and "error" not in result:
+                checkpoint.mark(result["id"])
@@ -0,0 +1,73 @@
+from typing import Callable, List, Optional
+import threading
+import time
+
+from .metrics import RequestMetrics
+
+
+class RequestCancelled(Exception):
+    """Raised while a request waits for the model and its token is cancelled"""
+
+
+class CancellationToken:
+    """Stops generations from another thread, at a deadline, or after a token budget.
+
+    Pass the same token to several requests (e.g. the chunks of a long
+    summary) to give them one shared deadline and budget. A generation checks
+    its token after every sampled token and ends with the token's reason as
+    finish reason: "cancelled", "deadline" or "budget".
+
+    Completions also report their metrics to the token they ran with, so the
+    usage of a request is known whichever threads generated it.
+    """
+
+    def __init__(self, timeout: Optional[float] = None, max_tokens: Optional[int] = None):
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.max_tokens = max_tokens
+        self.tokens = 0  # Tokens generated so far by every request using this token
+        self._reason: Optional[str] = None
+        self._metrics_callbacks: List[Callable[[RequestMetrics], None]] = []
+        self._lock = threading.Lock()
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self._reason is None:
+                self._reason = reason
+
+    def add_metrics_callback(self, callback: Callable[[RequestMetrics], None]):
+        """Call callback with the RequestMetrics of every completion run with this token"""
+        with self._lock:
+            self._metrics_callbacks.append(callback)
+
+    def report(self, request_metrics: RequestMetrics):
+        with self._lock:
+            callbacks = list(self._metrics_callbacks)
+        for callback in callbacks:
+            callback(request_metrics)
+
+    def consume(self, n: int = 1) -> bool:
+        """Count n tokens about to be emitted, False if that would exceed the budget.
+
+        Requests sharing the token call this from their own threads before
+        emitting each token, so together they stop at exactly max_tokens.
+        """
+        with self._lock:
+            if self.max_tokens is not None and self.tokens + n > self.max_tokens:
+                self._reason = self._reason or "budget"
+                return False
+            self.tokens += n
+            if self.max_tokens is not None and self.tokens >= self.max_tokens:
+                self._reason = self._reason or "budget"
+            return True
+
+    @property
+    def reason(self) -> Optional[str]:
+        """Why the token is cancelled, or None if it isn't"""
+        with self._lock:
+            if self._reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+                self._reason = "deadline"
+            return self._reason
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
@@ -1,5 +1,10 @@
-from .base import SmolTool
-from typing import Generator, List, Dict
+from .base import SmolTool, CompletionDelta, PRIORITY_INTERACTIVE
+from .state_cache import save_state_file, load_state_file
+from .context import ContextWindow
+from .summarizer import SUMMARY_SYSTEM_PROMPT
+from .config import ModelConfig
+from .cancellation import CancellationToken
+from typing import Generator, Hashable, List, Dict, Optional
 from dataclasses import dataclass
 from datetime import datetime
 import json
@@ -28,13 +33,23 @@ class ChatMessage:
         )
 
 class SmolChatter(SmolTool):
-    def __init__(self):
+    # Chat turns are interactive and jump ahead of background work
+    priority = PRIORITY_INTERACTIVE
+    name = "SmolLM2-1.7B"
+    config_name = "chatter"
+    # Replies should follow the conversation, not repeat an earlier chat's answer
+    cache_responses = False
+
+    def __init__(self, context_tokens: int = 4096, config: Optional[ModelConfig] = None):
         self.chat_history: List[ChatMessage] = []
         self.chat_archive: Dict[str, List[ChatMessage]] = {}
         self.current_chat_id = None
         self.chats_dir = "saved_chats"
         self._original_chat_state = None  # To track modifications
-        self.name = "SmolLM2-1.7B"
+
+        # Prompt budget for the history, older turns are condensed into a running summary
+        self.context_tokens = context_tokens
+        self.context = self.new_context_window()
         
         # Create chats directory if it doesn't exist
         if not os.path.exists(self.chats_dir):
@@ -44,13 +59,30 @@ class SmolChatter(SmolTool):
             model_repo="andito/SmolLM2-1.7B-Instruct-F16-GGUF",
             model_filename="smollm2-1.7b-8k-dpo-f16.gguf",
             system_prompt="You are a helpful AI assistant named SmolLM, trained by Hugging Face..",
+            config=config
+        )
+
+    def new_context_window(self) -> ContextWindow:
+        """An empty context window for a chat on this model"""
+        return ContextWindow(
+            count_tokens=self._count_tokens,
+            summarize=self._summarize_turns,
+            budget_tokens=self.context_tokens,
         )
 
+    def _state_key(self, chat_id: str = None):
+        """Key of a chat's KV state in the model's state cache"""
+        return ("chat", chat_id if chat_id is not None else self.current_chat_id)
+
+    def _state_filename(self, chat_id: str) -> str:
+        return f"{self.chats_dir}/chat_{chat_id}.state"
+
     def start_new_chat(self):
         """Start a new chat with a unique ID"""
         self.current_chat_id = datetime.now().strftime("%Y%m%d_%H%M%S")
         self.chat_history = []
         self._original_chat_state = None
+        self.context.reset()
 
     def has_current_chat(self) -> bool:
         """Check if there are any messages in the current chat"""
@@ -61,17 +93,23 @@ class SmolChatter(SmolTool):
         if not self.chat_history:
             return
             
+        previous_key = self._state_key()
         if title:
             # If overwriting, use existing chat_id if it matches the title
             if not overwrite or self.current_chat_id != title:
                 self.current_chat_id = title
         elif not self.current_chat_id:
             self.current_chat_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Keep the KV state attached to the chat under its new ID
+        if previous_key != self._state_key():
+            self.states.rename(previous_key, self._state_key())
             
         # Convert chat history to serializable format
         chat_data = {
             'id': self.current_chat_id,
-            'messages': [msg.to_dict() for msg in self.chat_history]
+            'messages': [msg.to_dict() for msg in self.chat_history],
+            'summary': self.context.summary,
+            'summarized_count': self.context.summarized_count
         }
         
         # Save to file
@@ -82,6 +120,11 @@ class SmolChatter(SmolTool):
         # Update original state to reflect saved state
         self._original_chat_state = [msg.to_dict() for msg in self.chat_history]
 
+        # Save the model state next to the chat so loading it skips the prefill
+        state = self.snapshot_state(self._state_key())
+        if state is not None:
+            save_state_file(state, self._state_filename(self.current_chat_id), self.cache_key)
+
     def load_chat(self, chat_id: str):
         """Load a specific chat from disk"""
         filename = f"{self.chats_dir}/chat_{chat_id}.json"
@@ -90,10 +133,18 @@ class SmolChatter(SmolTool):
                 data = json.load(f)
                 self.current_chat_id = data['id']
                 self.chat_history = [ChatMessage.from_dict(msg) for msg in data['messages']]
+                self.context.reset(data.get('summary', ""), data.get('summarized_count', 0))
                 # Store original state for modification tracking
                 self._original_chat_state = [msg.to_dict() for msg in self.chat_history]
         except FileNotFoundError:
             print(f"Chat {chat_id} not found")
+            return
+
+        # Resume from the saved model state unless it is already cached
+        if self._state_key() not in self.states:
+            state = load_state_file(self._state_filename(self.current_chat_id), self.cache_key, self.model.n_ctx())
+            if state is not None:
+                self.states.put(self._state_key(), state)
 
     def is_chat_modified(self) -> bool:
         """Check if the current chat has been modified since loading"""
@@ -113,42 +164,69 @@ class SmolChatter(SmolTool):
                 chats.append(chat_id)
         return sorted(chats, reverse=True)  # Most recent first
 
-    def _warm_up(self):
-        super()._warm_up()
-        self.clear_chat_history()
+    def _warm_up(self, strategy: Optional[str] = None):
+        super()._warm_up(strategy)
+        # Only a full warm-up adds a test exchange to the chat
+        if (strategy or self.config.warm_up) == "full":
+            self.clear_chat_history()
 
-    def process(self, text: str) -> Generator[str, None, None]:
+    def stream(self, text: str, cancel: Optional[CancellationToken] = None) -> Generator[CompletionDelta, None, None]:
+        yield from self.stream_reply(self.chat_history, self.context, self._state_key(), text, cancel)
+
+    def stream_reply(
+        self,
+        chat_history: List[ChatMessage],
+        context: ContextWindow,
+        state_key: Hashable,
+        text: str,
+        cancel: Optional[CancellationToken] = None
+    ) -> Generator[CompletionDelta, None, None]:
+        """Reply to text in any chat on this model, given its history, context window and KV state key"""
         # Add user message to history
-        self.chat_history.append(ChatMessage(
+        chat_history.append(ChatMessage(
             role="user",
             content=text,
             timestamp=datetime.now()
         ))
         
-        # Build messages including chat history
-        messages = [{"role": "system", "content": self.system_prompt}]
-        # Include last 5 messages for context
-        for msg in self.chat_history:
-            messages.append({"role": msg.role, "content": msg.content})
+        # Build messages from the recent history that fits the token budget
+        history = [{"role": msg.role, "content": msg.content} for msg in chat_history]
+        messages = context.build(self.system_prompt, history)
 
         # Generate response
         response = ""
-        for chunk in self._create_chat_completion(messages, max_tokens=1024):
-            response = chunk
-            yield chunk
+        for delta in self._stream_chat_completion(messages, max_tokens=1024, state_key=state_key, cancel=cancel):
+            response += delta.text
+            yield delta
         
         # Add assistant's response to history
-        self.chat_history.append(ChatMessage(
+        chat_history.append(ChatMessage(
             role="assistant",
             content=response,
             timestamp=datetime.now()
         ))
 
+    def _summarize_turns(self, summary: str, turns: List[Dict[str, str]]) -> str:
+        """Fold turns that left the context window into the running summary"""
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+        if summary:
+            transcript = f"Summary of the conversation so far:\n{summary}\n\nContinuation of the conversation:\n{transcript}"
+        messages = [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": transcript},
+            {"role": "assistant", "content": "This is a short summary of the text:"}
+        ]
+        return "".join(
+            delta.text for delta in self._stream_chat_completion(messages, max_tokens=256, temperature=0.1, top_p=0.9)
+        ).strip()
+
     def get_chat_history(self) -> List[ChatMessage]:
         return self.chat_history
     
     def clear_chat_history(self):
         self.chat_history = []
+        self.context.reset()
+        self.states.pop(self._state_key())
 
     def get_current_chat_id(self) -> str:
         """Get the ID of the current chat"""
@@ -0,0 +1,116 @@
+from dataclasses import dataclass, fields, replace, astuple
+from typing import Any, Dict, Optional, Tuple
+import json
+import os
+
+DEFAULT_MODEL_REPO = "andito/SmolLM2-1.7B-Instruct-F16-GGUF"
+DEFAULT_MODEL_FILENAME = "smollm2-1.7b-8k-dpo-f16.gguf"
+# Quantized builds of SmolLM2-1.7B-Instruct, selected with `quantization`
+QUANTIZED_MODEL_REPO = "bartowski/SmolLM2-1.7B-Instruct-GGUF"
+
+# Path of the JSON config file, see README for the layout
+CONFIG_ENV = "SMOL_TOOLS_CONFIG"
+DEFAULT_CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".config", "smol_tools", "config.json")
+# Prefix of environment overrides, e.g. SMOL_TOOLS_N_THREADS or SMOL_TOOLS_TITLER_QUANTIZATION
+ENV_PREFIX = "SMOL_TOOLS_"
+
+
+@dataclass(frozen=True)
+class ModelConfig:
+    """How to load the model behind a tool"""
+    model_repo: str = DEFAULT_MODEL_REPO
+    model_filename: str = DEFAULT_MODEL_FILENAME
+    quantization: Optional[str] = None  # e.g. "Q4_K_M" or "Q8_0", overrides model_repo/model_filename
+    quantized_repo: str = QUANTIZED_MODEL_REPO
+    n_ctx: int = 8192
+    n_threads: Optional[int] = None  # None lets llama.cpp decide
+    n_batch: int = 512
+    use_mmap: bool = True
+    use_mlock: bool = False
+    flash_attn: bool = False
+    backend: str = "llama_cpp"  # "stub" runs a deterministic fake model, see stub.py
+    draft_tokens: int = 0  # Tokens drafted by prompt-lookup speculative decoding, 0 turns it off
+    draft_ngram: int = 2  # Longest n-gram looked up in the context to find a draft
+    warm_up: str = "prefix"  # "none", "pagein", "token", "prefix" or "full", see SmolTool._warm_up
+    warm_up_background: bool = False  # Warm up on a thread, the tool is usable right after loading
+
+    def model_file(self) -> Tuple[str, str]:
+        """Repo and filename (or glob) of the GGUF file to load"""
+        if self.quantization:
+            return self.quantized_repo, f"*{self.quantization.upper()}.gguf"
+        return self.model_repo, self.model_filename
+
+    def llama_kwargs(self) -> Dict[str, Any]:
+        """Arguments for Llama.from_pretrained"""
+        repo, filename = self.model_file()
+        return {
+            "repo_id": repo,
+            "filename": filename,
+            "n_ctx": self.n_ctx,
+            "n_threads": self.n_threads,
+            "n_batch": self.n_batch,
+            "use_mmap": self.use_mmap,
+            "use_mlock": self.use_mlock,
+            "flash_attn": self.flash_attn,
+            "verbose": False,
+        }
+
+    def cache_key(self) -> Tuple:
+        """Tools whose configs have the same key share one loaded model"""
+        # Warm-up is per tool, tools warming up differently still share the model
+        return astuple(replace(
+            self,
+            quantized_repo=self.quantized_repo if self.quantization else "",
+            warm_up="",
+            warm_up_background=False
+        ))
+
+    @property
+    def label(self) -> str:
+        return self.model_file()[1]
+
+
+def _parse(value: str, default: Any) -> Any:
+    """Convert an environment variable to the type of a field's default"""
+    if value.lower() in ("", "none", "null"):
+        return None
+    if isinstance(default, bool):
+        return value.lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int) or default is None and value.lstrip("-").isdigit():
+        return int(value)
+    return value
+
+
+def _read_config_file() -> Dict[str, Dict[str, Any]]:
+    path = os.environ.get(CONFIG_ENV, DEFAULT_CONFIG_PATH)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_config(tool: str, base: Optional[ModelConfig] = None) -> ModelConfig:
+    """Config of one tool.
+
+    Later sources win: the tool's built-in defaults (base), the "default" and
+    then the tool's section of the config file, then SMOL_TOOLS_<FIELD> and
+    SMOL_TOOLS_<TOOL>_<FIELD> environment variables.
+    """
+    config = base or ModelConfig()
+    data = _read_config_file()
+    valid = {f.name for f in fields(ModelConfig)}
+    for section in ("default", tool):
+        overrides = data.get(section, {})
+        unknown = set(overrides) - valid
+        if unknown:
+            raise ValueError(f"Unknown model config keys in section '{section}': {sorted(unknown)}")
+        config = replace(config, **overrides)
+
+    for prefix in (ENV_PREFIX, f"{ENV_PREFIX}{tool.upper()}_"):
+        overrides = {}
+        for f in fields(ModelConfig):
+            value = os.environ.get(f"{prefix}{f.name.upper()}")
+            if value is not None:
+                overrides[f.name] = _parse(value, getattr(config, f.name))
+        config = replace(config, **overrides)
+    return config
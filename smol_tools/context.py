@@ -0,0 +1,70 @@
+from typing import Callable, Dict, List, Optional
+
+# Rough cost of the chat template markers around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class ContextWindow:
+    """Keeps a chat's prompt within a token budget.
+
+    Recent messages are sent verbatim. When they no longer fit, the oldest
+    turns are folded into a running summary, which is updated incrementally
+    from the previous summary and the newly dropped turns. Compaction shrinks
+    the verbatim part down to low_water of the budget, so the prompt prefix
+    (and with it the reusable KV cache) stays stable for several turns.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        summarize: Callable[[str, List[Dict[str, str]]], str],
+        budget_tokens: int = 4096,
+        low_water: float = 0.6,
+    ):
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.low_water = low_water
+        self.summary = ""
+        self.summarized_count = 0  # Number of leading history messages folded into the summary
+        self._token_counts: Dict[str, int] = {}
+
+    def reset(self, summary: str = "", summarized_count: int = 0):
+        self.summary = summary
+        self.summarized_count = summarized_count
+
+    def _message_tokens(self, message: Dict[str, str]) -> int:
+        content = message["content"]
+        if content not in self._token_counts:
+            self._token_counts[content] = self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        return self._token_counts[content]
+
+    def _summary_message(self) -> Optional[Dict[str, str]]:
+        if not self.summary:
+            return None
+        return {"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"}
+
+    def _prompt_tokens(self, system: Dict[str, str], messages: List[Dict[str, str]]) -> int:
+        head = [system] + ([self._summary_message()] if self.summary else [])
+        return sum(self._message_tokens(m) for m in head + messages)
+
+    def build(self, system_prompt: str, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Messages to send for history, compacting older turns if the budget is exceeded"""
+        system = {"role": "system", "content": system_prompt}
+        recent = history[self.summarized_count:]
+
+        if self._prompt_tokens(system, recent) > self.budget_tokens:
+            target = self.budget_tokens * self.low_water
+            # Always keep the newest message verbatim, drop whole turns from the front
+            cut = 0
+            while cut < len(recent) - 1 and self._prompt_tokens(system, recent[cut:]) > target:
+                cut += 1
+            while cut < len(recent) - 1 and recent[cut]["role"] != "user":
+                cut += 1
+            if cut > 0:
+                self.summary = self.summarize(self.summary, recent[:cut])
+                self.summarized_count += cut
+                recent = recent[cut:]
+
+        summary = self._summary_message()
+        return [system] + ([summary] if summary else []) + recent
@@ -0,0 +1,129 @@
+from typing import Any, Dict, List
+import json
+import re
+
+# JSON values in GBNF, after llama.cpp's grammars/json.gbnf
+JSON_RULES = r'''
+value ::= object | array | string | number | boolean | null
+object ::= "{" ws ( string ws ":" ws value ( ws "," ws string ws ":" ws value )* )? ws "}"
+array ::= "[" ws ( value ( ws "," ws value )* )? ws "]"
+string ::= "\"" ( [^"\\\x7F\x00-\x1F] | "\\" ( ["\\/bfnrt] | "u" [0-9a-fA-F]{4} ) )* "\""
+integer ::= "-"? ( "0" | [1-9] [0-9]{0,15} )
+number ::= integer ( "." [0-9]+ )? ( [eE] [-+]? [0-9]+ )?
+boolean ::= "true" | "false"
+null ::= "null"
+ws ::= | " " | "\n" [ \t]{0,20}
+'''
+
+# Rule for each tool input type, other types take any JSON value
+INPUT_RULES = {
+    "string": "string",
+    "integer": "integer",
+    "number": "number",
+    "boolean": "boolean",
+    "object": "object",
+    "array": "array",
+}
+
+
+def _literal(text: str) -> str:
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+def _rule_name(name: str) -> str:
+    return "call-" + re.sub(r"[^a-zA-Z0-9]+", "-", name).strip("-").lower()
+
+
+def _call_rule(name: str, inputs: Dict[str, Dict[str, Any]]) -> str:
+    """A call of one tool, with every input in declaration order"""
+    arguments = []
+    for input_name, spec in inputs.items():
+        rule = INPUT_RULES.get(spec.get("type"), "value")
+        if spec.get("nullable"):
+            rule = f"( {rule} | null )"
+        arguments.append(f'{_literal(json.dumps(input_name))} ws ":" ws {rule}')
+    body = ' ws "," ws '.join(arguments)
+    return (
+        f'"{{" ws {_literal(json.dumps("name"))} ws ":" ws {_literal(json.dumps(name))} ws "," ws '
+        f'{_literal(json.dumps("arguments"))} ws ":" ws "{{" ws {body + " ws " if body else ""}"}}" ws "}}"'
+    )
+
+
+def tool_call_grammar(tools: List[Any]) -> str:
+    """GBNF for a <tool_call>[...]</tool_call> list of calls to the given tools.
+
+    Tools are transformers @tool objects, only their name and inputs are used.
+    Generation under the grammar can only produce a well-formed call list and
+    ends as soon as the list is closed.
+    """
+    names = [_rule_name(tool.name) for tool in tools]
+    lines = [
+        'root ::= "<tool_call>" ws "[" ws ( call ( ws "," ws call )* )? ws "]" ws "</tool_call>"'
+        if tools else 'root ::= "<tool_call>" ws "[" ws "]" ws "</tool_call>"'
+    ]
+    if tools:
+        lines.append("call ::= " + " | ".join(names))
+    for name, tool in zip(names, tools):
+        lines.append(f"{name} ::= {_call_rule(tool.name, tool.inputs)}")
+    return "\n".join(lines) + "\n" + JSON_RULES.lstrip()
+
+
+class ToolCallParser:
+    """Incremental parser of a <tool_call>[...]</tool_call> list.
+
+    feed() takes the generated text piece by piece and returns each call
+    object as soon as its closing brace arrives, so it can run while the rest
+    of the list is still being generated. Objects that aren't valid JSON are
+    kept in errors.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.started = False
+        self.closed = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.start = 0
+        self.errors: List[str] = []
+
+    def feed(self, text: str) -> List[Any]:
+        self.buffer += text
+        calls = []
+        if not self.started:
+            tag = self.buffer.find("<tool_call>")
+            bracket = self.buffer.find("[", tag) if tag >= 0 else -1
+            if bracket < 0:
+                return calls
+            self.started = True
+            self.pos = bracket + 1
+        while self.pos < len(self.buffer) and not self.closed:
+            char = self.buffer[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                if self.depth == 0:
+                    self.start = self.pos
+                self.depth += 1
+            elif char in "}]":
+                if self.depth == 0:
+                    # Only "]" can close the list, a stray "}" is skipped
+                    self.closed = char == "]"
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        raw = self.buffer[self.start:self.pos + 1]
+                        try:
+                            calls.append(json.loads(raw))
+                        except ValueError:
+                            self.errors.append(raw)
+            self.pos += 1
+        return calls
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Seconds a response is reused, e.g. SMOL_TOOLS_HTTP_CACHE_TTL=0 to always fetch
+CACHE_TTL_ENV = "SMOL_TOOLS_HTTP_CACHE_TTL"
+DEFAULT_CACHE_TTL = 600.0
+
+
+class HTTPClient:
+    """Shared HTTP client for the agent's network tools.
+
+    One requests session keeps connections alive between calls, requests time
+    out instead of hanging, transient failures are retried with exponential
+    backoff, and successful GET responses are cached for ttl seconds.
+    """
+
+    def __init__(
+        self,
+        timeout: Tuple[float, float] = (3.0, 5.0),  # Connect and read timeouts
+        retries: int = 2,
+        backoff: float = 0.25,
+        pool_size: int = 8,
+        ttl: Optional[float] = None,
+        max_entries: int = 256
+    ):
+        self.timeout = timeout
+        self.ttl = float(os.environ.get(CACHE_TTL_ENV, DEFAULT_CACHE_TTL)) if ttl is None else ttl
+        self.max_entries = max_entries
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._cache: "OrderedDict[Tuple, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_text(self, url: str, params: Optional[Dict[str, Any]] = None, ttl: Optional[float] = None) -> str:
+        """The body of a GET request, from the cache if it was fetched less than ttl seconds ago"""
+        ttl = self.ttl if ttl is None else ttl
+        key = (url, tuple(sorted((params or {}).items())))
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > now:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        text = response.text
+        if ttl > 0:
+            with self._lock:
+                self._cache[key] = (time.monotonic() + ttl, text)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return text
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+# Shared by every tool in the process
+http_client = HTTPClient()
@@ -0,0 +1,183 @@
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import bisect
+import threading
+
+# Histogram buckets, in seconds for times and tokens/s for decode speed
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SPEED_BUCKETS = (1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0, 320.0)
+
+
+@dataclass
+class RequestMetrics:
+    """What one completion cost and where the time went"""
+    tool: str
+    model: str
+    prompt_tokens: int = 0
+    cached_prompt_tokens: int = 0  # Prompt tokens whose KV was reused instead of evaluated
+    completion_tokens: int = 0
+    queue_wait: float = 0.0  # Seconds waiting for the model
+    prefill_seconds: float = 0.0  # From the start of decoding to the first sampled token
+    ttft: float = 0.0  # From the request to the first sampled token
+    decode_seconds: float = 0.0  # After the first token
+    total_seconds: float = 0.0
+    finish_reason: Optional[str] = None  # "stop", "length", "cancelled", "deadline" or "budget"
+    cache_hit: bool = False
+    draft_tokens: int = 0  # Tokens drafted by speculative decoding and checked by the model
+    accepted_draft_tokens: int = 0
+
+    @property
+    def tokens_per_second(self) -> float:
+        if self.completion_tokens < 2 or self.decode_seconds <= 0:
+            return 0.0
+        return (self.completion_tokens - 1) / self.decode_seconds
+
+    @property
+    def draft_acceptance(self) -> float:
+        return self.accepted_draft_tokens / self.draft_tokens if self.draft_tokens else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(asdict(self), tokens_per_second=self.tokens_per_second, draft_acceptance=self.draft_acceptance)
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels: Any) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class MetricsRegistry:
+    """Collects the metrics of every completion, for callbacks and Prometheus"""
+
+    COUNTERS = {
+        "prompt_tokens": "Prompt tokens of completions",
+        "cached_prompt_tokens": "Prompt tokens served from a reused KV cache",
+        "completion_tokens": "Generated tokens",
+        "draft_tokens": "Tokens drafted by speculative decoding",
+        "accepted_draft_tokens": "Drafted tokens the model accepted",
+    }
+    HISTOGRAMS = {
+        "queue_wait": ("queue_wait_seconds", TIME_BUCKETS, "Time waiting for the shared model"),
+        "prefill_seconds": ("prefill_seconds", TIME_BUCKETS, "Time from the start of decoding to the first token"),
+        "ttft": ("time_to_first_token_seconds", TIME_BUCKETS, "Time from the request to the first token"),
+        "total_seconds": ("request_seconds", TIME_BUCKETS, "Total time of completions"),
+        "tokens_per_second": ("decode_tokens_per_second", SPEED_BUCKETS, "Decode speed after the first token"),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[RequestMetrics], None]] = []
+        self._requests: Dict[Tuple[str, str, str], int] = {}
+        self._cache_hits: Dict[Tuple[str, str], int] = {}
+        self._counters: Dict[str, Dict[Tuple[str, str], int]] = {name: {} for name in self.COUNTERS}
+        self._histograms: Dict[str, Dict[Tuple[str, str], _Histogram]] = {name: {} for name in self.HISTOGRAMS}
+
+    def add_callback(self, callback: Callable[[RequestMetrics], None]):
+        """Call callback with the RequestMetrics of every completion"""
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback: Callable[[RequestMetrics], None]):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def record(self, metrics: RequestMetrics):
+        labels = (metrics.tool, metrics.model)
+        with self._lock:
+            key = labels + (metrics.finish_reason or "unknown",)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if metrics.cache_hit:
+                self._cache_hits[labels] = self._cache_hits.get(labels, 0) + 1
+            for name, values in self._counters.items():
+                values[labels] = values.get(labels, 0) + getattr(metrics, name)
+            # Cache hits didn't run the model, their timings would skew the histograms
+            if not metrics.cache_hit:
+                for name, values in self._histograms.items():
+                    if name == "tokens_per_second" and metrics.completion_tokens < 2:
+                        continue
+                    if labels not in values:
+                        values[labels] = _Histogram(self.HISTOGRAMS[name][1])
+                    values[labels].observe(getattr(metrics, name))
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(metrics)
+            except Exception as e:
+                print(f"Metrics callback {callback!r} failed: {e}")
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            lines += [
+                "# HELP smol_tools_requests_total Completions by finish reason",
+                "# TYPE smol_tools_requests_total counter",
+            ]
+            for (tool, model, reason), value in sorted(self._requests.items()):
+                lines.append(f"smol_tools_requests_total{_labels(tool=tool, model=model, finish_reason=reason)} {value}")
+            lines += [
+                "# HELP smol_tools_cache_hits_total Completions replayed from the response cache",
+                "# TYPE smol_tools_cache_hits_total counter",
+            ]
+            for (tool, model), value in sorted(self._cache_hits.items()):
+                lines.append(f"smol_tools_cache_hits_total{_labels(tool=tool, model=model)} {value}")
+            for name, help_text in self.COUNTERS.items():
+                lines += [f"# HELP smol_tools_{name}_total {help_text}", f"# TYPE smol_tools_{name}_total counter"]
+                for (tool, model), value in sorted(self._counters[name].items()):
+                    lines.append(f"smol_tools_{name}_total{_labels(tool=tool, model=model)} {value}")
+            for name, (metric, buckets, help_text) in self.HISTOGRAMS.items():
+                lines += [f"# HELP smol_tools_{metric} {help_text}", f"# TYPE smol_tools_{metric} histogram"]
+                for (tool, model), histogram in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"smol_tools_{metric}_bucket{_labels(tool=tool, model=model, le=bound)} {cumulative}")
+                    lines.append(f"smol_tools_{metric}_sum{_labels(tool=tool, model=model)} {histogram.sum}")
+                    lines.append(f"smol_tools_{metric}_count{_labels(tool=tool, model=model)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+# Shared by every tool in the process
+metrics = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the console
+        pass
+
+
+def start_metrics_server(port: int = 9464, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve /metrics in a background thread, call shutdown() on the result to stop it"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="smol-tools-metrics", daemon=True).start()
+    print(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
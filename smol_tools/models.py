@@ -0,0 +1,242 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, List, Optional
+import os
+import threading
+import time
+from .backend import Llama, load_model
+from .config import ModelConfig
+from .startup import startup_timings
+
+# Memory budget for loaded models, in bytes with an optional K/M/G suffix
+BUDGET_ENV = "SMOL_TOOLS_MODEL_MEMORY"
+# Share of physical memory models may use when no budget is set
+DEFAULT_BUDGET_FRACTION = 0.75
+
+
+def estimate_nbytes(model: Llama) -> int:
+    """Approximate memory of a loaded model: its weights plus a full F16 KV cache"""
+    try:
+        weights = os.path.getsize(model.model_path)
+    except OSError:
+        weights = 0
+    return weights + kv_cache_nbytes(model)
+
+
+def kv_cache_nbytes(model: Llama) -> int:
+    """Approximate memory of a context's full F16 KV cache, what an extra context of mmap'd weights costs"""
+    metadata = model.metadata
+    arch = metadata.get("general.architecture", "llama")
+    try:
+        n_layer = int(metadata[f"{arch}.block_count"])
+        n_head = int(metadata[f"{arch}.attention.head_count"])
+        n_head_kv = int(metadata.get(f"{arch}.attention.head_count_kv", n_head))
+        n_embd_kv = model.n_embd() // n_head * n_head_kv
+        return 2 * n_layer * model.n_ctx() * n_embd_kv * 2
+    except (KeyError, ValueError, ZeroDivisionError):
+        return 0
+
+
+def _parse_bytes(value: str) -> int:
+    value = value.strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def default_budget() -> Optional[int]:
+    """Budget from SMOL_TOOLS_MODEL_MEMORY, else a share of physical memory, else unlimited"""
+    value = os.environ.get(BUDGET_ENV)
+    if value:
+        return _parse_bytes(value)
+    try:
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * DEFAULT_BUDGET_FRACTION)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+@dataclass
+class _Entry:
+    config: ModelConfig
+    model: Optional[Llama] = None
+    nbytes: int = 0  # Estimate from the last load, 0 until the first one
+    refs: int = 0  # Active leases, a model with leases is never unloaded
+    last_used: float = 0.0
+    loads: int = 0
+    load_lock: threading.Lock = field(default_factory=threading.Lock)
+    on_unload: List[Callable[[Llama], None]] = field(default_factory=list)
+    # Memory held beside the model that goes away with it, e.g. saved states and extra contexts
+    memory_sources: List[Callable[[], int]] = field(default_factory=list)
+
+    def resident_nbytes(self) -> int:
+        if self.model is None:
+            return 0
+        return self.nbytes + sum(source() for source in self.memory_sources)
+
+
+class ModelManager:
+    """Loads models on demand and keeps their total size within a memory budget.
+
+    Requests lease a model for as long as they use it. When a load would
+    exceed the budget, idle models (no leases) are unloaded, least recently
+    used first, and loaded again the next time they are needed. Models in use
+    are never unloaded, so the budget can be exceeded while they all are busy.
+    Memory sources registered with a model (saved states, extra contexts)
+    count towards its size and are expected to be freed by its unload callbacks.
+    """
+
+    def __init__(self, budget_bytes: Optional[int] = None):
+        self.budget_bytes = budget_bytes
+        self._entries: Dict[Hashable, _Entry] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def register(self, key: Hashable, config: ModelConfig, on_unload: Optional[Callable[[Llama], None]] = None) -> bool:
+        """Make a model known without loading it, returns True if it is new.
+
+        on_unload is called with the model before it is freed, only the first
+        registration of a key sets it.
+        """
+        with self._lock:
+            if key in self._entries:
+                return False
+            self._entries[key] = _Entry(config, on_unload=[on_unload] if on_unload else [])
+            return True
+
+    def add_unload_callback(self, key: Hashable, callback: Callable[[Llama], None]):
+        """Also call callback with the model for key before it is freed"""
+        with self._lock:
+            self._entries[key].on_unload.append(callback)
+
+    def add_memory_source(self, key: Hashable, nbytes: Callable[[], int]):
+        """Count nbytes() towards the size of the model for key while it is loaded"""
+        with self._lock:
+            self._entries[key].memory_sources.append(nbytes)
+
+    def get(self, key: Hashable) -> Llama:
+        """The model for key, loading it if it isn't resident"""
+        with self._lock:
+            entry = self._entries[key]
+            entry.last_used = time.monotonic()
+            model = entry.model
+        if model is not None:
+            return model
+        return self._load(key, entry)
+
+    @contextmanager
+    def lease(self, key: Hashable):
+        """Keep the model for key loaded until the block exits"""
+        with self._lock:
+            self._entries[key].refs += 1
+        try:
+            yield self.get(key)
+        finally:
+            with self._lock:
+                entry = self._entries[key]
+                entry.refs -= 1
+                entry.last_used = time.monotonic()
+
+    def _load(self, key: Hashable, entry: _Entry) -> Llama:
+        with entry.load_lock:
+            if entry.model is not None:
+                return entry.model
+            # Make room using the size from the previous load, if there was one
+            self._evict(entry.nbytes, keep=key)
+            repo, filename = entry.config.model_file()
+            print(f"Loading model {filename} from {repo}...")
+            phase = "model load" if entry.loads == 0 else "model reload"
+            with startup_timings.phase(f"{phase} {entry.config.label}"):
+                model = load_model(entry.config)
+            with self._lock:
+                entry.model = model
+                entry.nbytes = estimate_nbytes(model)
+                entry.loads += 1
+                entry.last_used = time.monotonic()
+            self._evict(0, keep=key)
+            return model
+
+    def _evict(self, incoming: int, keep: Hashable):
+        """Unload idle models, least recently used first, until incoming more bytes fit the budget"""
+        if self.budget_bytes is None:
+            return
+        while True:
+            with self._lock:
+                resident = [(k, e) for k, e in self._entries.items() if e.model is not None]
+                if sum(e.resident_nbytes() for _, e in resident) + incoming <= self.budget_bytes:
+                    return
+                idle = sorted(
+                    (k for k, e in resident if k != keep and e.refs == 0),
+                    key=lambda k: self._entries[k].last_used
+                )
+            # A model that is being loaded or unloaded elsewhere is skipped
+            if not any(self._unload(k, blocking=False) for k in idle):
+                print("Warning: loaded models exceed the memory budget but all of them are in use")
+                return
+
+    def unload(self, key: Hashable) -> bool:
+        """Free the model for key, returns False if it wasn't loaded.
+
+        It is loaded again the next time it is used. Raises RuntimeError if
+        the model is in use.
+        """
+        return self._unload(key, blocking=True)
+
+    def _unload(self, key: Hashable, blocking: bool) -> bool:
+        entry = self._entries[key]
+        # Holding the load lock makes requests for this model wait until the callbacks are done
+        if not entry.load_lock.acquire(blocking=blocking):
+            return False
+        try:
+            with self._lock:
+                if entry.refs > 0:
+                    if not blocking:
+                        return False
+                    raise RuntimeError(f"Model {entry.config.label} is in use")
+                model, entry.model = entry.model, None
+            if model is None:
+                return False
+            print(f"Unloading model {entry.config.label}")
+            for callback in entry.on_unload:
+                callback(model)
+            # The memory is freed when the last reference goes away, so a thread
+            # still tokenizing with it is not left with a dangling context
+            del model
+            return True
+        finally:
+            entry.load_lock.release()
+
+    def unload_idle(self) -> int:
+        """Free every model that isn't in use, returns how many were unloaded"""
+        with self._lock:
+            idle = [k for k, e in self._entries.items() if e.model is not None and e.refs == 0]
+        return sum(self.unload(key) for key in idle)
+
+    def stats(self) -> Dict[str, Any]:
+        """Budget, resident bytes and the state of every known model"""
+        with self._lock:
+            now = time.monotonic()
+            models = [
+                {
+                    "model": e.config.label,
+                    "resident": e.model is not None,
+                    "nbytes": e.nbytes,
+                    "extra_nbytes": e.resident_nbytes() - e.nbytes if e.model is not None else 0,
+                    "refs": e.refs,
+                    "idle": now - e.last_used if e.last_used else None,
+                    "loads": e.loads,
+                }
+                for e in self._entries.values()
+            ]
+        return {
+            "budget_bytes": self.budget_bytes,
+            "resident_bytes": sum(m["nbytes"] + m["extra_nbytes"] for m in models if m["resident"]),
+            "models": models,
+        }
+
+
+# Shared by every tool in the process
+model_manager = ModelManager(default_budget())
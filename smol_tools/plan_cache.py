@@ -0,0 +1,294 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import copy
+import re
+import threading
+import numpy as np
+
+NUMBER = r"-?\d+(?:\.\d+)?"
+# Slot captures by argument type
+SLOT_PATTERNS = {"int": r"(-?\d+)", "float": r"(" + NUMBER + r")", "str": r"(.+?)"}
+# A text slot holding one of these swallowed another request, e.g. "paris and what time is it"
+CLAUSE_JOINERS = re.compile(r"(?:^|\s)(?:and|then|also|or|plus)(?:\s|$)|[,;?!]")
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split()).strip(" ?!.")
+
+
+def _strip_query(query: str) -> str:
+    """normalize_query without lowercasing, slot values keep their case"""
+    return " ".join(query.split()).strip(" ?!.")
+
+
+def _mask_numbers(text: str) -> str:
+    return re.sub(NUMBER, "#", text)
+
+
+def _slot_type(value: Any) -> Optional[str]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str) and value.strip():
+        return "str"
+    return None
+
+
+@dataclass
+class PlanEntry:
+    """Tool calls for one query shape, with the arguments taken from the query as numbered slots"""
+    template: str  # Normalized query with "{0}", "{1}"... in place of the slot values
+    pattern: "re.Pattern"
+    calls: List[Dict[str, Any]]  # Slotted arguments are {"$slot": index}
+    slot_types: List[str]
+    masked: str  # Normalized query with its numbers masked, for embedding
+    query: str = ""  # Normalized query the plan was made for
+    embedding: Optional[np.ndarray] = None
+    hits: int = 0
+
+    @property
+    def semantic(self) -> bool:
+        """Only numeric slots can be re-extracted from a query that doesn't match the template"""
+        return all(t != "str" for t in self.slot_types)
+
+    def fill(self, values: List[str]) -> List[Dict[str, Any]]:
+        converted = []
+        for value, slot_type in zip(values, self.slot_types):
+            converted.append(int(value) if slot_type == "int" else float(value) if slot_type == "float" else value)
+
+        def substitute(node):
+            if isinstance(node, dict):
+                if set(node) == {"$slot"}:
+                    return converted[node["$slot"]]
+                return {k: substitute(v) for k, v in node.items()}
+            if isinstance(node, list):
+                return [substitute(v) for v in node]
+            return node
+
+        return substitute(self.calls)
+
+
+@dataclass
+class PlanCacheStats:
+    lookups: int = 0
+    exact: int = 0
+    template: int = 0
+    semantic: int = 0
+    stores: int = 0
+    evictions: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.exact + self.template + self.semantic
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+
+class PlanCache:
+    """Past queries and the tool calls the agent planned for them, reused without the LLM.
+
+    A query is looked up by exact match, then by template match, where the
+    argument values found in a stored query are slots re-extracted from the new
+    one ("random number between 5 and 50" reuses the plan for "... 1 and 10"),
+    and finally by embedding similarity above min_similarity. Similarity hits
+    are limited to plans whose arguments are all numbers from the query (or
+    that take none), since other values can't be re-extracted safely. Entries
+    are evicted least recently used first.
+
+    Text slots that look like they took in more than one request are not
+    filled, and plans calling a tool in side_effect_tools are only replayed
+    for the exact query they were planned for.
+    """
+
+    def __init__(
+        self,
+        embed: Optional[Callable[[List[str]], List[List[float]]]] = None,
+        max_entries: int = 256,
+        min_similarity: float = 0.92,
+        max_slot_chars: int = 64,
+        side_effect_tools: Iterable[str] = ()
+    ):
+        self.embed = embed
+        self.side_effect_tools = set(side_effect_tools)
+        self.max_entries = max_entries
+        self.min_similarity = min_similarity
+        self.max_slot_chars = max_slot_chars
+        self._entries: "OrderedDict[str, PlanEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = PlanCacheStats()
+
+    def _embedding(self, text: str) -> Optional[np.ndarray]:
+        if self.embed is None:
+            return None
+        try:
+            vector = np.asarray(self.embed([text])[0], dtype=np.float32)
+        except Exception as e:
+            print(f"Plan cache embedding failed: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def _side_effects(self, entry: PlanEntry) -> bool:
+        return any(call.get("name") in self.side_effect_tools for call in entry.calls)
+
+    def lookup(self, query: str) -> Optional[Tuple[List[Dict[str, Any]], str, float]]:
+        """The cached tool calls for query, how they were found and the confidence, or None"""
+        normalized = normalize_query(query)
+        cased = _strip_query(query)
+        if len(cased) != len(normalized):
+            # Lowercasing changed the length, positions don't carry over
+            cased = normalized
+        with self._lock:
+            self.counters.lookups += 1
+            for template, entry in reversed(self._entries.items()):
+                match = entry.pattern.fullmatch(normalized)
+                if match is None:
+                    continue
+                values = [cased[match.start(i):match.end(i)] for i in range(1, len(entry.slot_types) + 1)]
+                if any(len(value) > self.max_slot_chars for value in values):
+                    continue
+                if any(t == "str" and CLAUSE_JOINERS.search(v) for t, v in zip(entry.slot_types, values)):
+                    continue
+                exact = normalized == entry.query
+                if not exact and self._side_effects(entry):
+                    continue
+                kind = "exact" if exact else "template"
+                setattr(self.counters, kind, getattr(self.counters, kind) + 1)
+                entry.hits += 1
+                self._entries.move_to_end(template)
+                return entry.fill(values), kind, 1.0
+            candidates = [
+                entry for entry in self._entries.values()
+                if entry.semantic and entry.embedding is not None and not self._side_effects(entry)
+            ]
+
+        if not candidates:
+            return None
+        # Embedding runs outside the lock, it can take a while on a cold context
+        masked = _mask_numbers(normalized)
+        vector = self._embedding(masked)
+        if vector is None:
+            return None
+        numbers = re.findall(NUMBER, normalized)
+        best, best_score = None, self.min_similarity
+        for entry in candidates:
+            if len(entry.slot_types) != len(numbers) or any(
+                not re.fullmatch(SLOT_PATTERNS[t], n) for t, n in zip(entry.slot_types, numbers)
+            ):
+                continue
+            score = float(np.dot(entry.embedding, vector))
+            if score >= best_score:
+                best, best_score = entry, score
+        if best is None:
+            return None
+        with self._lock:
+            self.counters.semantic += 1
+            best.hits += 1
+            if best.template in self._entries:
+                self._entries.move_to_end(best.template)
+        return best.fill(numbers), "semantic", best_score
+
+    def store(self, query: str, tool_calls: List[Dict[str, Any]]):
+        """Remember the tool calls planned for query"""
+        normalized = normalize_query(query)
+        spans: List[Tuple[int, int]] = []
+        slot_types: List[str] = []
+        slots: Dict[Any, int] = {}
+
+        def find(value: Any, slot_type: str) -> Optional[int]:
+            # A value used by several arguments is one slot
+            if (slot_type, value) in slots:
+                return slots[(slot_type, value)]
+            if slot_type == "str":
+                needle = re.escape(" ".join(value.lower().split()))
+                regex = r"(?<!\w)" + needle + r"(?!\w)"
+            else:
+                regex = r"(?<![\d.-])" + re.escape(str(value)) + r"(?![\d.])"
+            for match in re.finditer(regex, normalized):
+                if all(match.end() <= start or match.start() >= end for start, end in spans):
+                    spans.append(match.span())
+                    slot_types.append(slot_type)
+                    slots[(slot_type, value)] = len(spans) - 1
+                    return len(spans) - 1
+            return None
+
+        def slotted(node):
+            if isinstance(node, dict):
+                return {k: slotted(v) for k, v in node.items()}
+            if isinstance(node, list):
+                return [slotted(v) for v in node]
+            slot_type = _slot_type(node)
+            index = find(node, slot_type) if slot_type else None
+            return node if index is None else {"$slot": index}
+
+        calls = [
+            dict(call, arguments=slotted(call.get("arguments") or {})) for call in copy.deepcopy(tool_calls)
+        ]
+
+        # Number the slots by position in the query, so semantic hits can fill them in order
+        order = sorted(range(len(spans)), key=lambda i: spans[i][0])
+        renumber = {old: new for new, old in enumerate(order)}
+
+        def renumbered(node):
+            if isinstance(node, dict):
+                if set(node) == {"$slot"}:
+                    return {"$slot": renumber[node["$slot"]]}
+                return {k: renumbered(v) for k, v in node.items()}
+            if isinstance(node, list):
+                return [renumbered(v) for v in node]
+            return node
+
+        calls = renumbered(calls)
+        slot_types = [slot_types[i] for i in order]
+        template, regex, last = "", "", 0
+        for new, old in enumerate(order):
+            start, end = spans[old]
+            template += normalized[last:start] + "{" + str(new) + "}"
+            regex += re.escape(normalized[last:start]) + SLOT_PATTERNS[slot_types[new]]
+            last = end
+        template += normalized[last:]
+        regex += re.escape(normalized[last:])
+
+        entry = PlanEntry(
+            template=template,
+            pattern=re.compile(regex),
+            calls=calls,
+            slot_types=slot_types,
+            masked=_mask_numbers(normalized),
+            query=normalized,
+        )
+        if entry.semantic:
+            entry.embedding = self._embedding(entry.masked)
+        with self._lock:
+            self._entries.pop(template, None)
+            self._entries[template] = entry
+            self.counters.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = self.counters
+            return {
+                "entries": len(self._entries),
+                "lookups": counters.lookups,
+                "hits": counters.hits,
+                "exact": counters.exact,
+                "template": counters.template,
+                "semantic": counters.semantic,
+                "misses": counters.lookups - counters.hits,
+                "hit_rate": counters.hit_rate,
+                "stores": counters.stores,
+                "evictions": counters.evictions,
+            }
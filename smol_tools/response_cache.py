@@ -0,0 +1,160 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# SQLite file of the on-disk tier, "off" keeps the cache in memory only
+CACHE_PATH_ENV = "SMOL_TOOLS_RESPONSE_CACHE"
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "smol_tools", "responses.sqlite")
+# Set to 1 to also cache sampled (temperature > 0) completions
+CACHE_SAMPLED_ENV = "SMOL_TOOLS_CACHE_SAMPLED"
+
+# A cached response: the (text, token_id, logprob) of each delta and the finish reason
+Response = Tuple[List[Tuple[str, Optional[int], Optional[float]]], str]
+
+
+def response_key(*parts: Any) -> str:
+    """Hash of everything that determines a response"""
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Completed responses by request hash, in an in-memory LRU backed by SQLite.
+
+    Entries expire after ttl seconds. The disk tier drops the least recently
+    used entries once it holds more than max_disk_bytes of responses.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = DEFAULT_CACHE_PATH,
+        memory_entries: int = 256,
+        max_disk_bytes: int = 64 * 1024 ** 2,
+        ttl: float = 7 * 24 * 3600,
+        cache_sampled: bool = False,
+    ):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.cache_sampled = cache_sampled
+        self._memory: "OrderedDict[str, Tuple[float, Response]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        # Must be called with self._lock held
+        if self._db is None and self.path:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)"
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Response cache disabled on disk: {e}")
+                self.path = None
+                self._db = None
+        return self._db
+
+    def get(self, key: str) -> Optional[Response]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return entry[1]
+            self._memory.pop(key, None)
+
+            db = self._connect()
+            if db is not None:
+                try:
+                    row = db.execute(
+                        "SELECT value, created FROM responses WHERE key = ? AND created > ?",
+                        (key, now - self.ttl)
+                    ).fetchone()
+                    if row is not None:
+                        db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                        db.commit()
+                        deltas, finish_reason = json.loads(row[0])
+                        response = ([tuple(d) for d in deltas], finish_reason)
+                        self._remember(key, row[1], response)
+                        self._stats["disk_hits"] += 1
+                        return response
+                except sqlite3.Error as e:
+                    print(f"Response cache read failed: {e}")
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: str, response: Response):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            self._stats["stores"] += 1
+            db = self._connect()
+            if db is None:
+                return
+            value = json.dumps(response)
+            try:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value), now, now)
+                )
+                self._evict_disk(db, now)
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"Response cache write failed: {e}")
+
+    def _remember(self, key: str, created: float, response: Response):
+        self._memory[key] = (created, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, db: sqlite3.Connection, now: float):
+        db.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        freed = 0
+        doomed = []
+        for key, size in db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total - freed <= self.max_disk_bytes:
+                break
+            doomed.append((key,))
+            freed += size
+        db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            db = self._connect()
+            if db is not None:
+                db.execute("DELETE FROM responses")
+                db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, memory_entries=len(self._memory))
+
+
+def _default_cache() -> ResponseCache:
+    path = os.environ.get(CACHE_PATH_ENV, DEFAULT_CACHE_PATH)
+    return ResponseCache(
+        path=None if path.lower() in ("", "0", "off", "none") else path,
+        cache_sampled=os.environ.get(CACHE_SAMPLED_ENV, "").lower() in ("1", "true", "yes", "on")
+    )
+
+
+# Shared by every tool in the process
+response_cache = _default_cache()
@@ -0,0 +1,109 @@
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, List, Optional, Sequence
+import math
+import re
+import threading
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def _terms(text: str) -> List[str]:
+    return WORD_PATTERN.findall(text.lower())
+
+
+@dataclass
+class Passage:
+    index: int  # Position of the passage in the document
+    text: str
+    score: float = 0.0
+
+
+class RetrievalIndex:
+    """Ranks the passages of one document against a query.
+
+    Scoring is BM25 over lowercase words. If an embed function is given, the
+    passages are also embedded once at build time and the ranking mixes the
+    normalized BM25 score with cosine similarity.
+    """
+
+    def __init__(
+        self,
+        passages: Sequence[str],
+        embed: Optional[Callable[[List[str]], List[List[float]]]] = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+        embedding_weight: float = 0.5,
+    ):
+        self.passages = list(passages)
+        self.embed = embed
+        self.k1 = k1
+        self.b = b
+        self.embedding_weight = embedding_weight
+
+        self._term_counts = [Counter(_terms(p)) for p in self.passages]
+        self._lengths = [sum(c.values()) for c in self._term_counts]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+        document_freq = Counter()
+        for counts in self._term_counts:
+            document_freq.update(counts.keys())
+        n = len(self.passages)
+        self._idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_freq.items()
+        }
+        self._embeddings = [_normalize(v) for v in embed(self.passages)] if embed and self.passages else None
+
+    def _bm25(self, query_terms: List[str]) -> List[float]:
+        scores = []
+        for counts, length in zip(self._term_counts, self._lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / (self._avg_length or 1.0))
+            for term in query_terms:
+                tf = counts.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def search(self, query: str, k: int = 4) -> List[Passage]:
+        """Top-k passages for query, best first"""
+        scores = self._bm25(_terms(query))
+        if self._embeddings is not None:
+            top = max(scores) or 1.0
+            query_vector = _normalize(self.embed([query])[0])
+            scores = [
+                (1 - self.embedding_weight) * s / top
+                + self.embedding_weight * sum(a * b for a, b in zip(query_vector, v))
+                for s, v in zip(scores, self._embeddings)
+            ]
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
+        return [Passage(i, self.passages[i], scores[i]) for i in ranked]
+
+
+def _normalize(vector: Sequence[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class IndexCache:
+    """LRU of built indexes, keyed by model, document content hash and build parameters"""
+
+    def __init__(self, capacity: int = 8):
+        self.capacity = capacity
+        self._indexes: "OrderedDict[Hashable, RetrievalIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key: Hashable, build: Callable[[], RetrievalIndex]) -> RetrievalIndex:
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        # Build outside the lock, it may take a while for large documents
+        index = build()
+        with self._lock:
+            self._indexes[key] = index
+            while len(self._indexes) > self.capacity:
+                self._indexes.popitem(last=False)
+        return index
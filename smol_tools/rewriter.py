@@ -1,18 +1,24 @@
-from .base import SmolTool
-from typing import Generator
+from .base import SmolTool, CompletionDelta
+from .config import ModelConfig, load_config
+from .cancellation import CancellationToken
+from dataclasses import replace
+from typing import Generator, Optional
 
 class SmolRewriter(SmolTool):
-    def __init__(self):
+    config_name = "rewriter"
+
+    def __init__(self, config: Optional[ModelConfig] = None, draft_tokens: Optional[int] = None):
+        # Rewrites mostly copy the email, prompt-lookup drafts of draft_tokens tokens speed up decoding
+        if draft_tokens is not None:
+            config = replace(config or load_config(self.config_name), draft_tokens=draft_tokens)
         super().__init__(
             model_repo="andito/SmolLM2-1.7B-Instruct-F16-GGUF",
             model_filename="smollm2-1.7b-8k-dpo-f16.gguf",
             system_prompt="You are an AI writing assistant. Your task is to rewrite the user's email to make it more professional and approachable while maintaining its main points and key message. Do not return any text other than the rewritten message.",
-            prefix_text="Rewrite the message below to make it more professional and approachable while maintaining its main points and key message. Do not add any new information or return any text other than the rewritten message\nThe message:"
+            prefix_text="Rewrite the message below to make it more professional and approachable while maintaining its main points and key message. Do not add any new information or return any text other than the rewritten message\nThe message:",
+            config=config
         )
 
-    def process(self, text: str) -> Generator[str, None, None]:
-        messages = [
-            {"role": "system", "content": self.system_prompt},
-            {"role": "user", "content": f"{self.prefix_text}\n{text}"}
-        ]
-        yield from self._create_chat_completion(messages, temperature=0.4, repeat_penalty=1.0, top_k=0, max_tokens=1024)
\ No newline at end of file
+    def stream(self, text: str, cancel: Optional[CancellationToken] = None) -> Generator[CompletionDelta, None, None]:
+        messages = self._prompt_messages(text)
+        yield from self._stream_chat_completion(messages, temperature=0.4, repeat_penalty=1.0, top_k=0, max_tokens=1024, cancel=cancel)
\ No newline at end of file
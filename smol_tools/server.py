@@ -0,0 +1,596 @@
+"""HTTP server sharing one set of loaded models between many clients.
+
+    python -m smol_tools serve --port 8000
+    SMOL_TOOLS_BACKEND=stub python -m smol_tools serve  # No model needed
+
+Routes:
+    GET    /health                      Status, load and tool readiness
+    GET    /metrics                     Prometheus metrics
+    GET    /v1/models                   Tools as OpenAI models
+    POST   /v1/chat/completions         OpenAI-compatible chat completions
+    POST   /v1/summarize                {"text", "question"?}
+    POST   /v1/rewrite                  {"text"}
+    POST   /v1/title                    {"text"}
+    POST   /v1/agent                    {"text"}
+    POST   /v1/sessions                 Start a chat session, returns its id
+    GET    /v1/sessions/<id>            The session's history
+    POST   /v1/sessions/<id>/messages   {"content"}, the reply to a new message
+    DELETE /v1/sessions/<id>            End a session
+
+POST routes take "stream": true for server-sent events, and "max_tokens" and
+"timeout" (seconds) to bound the generation.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Generator, Iterator, List, Optional, Set, Tuple
+import argparse
+import importlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+
+from .base import CompletionDelta
+from .cancellation import CancellationToken
+from .metrics import RequestMetrics, metrics
+from .startup import LazyTool
+
+# OpenAI model names of the tools, with the module and class that implement them
+TOOLS = {
+    "smol-summarizer": ("smol_tools.summarizer", "SmolSummarizer"),
+    "smol-rewriter": ("smol_tools.rewriter", "SmolRewriter"),
+    "smol-titler": ("smol_tools.titler", "SmolTitler"),
+    "smol-chatter": ("smol_tools.chatter", "SmolChatter"),
+    "smol-agent": ("smol_tools.agent", "SmolToolAgent"),
+}
+
+# Tool-specific routes and the model serving them
+ROUTES = {
+    "/v1/summarize": "smol-summarizer",
+    "/v1/rewrite": "smol-rewriter",
+    "/v1/title": "smol-titler",
+    "/v1/agent": "smol-agent",
+}
+
+# OpenAI has no finish reason for a spent token budget
+FINISH_REASONS = {"budget": "length"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+def _tool_class(model: str):
+    module, name = TOOLS[model]
+    return getattr(importlib.import_module(module), name)
+
+
+def _tool_factory(model: str):
+    """Constructs the tool for model, importing its module only then (the agent needs transformers)"""
+    def factory():
+        return _tool_class(model)()
+    factory.__name__ = TOOLS[model][1]
+    return factory
+
+
+def _number(body: Dict[str, Any], name: str) -> Optional[float]:
+    value = body.get(name)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+        raise HTTPError(400, f"{name} must be a positive number")
+    return value
+
+
+def _messages(body: Dict[str, Any]) -> List[Dict[str, str]]:
+    messages = body.get("messages")
+    if not messages or not isinstance(messages, list):
+        raise HTTPError(400, "messages must be a non-empty list")
+    for i, message in enumerate(messages):
+        if not isinstance(message, dict):
+            raise HTTPError(400, f"messages[{i}] must be an object")
+        for key in ("role", "content"):
+            if not isinstance(message.get(key), str):
+                raise HTTPError(400, f"messages[{i}].{key} must be a string")
+    return messages
+
+
+class ConcurrencyLimiter:
+    """At most max_active requests generate at once and at most max_waiting wait for a turn.
+
+    Requests beyond the queue are rejected right away (429), and requests
+    that wait longer than the timeout give up (503).
+    """
+
+    def __init__(self, max_active: int, max_waiting: int, timeout: float):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            if self.active >= self.max_active and self.waiting >= self.max_waiting:
+                raise HTTPError(429, "Too many requests waiting", {"Retry-After": "1"})
+            self.waiting += 1
+            try:
+                if not self._cond.wait_for(lambda: self.active < self.max_active, self.timeout):
+                    raise HTTPError(503, "Timed out waiting for a free slot", {"Retry-After": "1"})
+            finally:
+                self.waiting -= 1
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.active == 0 and self.waiting == 0, timeout)
+
+
+def _usage(captured: List[RequestMetrics], completion_tokens: int) -> Dict[str, int]:
+    prompt_tokens = sum(m.prompt_tokens for m in captured)
+    # The agent's tool responses aren't tokens, count what the model generated
+    completion_tokens = max(completion_tokens, sum(m.completion_tokens for m in captured))
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+class ChatSession:
+    """A conversation on the shared chatter, used by one request at a time.
+
+    Only the history and its context window belong to the session, its KV
+    state lives in the chatter's state cache under the session id.
+    """
+
+    def __init__(self, chatter):
+        self.id = uuid.uuid4().hex
+        self.chatter = chatter
+        self.history = []  # ChatMessages, oldest first
+        self.context = chatter.new_context_window()
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def stream(self, content: str, cancel: CancellationToken) -> Generator[CompletionDelta, None, None]:
+        return self.chatter.stream_reply(self.history, self.context, self.chatter._state_key(self.id), content, cancel)
+
+    def close(self):
+        self.chatter.states.pop(self.chatter._state_key(self.id))
+
+
+class SmolServer:
+    """The tools behind an HTTP server, with concurrency limits and graceful shutdown"""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        max_active: int = 4,
+        max_waiting: int = 32,
+        queue_timeout: float = 60.0,
+        max_sessions: int = 64,
+        models: Optional[List[str]] = None
+    ):
+        self.tools = {model: LazyTool(_tool_factory(model), name=model) for model in models or TOOLS}
+        self.limiter = ConcurrencyLimiter(max_active, max_waiting, queue_timeout)
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self.sessions_lock = threading.Lock()
+        self.draining = False
+        self._requests: Set[CancellationToken] = set()
+        self._requests_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.smol = self
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.httpd.server_address[:2]
+
+    def tool(self, model: str):
+        if model not in self.tools:
+            raise HTTPError(404, f"Unknown model {model!r}, available: {', '.join(self.tools)}")
+        try:
+            return self.tools[model].load()
+        except ImportError as e:
+            raise HTTPError(501, f"{model} is not available: {e}")
+
+    @contextmanager
+    def request(self, body: Dict[str, Any]) -> Iterator[CancellationToken]:
+        """A limiter slot and a cancellation token for one generation"""
+        if self.draining:
+            raise HTTPError(503, "Server is shutting down")
+        _number(body, "timeout"), _number(body, "max_tokens")
+        with self.limiter.slot():
+            cancel = CancellationToken(timeout=_number(body, "timeout"), max_tokens=_number(body, "max_tokens"))
+            with self._requests_lock:
+                self._requests.add(cancel)
+            try:
+                yield cancel
+            finally:
+                with self._requests_lock:
+                    self._requests.discard(cancel)
+
+    def create_session(self) -> ChatSession:
+        session = ChatSession(self.tool("smol-chatter"))
+        with self.sessions_lock:
+            self.sessions[session.id] = session
+            # Drop the least recently used idle sessions over the limit
+            for old in list(self.sessions.values()):
+                if len(self.sessions) <= self.max_sessions:
+                    break
+                if old is not session and not old.lock.locked():
+                    del self.sessions[old.id]
+                    old.close()
+        return session
+
+    def session(self, session_id: str) -> ChatSession:
+        with self.sessions_lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise HTTPError(404, f"Unknown session {session_id!r}")
+            self.sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            return session
+
+    def close_session(self, session_id: str):
+        with self.sessions_lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            raise HTTPError(404, f"Unknown session {session_id!r}")
+        session.close()
+
+    def serve_forever(self):
+        host, port = self.address
+        print(f"Serving smol tools on http://{host}:{port}")
+        self.httpd.serve_forever()
+
+    def shutdown(self, grace: float = 30.0):
+        """Stop accepting requests, let running ones finish for up to grace seconds, then cancel them"""
+        self.draining = True
+        # serve_forever() returns once its current poll ends, call this from another thread
+        self.httpd.shutdown()
+        if not self.limiter.wait_idle(grace):
+            with self._requests_lock:
+                running = list(self._requests)
+            print(f"Cancelling {len(running)} requests still running after {grace:.0f}s")
+            for cancel in running:
+                cancel.cancel()
+            self.limiter.wait_idle(5.0)
+        self.httpd.server_close()
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "status": "draining" if self.draining else "ok",
+            "active": self.limiter.active,
+            "waiting": self.limiter.waiting,
+            "sessions": len(self.sessions),
+            "tools": {model: tool.status for model, tool in self.tools.items()},
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive needs HTTP/1.1, and idle connections are closed after the timeout
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+    server_version = "smol-tools"
+    _streaming = False
+
+    @property
+    def smol(self) -> SmolServer:
+        return self.server.smol
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} {format % args}")
+
+    def _dispatch(self, method: str):
+        path = self.path.split("?")[0].rstrip("/")
+        try:
+            body = self._read_body() if method == "POST" else {}
+            if self.smol.draining:
+                self.close_connection = True
+            if method == "GET" and path == "/health":
+                self._send_json(200, self.smol.health())
+            elif method == "GET" and path == "/metrics":
+                self._send(200, metrics.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+            elif method == "GET" and path == "/v1/models":
+                self._send_json(200, {
+                    "object": "list",
+                    "data": [{"id": model, "object": "model", "owned_by": "smol-tools"} for model in self.smol.tools],
+                })
+            elif method == "POST" and path == "/v1/chat/completions":
+                self._chat_completions(body)
+            elif method == "POST" and path in ROUTES:
+                self._tool_route(ROUTES[path], body)
+            elif path == "/v1/sessions" and method == "POST":
+                # Loading the chatter can take a while, gate it like the other POSTs
+                with self.smol.request(body):
+                    session = self.smol.create_session()
+                self._send_json(201, {"id": session.id})
+            elif path.startswith("/v1/sessions/"):
+                self._session_route(method, path[len("/v1/sessions/"):].split("/"), body)
+            else:
+                raise HTTPError(404, f"No route for {method} {path}")
+        except HTTPError as e:
+            self._send_error(e.status, str(e), e.headers)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        except Exception as e:
+            print(f"Error handling {method} {path}: {e}")
+            self._send_error(500, str(e))
+
+    def _read_body(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            raise HTTPError(400, f"Invalid JSON: {e}")
+        if not isinstance(body, dict):
+            raise HTTPError(400, "Expected a JSON object")
+        return body
+
+    def _send(self, status: int, data: bytes, content_type: str, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None):
+        self._send(status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+    def _send_error(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        # After a partial stream the connection can't carry an error response
+        if self._streaming:
+            self.close_connection = True
+            return
+        error_type = "invalid_request_error" if status < 500 else "server_error"
+        self._send_json(status, {"error": {"message": message, "type": error_type, "code": status}}, headers)
+
+    def _start_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # Chunked, so the connection stays usable after the stream ends
+        self.send_header("Transfer-Encoding", "chunked")
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self._streaming = True
+
+    def _send_event(self, payload: Any):
+        data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_events(self):
+        self._send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+        self._streaming = False
+
+    def _run(
+        self,
+        deltas: Generator[CompletionDelta, None, None],
+        cancel: CancellationToken,
+        stream: bool,
+        event,
+        response
+    ):
+        """Send the deltas as events, or collect them into one response.
+
+        event(delta) and response(text, finish_reason, usage) build the payloads.
+        A client that disconnects cancels its generation. Events start with the
+        first delta, so a prompt that doesn't fit is still answered with a 400.
+        """
+        text, finish_reason, n_tokens = "", None, 0
+        # Completions of the request report here from whichever thread runs them
+        captured: List[RequestMetrics] = []
+        cancel.add_metrics_callback(captured.append)
+        try:
+            for delta in deltas:
+                if stream and not self._streaming:
+                    self._start_events()
+                text += delta.text
+                n_tokens += delta.token_id is not None
+                finish_reason = delta.finish_reason or finish_reason
+                if stream and (delta.text or delta.finish_reason):
+                    self._send_event(event(delta))
+        except (BrokenPipeError, ConnectionResetError):
+            cancel.cancel()
+            raise
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        finally:
+            deltas.close()
+        finish_reason = FINISH_REASONS.get(finish_reason, finish_reason) or "stop"
+        usage = _usage(captured, n_tokens)
+        if stream:
+            if not self._streaming:
+                self._start_events()
+            self._end_events()
+        else:
+            self._send_json(200, response(text, finish_reason, usage))
+
+    def _chat_completions(self, body: Dict[str, Any]):
+        model = body.get("model", "smol-chatter")
+        if not isinstance(model, str):
+            raise HTTPError(400, "model must be a string")
+        messages = _messages(body)
+        tool = self.smol.tool(model)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def choice(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+
+        first = [True]
+
+        def event(delta: CompletionDelta) -> Dict[str, Any]:
+            finish_reason = FINISH_REASONS.get(delta.finish_reason, delta.finish_reason)
+            message = {"content": delta.text} if delta.text else {}
+            # Only the first chunk carries the role
+            if first[0]:
+                message["role"] = "assistant"
+                first[0] = False
+            return choice(message, finish_reason)
+
+        def response(text: str, finish_reason: str, usage: Dict[str, int]) -> Dict[str, Any]:
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": finish_reason,
+                }],
+                "usage": usage,
+            }
+
+        with self.smol.request(body) as cancel:
+            if model == "smol-chatter":
+                # The whole conversation comes with each request, as with OpenAI
+                if messages[0].get("role") != "system":
+                    messages = [{"role": "system", "content": tool.system_prompt}] + messages
+                deltas = tool._stream_chat_completion(
+                    messages,
+                    temperature=body.get("temperature", 0.4),
+                    top_p=body.get("top_p", 0.9),
+                    max_tokens=body.get("max_tokens") or 1024,
+                    cancel=cancel
+                )
+            else:
+                # The other tools work on the last user message, with their own prompts
+                text = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+                deltas = tool.stream(text, cancel=cancel)
+            self._run(deltas, cancel, bool(body.get("stream")), event, response)
+
+    def _tool_route(self, model: str, body: Dict[str, Any]):
+        text = body.get("text")
+        if not isinstance(text, str) or not text:
+            raise HTTPError(400, "text is required")
+        kwargs = {"question": body["question"]} if model == "smol-summarizer" and body.get("question") else {}
+        tool = self.smol.tool(model)
+        with self.smol.request(body) as cancel:
+            self._run(
+                tool.stream(text, cancel=cancel, **kwargs),
+                cancel,
+                bool(body.get("stream")),
+                lambda delta: {"text": delta.text, "finish_reason": FINISH_REASONS.get(delta.finish_reason, delta.finish_reason)},
+                lambda text, finish_reason, usage: {"model": model, "text": text, "finish_reason": finish_reason, "usage": usage}
+            )
+
+    def _session_route(self, method: str, parts: List[str], body: Dict[str, Any]):
+        session = self.smol.session(parts[0])
+        if method == "GET" and len(parts) == 1:
+            self._send_json(200, {"id": session.id, "messages": [m.to_dict() for m in session.history]})
+        elif method == "DELETE" and len(parts) == 1:
+            self.smol.close_session(session.id)
+            self._send_json(200, {"id": session.id, "deleted": True})
+        elif method == "POST" and parts[1:] == ["messages"]:
+            content = body.get("content")
+            if not isinstance(content, str) or not content:
+                raise HTTPError(400, "content is required")
+            # A session's history takes one message at a time
+            if not session.lock.acquire(blocking=False):
+                raise HTTPError(409, "The session is still answering a previous message")
+            try:
+                with self.smol.request(body) as cancel:
+                    self._run(
+                        session.stream(content, cancel),
+                        cancel,
+                        bool(body.get("stream")),
+                        lambda delta: {"text": delta.text, "finish_reason": FINISH_REASONS.get(delta.finish_reason, delta.finish_reason)},
+                        lambda text, finish_reason, usage: {"id": session.id, "text": text, "finish_reason": finish_reason, "usage": usage}
+                    )
+            finally:
+                session.lock.release()
+        else:
+            raise HTTPError(404, f"No route for {method} {self.path}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m smol_tools serve", description="Serve the smol tools over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-active", type=int, default=4, help="Requests generating at once, the rest queue")
+    parser.add_argument("--max-waiting", type=int, default=32, help="Queued requests before new ones get 429")
+    parser.add_argument("--queue-timeout", type=float, default=60.0, help="Seconds a request may queue before a 503")
+    parser.add_argument("--max-sessions", type=int, default=64, help="Chat sessions kept, least recently used are dropped")
+    parser.add_argument("--grace", type=float, default=30.0, help="Seconds running requests get to finish on shutdown")
+    parser.add_argument("--models", nargs="+", choices=sorted(TOOLS), help="Tools to serve, all by default")
+    parser.add_argument("--preload", action="store_true", help="Load the models before serving instead of on first use")
+    parser.add_argument("--backend", choices=["stub", "llama_cpp"], help="Overrides SMOL_TOOLS_BACKEND")
+    args = parser.parse_args(argv)
+
+    if args.backend:
+        os.environ["SMOL_TOOLS_BACKEND"] = args.backend
+    server = SmolServer(
+        args.host,
+        args.port,
+        max_active=args.max_active,
+        max_waiting=args.max_waiting,
+        queue_timeout=args.queue_timeout,
+        max_sessions=args.max_sessions,
+        models=args.models
+    )
+    if args.preload:
+        for model, tool in server.tools.items():
+            try:
+                tool.load()
+            except ImportError as e:
+                print(f"{model} is not available: {e}")
+
+    stopping = threading.Thread(target=server.shutdown, args=(args.grace,), name="smol-tools-shutdown")
+
+    def stop(signum, frame):
+        if stopping.is_alive():
+            return
+        print("Shutting down, waiting for running requests...")
+        # shutdown() blocks until serve_forever() returns, which runs on this thread
+        stopping.start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+    stopping.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+from typing import Any, List, Optional, Tuple
+import numpy as np
+from .backend import LlamaPromptLookupDecoding
+from .state_cache import common_prefix_length
+
+
+class PromptLookupDraft:
+    """Prompt-lookup (n-gram) draft model that counts how many of its drafted tokens were accepted.
+
+    Wraps LlamaPromptLookupDecoding, which drafts the tokens that followed the
+    last n-gram the last time it appeared in the context. Llama.generate
+    evaluates each draft together with the sampled token and keeps the drafted
+    tokens the model would have sampled itself, which is a lot of them when the
+    output copies the input, as in a rewrite.
+
+    A draft is settled on the next call, once generation has checked it, and
+    reset() drops one that was never checked.
+    """
+
+    def __init__(self, num_pred_tokens: int = 10, max_ngram_size: int = 2):
+        if LlamaPromptLookupDecoding is None:
+            raise ImportError("Prompt-lookup decoding needs llama-cpp-python")
+        self.lookup = LlamaPromptLookupDecoding(max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens)
+        self.drafted = 0
+        self.accepted = 0
+        self._pending: Optional[Tuple[int, List[int]]] = None  # Position and tokens of the last draft
+
+    def reset(self):
+        """Forget the unchecked draft, call before each generation"""
+        self._pending = None
+
+    def __call__(self, input_ids: np.ndarray, **kwargs: Any) -> np.ndarray:
+        if self._pending is not None:
+            start, draft = self._pending
+            # A rejected token was overwritten by the one sampled in its place
+            self.accepted += common_prefix_length(draft, input_ids[start:start + len(draft)].tolist())
+            self.drafted += len(draft)
+        draft = self.lookup(input_ids)
+        self._pending = (len(input_ids), draft.tolist()) if len(draft) else None
+        return draft
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+import inspect
+import threading
+import time
+
+
+class StartupTimer:
+    """Records how long each startup phase (import, model load, warm-up) took"""
+
+    def __init__(self):
+        self._phases: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self._phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def phases(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._phases)
+
+    def report(self) -> str:
+        with self._lock:
+            lines = [f"  {name}: {seconds:.2f}s" for name, seconds in self._phases]
+        return "Startup timings:\n" + "\n".join(lines)
+
+
+# Shared by every tool in the process
+startup_timings = StartupTimer()
+
+
+class LazyTool:
+    """Stands in for a tool and constructs it on first use.
+
+    Attribute access is forwarded to the real tool, blocking until it is
+    loaded. Plain class-level data (e.g. a tool's display name) is served
+    without loading the model.
+    """
+
+    def __init__(self, factory: Callable[[], Any], name: Optional[str] = None):
+        self._factory = factory
+        self._name = name or getattr(factory, "__name__", repr(factory))
+        self._tool = None
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready.is_set() and self._error is None
+
+    @property
+    def status(self) -> str:
+        if self._error is not None:
+            return "failed"
+        if self._ready.is_set():
+            return "ready"
+        return "loading" if self._lock.locked() else "pending"
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the tool is loaded, returns False on timeout"""
+        return self._ready.wait(timeout)
+
+    def load(self):
+        """Construct the tool now if it isn't yet, and return it"""
+        if self._tool is not None:
+            return self._tool
+        with self._lock:
+            if self._tool is None:
+                try:
+                    self._tool = self._factory()
+                except BaseException as e:
+                    self._error = e
+                    raise
+                finally:
+                    self._ready.set()
+        return self._tool
+
+    def __getattr__(self, name: str):
+        # Only called for attributes not found on the proxy itself
+        if self._tool is None and inspect.isclass(self._factory):
+            static = inspect.getattr_static(self._factory, name, None)
+            if static is not None and not callable(static) and not hasattr(static, "__get__"):
+                return static
+        return getattr(self.load(), name)
+
+    def __repr__(self) -> str:
+        return f"LazyTool({self._name}, {self.status})"
+
+
+class WarmupThread(threading.Thread):
+    """Loads and warms up lazy tools one after another in the background"""
+
+    def __init__(self, tools: List[LazyTool], on_ready: Optional[Callable[[LazyTool], None]] = None):
+        super().__init__(name="smol-tools-warmup", daemon=True)
+        self.tools = tools
+        self.on_ready = on_ready
+
+    def run(self):
+        for tool in self.tools:
+            try:
+                tool.load()
+            except Exception as e:
+                print(f"Failed to load {tool._name}: {e}")
+                continue
+            if self.on_ready is not None:
+                self.on_ready(tool)
+        print(startup_timings.report())
+
+    def readiness(self) -> Dict[str, str]:
+        """Status of each tool: pending, loading, ready or failed"""
+        return {tool._name: tool.status for tool in self.tools}
+
+
+def warm_up_in_background(tools: List[LazyTool], on_ready: Optional[Callable[[LazyTool], None]] = None) -> WarmupThread:
+    thread = WarmupThread(tools, on_ready)
+    thread.start()
+    return thread
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Sequence
+import json
+import os
+import threading
+import numpy as np
+from .backend import LlamaState
+
+# Bump when the on-disk layout changes so old files are ignored
+STATE_FILE_VERSION = 1
+
+
+def state_nbytes(state: LlamaState) -> int:
+    """Approximate memory held by a saved model state"""
+    return int(state.llama_state_size) + state.scores.nbytes + state.input_ids.nbytes
+
+
+def compact_state(state: LlamaState) -> LlamaState:
+    """Drop the per-token score rows of a state saved without logits_all.
+
+    Sampling reads the logits from the llama context itself, so the score rows
+    are never used again. One row is kept so load_state can broadcast it.
+    """
+    if state.scores.shape[0] > 1:
+        state.scores = state.scores[-1:].copy()
+    return state
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def save_state_file(state: LlamaState, path: str, model_key: Any):
+    """Write a state to disk, tagged with the model it belongs to"""
+    meta = {
+        "version": STATE_FILE_VERSION,
+        "model": list(model_key),
+        "n_tokens": int(state.n_tokens),
+        "llama_state_size": int(state.llama_state_size),
+        "seed": int(state.seed),
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            meta=np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8),
+            input_ids=state.input_ids[:state.n_tokens],
+            scores=state.scores,
+            llama_state=np.frombuffer(state.llama_state, dtype=np.uint8),
+        )
+    os.replace(tmp_path, path)
+
+
+def load_state_file(path: str, model_key: Any, n_ctx: int) -> Optional[LlamaState]:
+    """Read a state written by save_state_file, or None if it is missing or belongs to another model"""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+            if meta.get("version") != STATE_FILE_VERSION or meta.get("model") != list(model_key):
+                return None
+            if meta["n_tokens"] > n_ctx:
+                return None
+            input_ids = np.zeros((n_ctx,), dtype=np.intc)
+            input_ids[:meta["n_tokens"]] = data["input_ids"]
+            return LlamaState(
+                input_ids=input_ids,
+                scores=data["scores"].copy(),
+                n_tokens=meta["n_tokens"],
+                llama_state=data["llama_state"].tobytes(),
+                llama_state_size=meta["llama_state_size"],
+                seed=meta["seed"],
+            )
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class StateCache:
+    """LRU of saved model states (KV cache snapshots) for one model.
+
+    Entries are keyed by whatever identifies a token prefix, e.g. a chat id.
+    The cache is bounded both by entry count and by total bytes. It also tracks
+    which key the live model context currently holds, so a key's context is
+    only snapshotted when another request is about to overwrite it.
+    """
+
+    def __init__(self, capacity: int = 8, max_bytes: int = 2 * 1024 ** 3):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.resident: Optional[Hashable] = None  # Key whose tokens are in the live context
+        self.resident_dirty = False  # True if the live context changed since its last snapshot
+        self._states: "OrderedDict[Hashable, LlamaState]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._states
+
+    def get(self, key: Hashable) -> Optional[LlamaState]:
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                self.misses += 1
+                return None
+            self._states.move_to_end(key)
+            self.hits += 1
+            return state
+
+    def put(self, key: Hashable, state: LlamaState):
+        with self._lock:
+            self._remove(key)
+            self._states[key] = state
+            self._bytes += state_nbytes(state)
+            # Evict least recently used entries, but never the one just added
+            while len(self._states) > 1 and (len(self._states) > self.capacity or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._states)))
+
+    def pop(self, key: Hashable) -> Optional[LlamaState]:
+        with self._lock:
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._bytes = 0
+            self.resident = None
+            self.resident_dirty = False
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def rename(self, old: Hashable, new: Hashable):
+        with self._lock:
+            state = self._remove(old)
+            if state is not None:
+                self._remove(new)
+                self._states[new] = state
+                self._bytes += state_nbytes(state)
+            if self.resident == old:
+                self.resident = new
+
+    def _remove(self, key: Hashable) -> Optional[LlamaState]:
+        state = self._states.pop(key, None)
+        if state is not None:
+            self._bytes -= state_nbytes(state)
+        return state
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._states),
+                "bytes": self._bytes,
+                "resident": self.resident,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
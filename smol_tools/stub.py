@@ -0,0 +1,162 @@
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence
+import re
+import threading
+import time
+import zlib
+import numpy as np
+from .backend import LlamaState
+
+SPECIAL_TOKENS = {"<s>": 0, "<|im_end|>": 1, "<|endoftext|>": 2, "<|im_start|>": 3}
+PIECE_PATTERN = re.compile(r"\s*\S+|\s+")
+# Every reply is this text, cycled to REPLY_TOKENS tokens and then ended
+REPLY_TEXT = (
+    " The document describes a plan to ship the release next week, after the remaining"
+    " tests pass and the team has reviewed the changes to the deployment scripts."
+)
+REPLY_TOKENS = 48
+EMBEDDING_SIZE = 64
+
+
+@dataclass
+class StubFormatterResponse:
+    prompt: str
+    added_special: bool = False
+
+
+class StubChatFormatter:
+    """ChatML prompts, like the template of the SmolLM2 models"""
+
+    def __call__(self, messages: List[Dict[str, str]], **kwargs) -> StubFormatterResponse:
+        prompt = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+        return StubFormatterResponse(prompt + "<|im_start|>assistant\n")
+
+
+class StubLlama:
+    """A deterministic stand-in for llama_cpp.Llama that loads no weights.
+
+    Words are tokens, ids come from a hash so they are stable across processes,
+    and every generation produces the same reply. Evaluation sleeps for a
+    fixed time per token, so benchmarks on the stub measure smol_tools' own
+    overhead plus a predictable model cost. Prefix reuse of the KV cache
+    behaves like llama.cpp's.
+    """
+
+    prefill_seconds_per_token = 0.0001
+    decode_seconds_per_token = 0.002
+
+    # Pieces of every id seen, for detokenize
+    _pieces: Dict[int, str] = {v: k for k, v in SPECIAL_TOKENS.items()}
+    _pieces_lock = threading.Lock()
+
+    def __init__(self, model_path: str, n_ctx: int = 8192, embedding: bool = False, **kwargs):
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.embedding = embedding
+        self.metadata = {"general.architecture": "stub", "general.name": model_path}
+        self.context_params = type("ContextParams", (), {"logits_all": False})()
+        self.draft_model = None
+        self.ctx = None
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.scores = np.zeros((1, 1), dtype=np.single)
+        self.n_tokens = 0
+        self._reply = self.tokenize(REPLY_TEXT.encode("utf-8"), add_bos=False)
+
+    @classmethod
+    def from_pretrained(cls, repo_id: str, filename: str, **kwargs) -> "StubLlama":
+        return cls(model_path=f"stub://{repo_id}/{filename}", **kwargs)
+
+    @property
+    def _input_ids(self) -> np.ndarray:
+        return self.input_ids[:self.n_tokens]
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def n_vocab(self) -> int:
+        return 1 << 20
+
+    def n_embd(self) -> int:
+        return EMBEDDING_SIZE
+
+    def token_eos(self) -> int:
+        return SPECIAL_TOKENS["<|im_end|>"]
+
+    def token_bos(self) -> int:
+        return SPECIAL_TOKENS["<s>"]
+
+    def _piece_id(self, piece: str) -> int:
+        token = zlib.crc32(piece.encode("utf-8")) % (self.n_vocab() - len(SPECIAL_TOKENS)) + len(SPECIAL_TOKENS)
+        with self._pieces_lock:
+            self._pieces.setdefault(token, piece)
+        return token
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        text = text.decode("utf-8", errors="ignore")
+        tokens = [self.token_bos()] if add_bos else []
+        parts = re.split("(" + "|".join(map(re.escape, SPECIAL_TOKENS)) + ")", text) if special else [text]
+        for part in parts:
+            if special and part in SPECIAL_TOKENS:
+                tokens.append(SPECIAL_TOKENS[part])
+            else:
+                tokens.extend(self._piece_id(piece) for piece in PIECE_PATTERN.findall(part))
+        return tokens
+
+    def detokenize(self, tokens: Sequence[int], prev_tokens: Optional[Sequence[int]] = None, special: bool = False) -> bytes:
+        pieces = [self._pieces.get(t, "") for t in tokens if special or t not in SPECIAL_TOKENS.values()]
+        return "".join(pieces).encode("utf-8")
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens: Sequence[int]):
+        tokens = list(tokens)
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise ValueError("Stub context is full")
+        cost = self.prefill_seconds_per_token if len(tokens) > 1 else self.decode_seconds_per_token
+        time.sleep(cost * len(tokens))
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+
+    def generate(self, tokens: Sequence[int], reset: bool = True, **kwargs) -> Iterator[int]:
+        tokens = list(tokens)
+        if reset and self.n_tokens > 0:
+            # Keep the evaluated prefix shared with the new prompt, like Llama.generate
+            prefix = 0
+            for a, b in zip(self._input_ids, tokens[:-1]):
+                if a != b:
+                    break
+                prefix += 1
+            if prefix > 0:
+                reset = False
+                tokens = tokens[prefix:]
+                self.n_tokens = prefix
+        if reset:
+            self.reset()
+        for i in range(REPLY_TOKENS + 1):
+            self.eval(tokens)
+            token = self._reply[i % len(self._reply)] if i < REPLY_TOKENS else self.token_eos()
+            yield token
+            tokens = [token]
+
+    def save_state(self) -> LlamaState:
+        kv = self.input_ids[:self.n_tokens].tobytes()
+        return LlamaState(self.input_ids.copy(), self.scores.copy(), self.n_tokens, kv, len(kv), 0)
+
+    def load_state(self, state: LlamaState):
+        self.input_ids = np.array(state.input_ids, dtype=np.intc)
+        self.input_ids.resize(self._n_ctx, refcheck=False)
+        self.n_tokens = state.n_tokens
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Hashed bag-of-words vectors"""
+        vectors = []
+        for text in texts:
+            vector = [0.0] * EMBEDDING_SIZE
+            for piece in PIECE_PATTERN.findall(text.lower()):
+                vector[zlib.crc32(piece.strip().encode("utf-8")) % EMBEDDING_SIZE] += 1.0
+            vectors.append(vector)
+        return vectors
+
+    def close(self):
+        pass
@@ -1,8 +1,28 @@
-from .base import SmolTool
-from typing import Generator, Optional
+from .base import SmolTool, CompletionDelta, PROMPT_SENTINEL
+from .cancellation import RequestCancelled
+from .models import model_manager, kv_cache_nbytes
+from .state_cache import state_nbytes
+from .retrieval import RetrievalIndex, IndexCache
+from .config import ModelConfig
+from .cancellation import CancellationToken
+from .metrics import RequestMetrics, metrics
+from typing import Callable, Generator, Optional, Dict, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from typing import List
+from .backend import Llama
+import hashlib
+import os
+import threading
+import time
+
+SUMMARY_SYSTEM_PROMPT = "Concisely summarize the main points of the input text in up to three sentences, focusing on key information and events."
+
+# Tokens reserved in each prompt for the template and the generated summary
+PARTIAL_SUMMARY_TOKENS = 256
+PROMPT_OVERHEAD_TOKENS = 128
 
 @dataclass
 class SummaryMessage:
@@ -10,31 +30,386 @@ class SummaryMessage:
     content: str
     timestamp: datetime
 
-class SmolSummarizer(SmolTool):
+class DocumentSession:
+    """A document evaluated once, so questions about it only pay for the question and the answer.
+
+    The KV state after the document prefix is kept in the model's state cache
+    and restored before each question. If it was evicted, it is rebuilt on the
+    next question.
+    """
+
+    def __init__(self, summarizer: "SmolSummarizer", text: str):
+        self.summarizer = summarizer
+        self.text = text
+        self.key = ("document", hashlib.sha256(text.encode("utf-8")).hexdigest())
+        self.nbytes = 0
+
+    def _messages(self, question: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "user", "content": f"Original text:\n{self.text}\n\nQuestion: {question}"},
+        ]
+
+    def prefill(self):
+        """Evaluate the document and snapshot the model state"""
+        state = self.summarizer._prefill_state(self.key, self._messages(PROMPT_SENTINEL))
+        self.nbytes = state_nbytes(state)
+
+    def ask(self, question: str, cancel: Optional[CancellationToken] = None) -> Generator[CompletionDelta, None, None]:
+        if self.key not in self.summarizer.states:
+            self.prefill()
+        yield from self.summarizer._stream_chat_completion(
+            self._messages(question),
+            max_tokens=1024,
+            temperature=0.1,
+            top_p=0.9,
+            state_key=self.key,
+            update_state=False,
+            cancel=cancel
+        )
+
+    def close(self):
+        self.summarizer.states.pop(self.key)
+
+
+class WorkerPool:
+    """Private contexts of one model, shared by every long summary and used by one chunk at a time.
+
+    Contexts too small for a later request are closed once they're idle, and
+    close() frees them all, closing the ones in use when they're returned.
+    """
+
     def __init__(self):
-        self.name = "SmolLM2-1.7B"
-        
+        self.contexts: List[Llama] = []  # Every open context, idle or checked out
+        self.idle: List[Llama] = []
+        self.n_ctx = 0
+        self.condition = threading.Condition()
+        # Contexts are loaded one request at a time, so concurrent requests don't both load them
+        self.spawn_lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        with self.condition:
+            return sum(kv_cache_nbytes(context) for context in self.contexts)
+
+    def reserve(self, n_workers: int, n_ctx: int, spawn: Callable[[int], Llama]):
+        """Make sure at least n_workers contexts of n_ctx or more tokens exist"""
+        with self.spawn_lock:
+            with self.condition:
+                if n_ctx > self.n_ctx:
+                    self.n_ctx = n_ctx
+                    for context in [c for c in self.idle if c.n_ctx() < n_ctx]:
+                        self._close(context)
+                n_ctx = self.n_ctx
+                missing = n_workers - sum(1 for c in self.contexts if c.n_ctx() >= n_ctx)
+            for i in range(missing):
+                print(f"Loading summarizer worker context {i + 1}/{missing}...")
+                self._add(spawn(n_ctx))
+
+    def checkout(self, spawn: Callable[[int], Llama], cancel: Optional[CancellationToken] = None) -> Llama:
+        """Wait for an idle context, raises RequestCancelled if cancel is cancelled meanwhile"""
+        with self.condition:
+            while not self.idle:
+                if cancel is not None and cancel.cancelled:
+                    raise RequestCancelled(cancel.reason)
+                if not self.contexts:
+                    # The pool was closed under a running summary
+                    break
+                self.condition.wait(0.05 if cancel is not None else None)
+            else:
+                return self.idle.pop()
+            n_ctx = self.n_ctx
+        context = spawn(n_ctx)
+        with self.condition:
+            self.contexts.append(context)
+        return context
+
+    def checkin(self, context: Llama):
+        with self.condition:
+            if context in self.contexts and context.n_ctx() >= self.n_ctx:
+                self.idle.append(context)
+                self.condition.notify()
+            else:
+                self._close(context)
+
+    def close(self):
+        """Close the idle contexts now and the checked out ones when they're returned"""
+        with self.condition:
+            for context in list(self.idle):
+                self._close(context)
+            self.contexts.clear()
+            self.condition.notify_all()
+
+    def _add(self, context: Llama):
+        with self.condition:
+            self.contexts.append(context)
+            self.idle.append(context)
+            self.condition.notify()
+
+    def _close(self, context: Llama):
+        # Must be called with self.condition held
+        if context in self.contexts:
+            self.contexts.remove(context)
+        if context in self.idle:
+            self.idle.remove(context)
+        context.close()
+
+
+class SmolSummarizer(SmolTool):
+    # Private contexts used to summarize chunks of long documents in parallel, one pool per model
+    _worker_pools: Dict[Tuple, WorkerPool] = {}
+    _worker_lock = threading.Lock()
+    # Retrieval indexes of documents too long to fit in a question prompt
+    _indexes = IndexCache()
+    name = "SmolLM2-1.7B"
+    config_name = "summarizer"
+
+    def __init__(self, max_sessions: int = 4, max_session_bytes: int = 2 * 1024 ** 3, config: Optional[ModelConfig] = None):
+        # Open document sessions, least recently used first
+        self._sessions: "OrderedDict[str, DocumentSession]" = OrderedDict()
+        self._sessions_lock = threading.Lock()
+        self.max_sessions = max_sessions
+        self.max_session_bytes = max_session_bytes
+
         super().__init__(
             model_repo="andito/SmolLM2-1.7B-Instruct-F16-GGUF",
             model_filename="smollm2-1.7b-8k-dpo-f16.gguf",
-            system_prompt="Concisely summarize the main points of the input text in up to three sentences, focusing on key information and events.",
+            system_prompt=SUMMARY_SYSTEM_PROMPT,
+            config=config
         )
 
-    def process(self, text: str, question: Optional[str] = None) -> Generator[str, None, None]:
+    def _summary_messages(self, text: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": f"{self.prefix_text}\n{text}"},
+            {"role": "assistant", "content": "This is a short summary of the text:"}
+        ]
+
+    def _prompt_messages(self, text: str) -> List[Dict[str, str]]:
+        return self._summary_messages(text)
+
+    def _fits_in_prompt(self, text: str) -> bool:
+        return self._count_tokens(text) <= self.model.n_ctx() - 1024 - PROMPT_OVERHEAD_TOKENS
+
+    def stream(
+        self,
+        text: str,
+        question: Optional[str] = None,
+        cancel: Optional[CancellationToken] = None
+    ) -> Generator[CompletionDelta, None, None]:
         if question is None:
+            # Documents that don't fit in one prompt go through map-reduce
+            if not self._fits_in_prompt(text):
+                yield from self.summarize_long(text, cancel=cancel)
+                return
             print("Summarizing text")
-            prompt = f"{self.prefix_text}\n{text}"
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": prompt},
-                {"role": "assistant", "content": "This is a short summary of the text:"}
-            ]
+            messages = self._summary_messages(text)
         else:
             print("Answering question")
-            prompt = f"Original text:\n{text}\n\nQuestion: {question}"
-            messages = [
-                {"role": "user", "content": prompt},
-            ]
+            # Documents that don't fit in one prompt are answered from retrieved passages
+            if not self._fits_in_prompt(text):
+                yield from self.answer_long(text, question, cancel=cancel)
+            else:
+                yield from self.session(text).ask(question, cancel=cancel)
+            return
+
+        yield from self._stream_chat_completion(messages, max_tokens=1024, temperature=0.1, top_p=0.9, cancel=cancel)
+
+    def answer_long(
+        self,
+        text: str,
+        question: str,
+        context_tokens: int = 2048,
+        passage_tokens: int = 256,
+        use_embeddings: bool = False,
+        cancel: Optional[CancellationToken] = None
+    ) -> Generator[CompletionDelta, None, None]:
+        """Answer a question about a document of any length from its most relevant passages.
+
+        The passage index is built once per document and model, cached by content hash.
+        Ranking uses BM25, optionally mixed with embeddings from the model.
+        """
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        index = self._indexes.get_or_build(
+            (self.cache_key, digest, passage_tokens, use_embeddings),
+            lambda: RetrievalIndex(
+                self._split(text, passage_tokens, passage_tokens // 8),
+                embed=self._embed if use_embeddings else None
+            )
+        )
+
+        # Take the best passages that fit the budget, then restore document order
+        context_tokens = min(context_tokens, self.model.n_ctx() - 1024 - PROMPT_OVERHEAD_TOKENS)
+        chosen, used = [], 0
+        for passage in index.search(question, k=max(1, 2 * context_tokens // passage_tokens)):
+            if used + passage_tokens > context_tokens:
+                break
+            chosen.append(passage)
+            used += passage_tokens
+        excerpts = "\n\n".join(p.text for p in sorted(chosen, key=lambda p: p.index))
+
+        messages = [
+            {"role": "user", "content": f"Excerpts from the original text:\n{excerpts}\n\nQuestion: {question}"},
+        ]
+        yield from self._stream_chat_completion(messages, max_tokens=1024, temperature=0.1, top_p=0.9, cancel=cancel)
+
+    def session(self, text: str) -> DocumentSession:
+        """Open (or reuse) the question-answering session for a document"""
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        with self._sessions_lock:
+            session = self._sessions.get(digest)
+            if session is not None:
+                self._sessions.move_to_end(digest)
+                return session
+            session = DocumentSession(self, text)
+            self._sessions[digest] = session
+        session.prefill()
+        self._evict_sessions()
+        return session
+
+    def _evict_sessions(self):
+        """Close least recently used sessions beyond the count and memory caps"""
+        with self._sessions_lock:
+            while len(self._sessions) > 1 and (
+                len(self._sessions) > self.max_sessions
+                or sum(s.nbytes for s in self._sessions.values()) > self.max_session_bytes
+            ):
+                _, session = self._sessions.popitem(last=False)
+                session.close()
+
+    def _split(self, text: str, chunk_tokens: int, overlap_tokens: int) -> List[str]:
+        """Split text into chunks of chunk_tokens tokens, consecutive chunks share overlap_tokens"""
+        tokens = self.model.tokenize(text.encode("utf-8"), add_bos=False)
+        step = max(1, chunk_tokens - overlap_tokens)
+        chunks = []
+        for start in range(0, len(tokens), step):
+            chunk = tokens[start:start + chunk_tokens]
+            chunks.append(self.model.detokenize(chunk).decode("utf-8", errors="ignore"))
+            if start + chunk_tokens >= len(tokens):
+                break
+        return chunks
+
+    def _group(self, summaries: List[str], budget_tokens: int) -> List[List[str]]:
+        """Pack consecutive summaries into groups that fit in one prompt.
 
-        for chunk in self._create_chat_completion(messages, max_tokens=1024, temperature=0.1, top_p=0.9):
-            yield chunk
+        Groups take at least two summaries so every reduce level makes progress.
+        """
+        groups, current, size = [], [], 0
+        for summary in summaries:
+            n = self._count_tokens(summary)
+            if len(current) >= 2 and size + n > budget_tokens:
+                groups.append(current)
+                current, size = [], 0
+            current.append(summary)
+            size += n
+        if current:
+            groups.append(current)
+        return groups
+
+    def _worker_pool(self) -> WorkerPool:
+        with self._worker_lock:
+            pool = self._worker_pools.get(self.cache_key)
+            if pool is None:
+                pool = self._worker_pools[self.cache_key] = WorkerPool()
+                # Worker contexts are freed along with the model
+                cache_key = self.cache_key
+                model_manager.add_unload_callback(cache_key, lambda model: SmolSummarizer.release_workers(cache_key))
+                model_manager.add_memory_source(cache_key, lambda: pool.nbytes)
+            return pool
+
+    @classmethod
+    def release_workers(cls, cache_key: Optional[Tuple] = None):
+        """Free the private contexts used for long documents, of one model or of all of them"""
+        with cls._worker_lock:
+            pools = [cls._worker_pools[cache_key]] if cache_key in cls._worker_pools else (
+                list(cls._worker_pools.values()) if cache_key is None else []
+            )
+        for pool in pools:
+            pool.close()
+
+    def _summarize_on_worker(
+        self,
+        workers: WorkerPool,
+        spawn: Callable[[int], Llama],
+        text: str,
+        cancel: Optional[CancellationToken] = None
+    ) -> str:
+        start = time.perf_counter()
+        try:
+            context = workers.checkout(spawn, cancel)
+        except RequestCancelled:
+            return ""
+        stats = RequestMetrics(
+            self.__class__.__name__,
+            self.config.label,
+            queue_wait=time.perf_counter() - start,
+            finish_reason="cancelled"
+        )
+        try:
+            prompt_tokens = self._tokenize_messages(self._summary_messages(text))
+            return "".join(
+                delta.text for delta in self._generate(
+                    prompt_tokens,
+                    temperature=0.1,
+                    top_p=0.9,
+                    top_k=50,
+                    repeat_penalty=1.2,
+                    max_tokens=PARTIAL_SUMMARY_TOKENS,
+                    model=context,
+                    stats=stats,
+                    cancel=cancel
+                )
+            ).strip()
+        finally:
+            workers.checkin(context)
+            stats.total_seconds = time.perf_counter() - start
+            stats.ttft = stats.queue_wait + stats.prefill_seconds
+            metrics.record(stats)
+            if cancel is not None:
+                cancel.report(stats)
+
+    def summarize_long(
+        self,
+        text: str,
+        chunk_tokens: int = 2048,
+        overlap_tokens: int = 128,
+        n_workers: Optional[int] = None,
+        cancel: Optional[CancellationToken] = None
+    ) -> Generator[CompletionDelta, None, None]:
+        """Summarize a document of any length with parallel map-reduce.
+
+        The text is split by token count with overlap, the chunks are summarized
+        in parallel on private model contexts, and the partial summaries are
+        merged hierarchically until they fit in one prompt. Only the final
+        summary is streamed. A cancelled token stops the chunks still running
+        and skips the rest.
+        """
+        chunks = self._split(text, chunk_tokens, overlap_tokens)
+        if n_workers is None:
+            n_workers = max(1, min(4, (os.cpu_count() or 1) // 4))
+        n_workers = max(1, min(n_workers, len(chunks)))
+        print(f"Summarizing long text in {len(chunks)} chunks with {n_workers} workers")
+
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+
+        def spawn(n_ctx: int) -> Llama:
+            return self._spawn_context(n_ctx, n_threads=n_threads)
+
+        workers = self._worker_pool()
+        workers.reserve(n_workers, chunk_tokens + PARTIAL_SUMMARY_TOKENS + PROMPT_OVERHEAD_TOKENS, spawn)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            summaries = list(executor.map(lambda chunk: self._summarize_on_worker(workers, spawn, chunk, cancel), chunks))
+            # Reduce level by level until everything fits in a single prompt
+            groups = self._group(summaries, chunk_tokens)
+            while len(groups) > 1 and not (cancel is not None and cancel.cancelled):
+                summaries = list(executor.map(
+                    lambda group: self._summarize_on_worker(workers, spawn, "\n\n".join(group), cancel), groups
+                ))
+                groups = self._group(summaries, chunk_tokens)
+
+        if cancel is not None and cancel.cancelled:
+            yield CompletionDelta(text="", finish_reason=cancel.reason)
+            return
+
+        yield from self._stream_chat_completion(
+            self._summary_messages("\n\n".join(groups[0])), max_tokens=1024, temperature=0.1, top_p=0.9, cancel=cancel
+        )
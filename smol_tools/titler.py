@@ -1,17 +1,22 @@
-from .base import SmolTool
-from typing import Generator
+from .base import SmolTool, CompletionDelta, PRIORITY_BACKGROUND
+from .config import ModelConfig
+from .cancellation import CancellationToken
+from typing import Generator, Optional
 
 class SmolTitler(SmolTool):
-    def __init__(self):
+    # Titles are generated in the background and can wait
+    priority = PRIORITY_BACKGROUND
+    config_name = "titler"
+
+    def __init__(self, config: Optional[ModelConfig] = None):
         super().__init__(
             model_repo="andito/SmolLM2-1.7B-Instruct-F16-GGUF",
             model_filename="smollm2-1.7b-8k-dpo-f16.gguf",
             system_prompt="",
             prefix_text="Create a title for this conversation:",
+            config=config
         )
 
-    def process(self, text: str) -> Generator[str, None, None]:
-        messages = [
-            {"role": "user", "content": f"{self.prefix_text}\n{text}"}
-        ]
-        yield from self._create_chat_completion(messages, max_tokens=128, temperature=0.6, top_p=0.9, top_k=0, repeat_penalty=1.1)
\ No newline at end of file
+    def stream(self, text: str, cancel: Optional[CancellationToken] = None) -> Generator[CompletionDelta, None, None]:
+        messages = self._prompt_messages(text)
+        yield from self._stream_chat_completion(messages, max_tokens=128, temperature=0.6, top_p=0.9, top_k=0, repeat_penalty=1.1, cancel=cancel)
\ No newline at end of file
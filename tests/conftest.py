@@ -0,0 +1,11 @@
+"""The tests run on the stub backend, no model, llama-cpp-python or download needed"""
+import os
+import sys
+
+os.environ["SMOL_TOOLS_BACKEND"] = "stub"
+# Keep the user's config file and on-disk response cache out of the tests
+os.environ["SMOL_TOOLS_CONFIG"] = os.path.join(os.path.dirname(__file__), "no-config.json")
+os.environ["SMOL_TOOLS_RESPONSE_CACHE"] = "off"
+os.environ.setdefault("SMOL_TOOLS_WARM_UP", "none")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+from smol_tools.base import InferenceScheduler
+from smol_tools.cancellation import CancellationToken, RequestCancelled
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_budget_shared_between_threads():
+    cancel = CancellationToken(max_tokens=1000)
+    emitted = []
+
+    def worker():
+        n = 0
+        while cancel.consume():
+            n += 1
+        emitted.append(n)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5.0)
+    assert sum(emitted) == cancel.tokens == 1000
+    assert cancel.reason == "budget"
+
+
+def test_cancel_keeps_the_first_reason():
+    cancel = CancellationToken(max_tokens=2)
+    assert cancel.consume() and not cancel.cancelled
+    assert cancel.consume() and cancel.reason == "budget"
+    cancel.cancel()
+    assert cancel.reason == "budget"
+    assert not cancel.consume()
+    assert cancel.tokens == 2
+
+
+def test_cancelled_while_queued_leaves_the_queue():
+    scheduler = InferenceScheduler("test")
+    cancel = CancellationToken()
+    errors = []
+
+    def request():
+        try:
+            with scheduler.slot("Rewriter", cancel=cancel):
+                pytest.fail("a cancelled request got the slot")
+        except RequestCancelled as e:
+            errors.append(str(e))
+
+    with scheduler.slot("holder"):
+        thread = threading.Thread(target=request)
+        thread.start()
+        _wait_for(lambda: scheduler.stats()["queue_depth"] == 1)
+        cancel.cancel()
+        thread.join(5.0)
+        assert errors == ["cancelled"]
+        assert scheduler.stats()["queue_depth"] == 0
+    # The model is free again for the next request
+    with scheduler.slot("Titler") as ticket:
+        assert ticket.started_at is not None
+
+
+def test_deadline_while_queued():
+    scheduler = InferenceScheduler("test")
+    with scheduler.slot("holder"):
+        with pytest.raises(RequestCancelled, match="deadline"):
+            with scheduler.slot("Rewriter", cancel=CancellationToken(timeout=0.1)):
+                pass
+    assert scheduler.stats()["queue_depth"] == 0
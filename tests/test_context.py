@@ -0,0 +1,75 @@
+from smol_tools.context import ContextWindow, MESSAGE_OVERHEAD_TOKENS
+
+
+def _window(budget_tokens, summaries):
+    def summarize(summary, turns):
+        summaries.append((summary, [turn["content"] for turn in turns]))
+        return f"summary of {len(summaries)}"
+
+    return ContextWindow(count_tokens=lambda text: len(text.split()), summarize=summarize, budget_tokens=budget_tokens)
+
+
+def _history(n_turns):
+    history = []
+    for i in range(n_turns):
+        history.append({"role": "user", "content": f"question {i} " + "word " * 8})
+        history.append({"role": "assistant", "content": f"answer {i} " + "word " * 8})
+    return history
+
+
+def test_fits_without_compaction():
+    summaries = []
+    window = _window(1000, summaries)
+    history = _history(3)
+    messages = window.build("system", history)
+    assert messages[0] == {"role": "system", "content": "system"}
+    assert messages[1:] == history
+    assert summaries == [] and window.summarized_count == 0
+
+
+def test_compacts_to_low_water():
+    summaries = []
+    window = _window(100, summaries)
+    history = _history(5)
+    messages = window.build("system", history)
+
+    # The oldest turns were summarized once, cut at a user message
+    assert len(summaries) == 1
+    assert summaries[0][0] == ""
+    kept = history[window.summarized_count:]
+    assert kept[0]["role"] == "user"
+    assert messages == [
+        {"role": "system", "content": "system"},
+        {"role": "system", "content": "Summary of the earlier conversation: summary of 1"},
+    ] + kept
+    tokens = sum(len(m["content"].split()) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+    assert tokens <= 100 * window.low_water
+
+
+def test_prefix_stable_until_budget_exceeded_again():
+    summaries = []
+    window = _window(100, summaries)
+    history = _history(5)
+    window.build("system", history)
+    summarized = window.summarized_count
+
+    # One more turn fits below the budget, the summary and the cut don't move
+    history += _history(1)
+    window.build("system", history)
+    assert window.summarized_count == summarized and len(summaries) == 1
+
+    # Further turns compact again, folding the previous summary into the next
+    history += _history(3)
+    window.build("system", history)
+    assert len(summaries) == 2
+    assert summaries[1][0] == "summary of 1"
+    assert window.summarized_count > summarized
+
+
+def test_newest_message_always_kept():
+    summaries = []
+    window = _window(10, summaries)
+    history = [{"role": "user", "content": "word " * 50}]
+    messages = window.build("system", history)
+    assert messages[-1] == history[0]
+    assert summaries == []
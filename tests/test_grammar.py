@@ -0,0 +1,54 @@
+import json
+
+from smol_tools.grammar import ToolCallParser
+
+CALLS = [
+    {"name": "get_weather", "arguments": {"location": "Paris", "celsius": True}},
+    {"name": "final_answer", "arguments": {"answer": "It's {sunny} [mostly], \"warm\"\\"}},
+]
+TEXT = "Sure.\n<tool_call>" + json.dumps(CALLS) + "</tool_call>"
+
+
+def _feed_in_chunks(text, size):
+    parser = ToolCallParser()
+    calls = []
+    for i in range(0, len(text), size):
+        calls.extend(parser.feed(text[i:i + size]))
+    return parser, calls
+
+
+def test_whole_text():
+    parser = ToolCallParser()
+    assert parser.feed(TEXT) == CALLS
+    assert parser.closed
+    assert parser.errors == []
+
+
+def test_split_chunks():
+    # Chunks split the tag, keys, escapes and the braces inside strings
+    for size in range(1, 12):
+        parser, calls = _feed_in_chunks(TEXT, size)
+        assert calls == CALLS, size
+        assert parser.closed
+
+
+def test_calls_returned_as_they_close():
+    parser = ToolCallParser()
+    first = json.dumps(CALLS[0])
+    assert parser.feed("<tool_call>[" + first[:-1]) == []
+    assert parser.feed(first[-1] + ", ") == [CALLS[0]]
+    assert not parser.closed
+
+
+def test_text_before_the_tag_is_ignored():
+    parser = ToolCallParser()
+    assert parser.feed('I will call {"name": "x"} [now]') == []
+    assert parser.feed("<tool_call>[]") == []
+    assert parser.closed
+
+
+def test_invalid_object_goes_to_errors():
+    parser = ToolCallParser()
+    calls = parser.feed('<tool_call>[{"name": get_weather}, ' + json.dumps(CALLS[0]) + "]")
+    assert calls == [CALLS[0]]
+    assert parser.errors == ['{"name": get_weather}']
@@ -0,0 +1,73 @@
+from smol_tools.plan_cache import PlanCache
+
+WEATHER = [{"name": "get_weather", "arguments": {"location": "Paris"}}]
+RANDOM = [{"name": "get_random_number_between", "arguments": {"min": 1, "max": 10}}]
+BROWSER = [{"name": "open_webbrowser", "arguments": {"url": "https://example.com"}}]
+
+
+def _bag_of_words(texts):
+    vocabulary = ["random", "number", "between", "and", "pick", "a", "give", "me", "#", "weather"]
+    return [[text.split().count(word) for word in vocabulary] for text in texts]
+
+
+def test_exact_hit():
+    plans = PlanCache()
+    plans.store("What's the weather in Paris?", WEATHER)
+    assert plans.lookup("what's the weather in  Paris") == (WEATHER, "exact", 1.0)
+
+
+def test_template_hit_extracts_slots():
+    plans = PlanCache()
+    plans.store("Give me a random number between 1 and 10", RANDOM)
+    calls, kind, _ = plans.lookup("give me a random number between 5 and 50")
+    assert kind == "template"
+    assert calls == [{"name": "get_random_number_between", "arguments": {"min": 5, "max": 50}}]
+
+
+def test_text_slot_keeps_the_query_case():
+    plans = PlanCache()
+    plans.store("What's the weather in Paris?", WEATHER)
+    calls, kind, _ = plans.lookup("What's the weather in New York?")
+    assert kind == "template"
+    assert calls == [{"name": "get_weather", "arguments": {"location": "New York"}}]
+
+
+def test_text_slot_rejects_other_clauses():
+    plans = PlanCache()
+    plans.store("What's the weather in Paris?", WEATHER)
+    assert plans.lookup("What's the weather in Paris and what time is it?") is None
+    assert plans.lookup("What's the weather in Paris, then open google.com") is None
+    assert plans.lookup("What's the weather in Rome then in Oslo") is None
+
+
+def test_text_slot_length_limit():
+    plans = PlanCache(max_slot_chars=10)
+    plans.store("What's the weather in Paris?", WEATHER)
+    assert plans.lookup("What's the weather in Llanfairpwllgwyngyll") is None
+
+
+def test_different_query_misses():
+    plans = PlanCache()
+    plans.store("What's the weather in Paris?", WEATHER)
+    assert plans.lookup("What time is it in Paris?") is None
+    assert plans.stats()["misses"] == 1
+
+
+def test_side_effects_only_replayed_for_the_exact_query():
+    plans = PlanCache(side_effect_tools={"open_webbrowser"})
+    plans.store("Open https://example.com", BROWSER)
+    assert plans.lookup("open https://example.com") == (BROWSER, "exact", 1.0)
+    assert plans.lookup("Open https://evil.example") is None
+
+
+def test_semantic_hit_needs_numeric_slots():
+    plans = PlanCache(embed=_bag_of_words, min_similarity=0.8)
+    plans.store("Give me a random number between 1 and 10", RANDOM)
+    plans.store("What's the weather in Paris?", WEATHER)
+    calls, kind, score = plans.lookup("pick a random number between 3 and 7")
+    assert kind == "semantic" and score >= 0.8
+    assert calls == [{"name": "get_random_number_between", "arguments": {"min": 3, "max": 7}}]
+    # A text slot can't be re-extracted from a query that doesn't match its template
+    assert plans.lookup("weather for paris") is None
+    # Numbers that don't fit the slots
+    assert plans.lookup("pick a random number between 3 and 7 and 9") is None
@@ -0,0 +1,73 @@
+import pytest
+
+import smol_tools.base
+from smol_tools.cancellation import CancellationToken
+from smol_tools.response_cache import ResponseCache
+from smol_tools.rewriter import SmolRewriter
+
+MESSAGES = [
+    {"role": "system", "content": "You rewrite emails."},
+    {"role": "user", "content": "hey, can u send the report by friday"},
+]
+
+
+@pytest.fixture(scope="module")
+def rewriter():
+    return SmolRewriter()
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = ResponseCache(path=None)
+    monkeypatch.setattr(smol_tools.base, "response_cache", cache)
+    return cache
+
+
+def _complete(tool, max_tokens=8, cancel=None):
+    deltas = list(tool._stream_chat_completion(MESSAGES, temperature=0.0, max_tokens=max_tokens, cancel=cancel))
+    return "".join(d.text for d in deltas), deltas[-1].finish_reason
+
+
+def test_finished_response_is_cached(rewriter, cache):
+    text, finish_reason = _complete(rewriter)
+    assert finish_reason == "length"
+    assert cache.stats()["stores"] == 1
+    assert _complete(rewriter) == (text, finish_reason)
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_cancelled_response_is_not_cached(rewriter, cache):
+    cancel = CancellationToken()
+    cancel.cancel()
+    assert _complete(rewriter, cancel=cancel)[1] == "cancelled"
+    # Cut short by the token budget, the text is only a prefix of the response
+    assert _complete(rewriter, cancel=CancellationToken(max_tokens=2))[1] == "budget"
+    assert cache.stats()["stores"] == 0
+
+
+def test_closed_stream_is_not_cached(rewriter, cache):
+    stream = rewriter._stream_chat_completion(MESSAGES, temperature=0.0, max_tokens=8)
+    next(stream)
+    stream.close()
+    assert cache.stats()["stores"] == 0
+
+
+def test_sampled_response_is_not_cached_by_default(rewriter, cache):
+    list(rewriter._stream_chat_completion(MESSAGES, temperature=0.7, max_tokens=8))
+    assert cache.stats()["stores"] == 0
+
+
+def test_cache_hit_honors_cancel(rewriter, cache):
+    text, _ = _complete(rewriter, max_tokens=16)
+    assert cache.stats()["stores"] == 1
+
+    cancel = CancellationToken()
+    cancel.cancel()
+    assert _complete(rewriter, max_tokens=16, cancel=cancel) == ("", "cancelled")
+
+    cancel = CancellationToken(max_tokens=3)
+    replayed, finish_reason = _complete(rewriter, max_tokens=16, cancel=cancel)
+    assert finish_reason == "budget"
+    assert cancel.tokens == 3
+    assert text.startswith(replayed) and replayed != text
+    assert cache.stats()["memory_hits"] == 2
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from smol_tools.base import InferenceScheduler, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_NORMAL
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def _run_queued(scheduler, requests):
+    """Queue (label, owner, priority) requests behind a held slot in order, release it, return the serving order"""
+    served = []
+
+    def request(label, owner, priority):
+        with scheduler.slot(owner, priority):
+            served.append(label)
+
+    threads = []
+    with scheduler.slot("holder"):
+        for i, (label, owner, priority) in enumerate(requests):
+            thread = threading.Thread(target=request, args=(label, owner, priority))
+            thread.start()
+            threads.append(thread)
+            _wait_for(lambda: scheduler.stats()["queue_depth"] == i + 1)
+    for thread in threads:
+        thread.join(5.0)
+    return served
+
+
+def test_higher_priority_served_first():
+    scheduler = InferenceScheduler("test")
+    served = _run_queued(scheduler, [
+        ("background", "Summarizer", PRIORITY_BACKGROUND),
+        ("normal", "Rewriter", PRIORITY_NORMAL),
+        ("interactive", "Chatter", PRIORITY_INTERACTIVE),
+    ])
+    assert served == ["interactive", "normal", "background"]
+
+
+def test_owners_of_same_priority_are_interleaved():
+    scheduler = InferenceScheduler("test")
+    served = _run_queued(scheduler, [
+        ("a1", "Rewriter", PRIORITY_NORMAL),
+        ("a2", "Rewriter", PRIORITY_NORMAL),
+        ("a3", "Rewriter", PRIORITY_NORMAL),
+        ("b1", "Titler", PRIORITY_NORMAL),
+        ("b2", "Titler", PRIORITY_NORMAL),
+    ])
+    # The titler queued last but doesn't wait for the rewriter's whole backlog
+    assert served == ["a1", "b1", "a2", "b2", "a3"]